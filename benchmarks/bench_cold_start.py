@@ -0,0 +1,293 @@
+'''
+Cold-start benchmark of the packaged Lambda.
+
+Builds src.zip as described in the README and unpacks it into a temporary
+directory, as Lambda does into /var/task, without bytecode caches (the
+task directory is read-only, so none are written). Each run then starts a
+new interpreter, so every module is imported cold, and measures:
+
+    - import: the cumulative import time of src.lambda_handler, as
+      reported by python -X importtime (which also lists the slowest
+      imports).
+    - init: importing the handler with AWS_LAMBDA_FUNCTION_NAME set, so the
+      clients are also built (see src.lambda_handler.init_clients), as in
+      the Lambda init phase.
+    - first record: from the start of the first invocation to the first
+      record reaching the broker.
+    - cold start: init plus first record, i.e. from the first line of the
+      process to the first record.
+
+The Guardian API is served from a local HTTP server and records are
+published to a memory broker, so no network or AWS account is needed and
+the times are those of this code rather than of remote services.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_cold_start
+    python -m benchmarks.bench_cold_start --runs 10 --check
+
+--check exits with status 1 if the median import or cold start time is
+over its target (TARGETS, in milliseconds), so the targets can be tracked
+in CI. They allow for a slower machine than a developer's; lower them as
+cold starts improve.
+'''
+import argparse
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = {'import_ms': 300.0, 'cold_start_ms': 600.0}
+ARTICLES = 50
+SLOWEST_IMPORTS = 8
+IMPORT_TIME_PATTERN = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+# Run in a new interpreter in the unpacked package. The handler is called
+# once, as the first invocation of a new Lambda environment.
+CHILD_SCRIPT = '''
+import time
+start = time.perf_counter()
+import json
+import sys
+from src.lambda_handler import lambda_handler
+initialised = time.perf_counter()
+from src import guardian_api
+from src.brokers import MemoryBroker
+from src.connections_aws import connections_aws
+
+
+class FirstRecordBroker(MemoryBroker):
+    first = None
+
+    def put(self, stream_id, entries, max_retries=3):
+        if self.first is None:
+            self.first = time.perf_counter()
+        return super().put(stream_id, entries, max_retries)
+
+
+guardian_api.BASE_URL = sys.argv[1]
+connections_aws.set_credentials('Guardian-Key', 'test')
+broker = FirstRecordBroker()
+invoked = time.perf_counter()
+summaries = lambda_handler(
+    {'search_term': 'cold start', 'stream_id': 'cold_start'}, None, broker)
+print(json.dumps({
+    'records': sum(summary['records'] for summary in summaries or []),
+    'init_ms': (initialised - start) * 1000,
+    'first_record_ms': (broker.first - invoked) * 1000,
+    'cold_start_ms': (broker.first - start) * 1000,
+}))
+'''
+
+
+def _article(index: int) -> dict:
+    return {
+        'id': f'technology/2024/jan/01/cold-start-{index}',
+        'type': 'article',
+        'sectionId': 'technology',
+        'webPublicationDate': f'2024-01-01T{index % 24:02d}:00:00Z',
+        'webTitle': f'Article {index}',
+        'webUrl': f'https://www.theguardian.com/cold-start-{index}',
+        'apiUrl': f'https://content.guardianapis.com/cold-start-{index}',
+        'isHosted': False,
+    }
+
+
+class _GuardianHandler(BaseHTTPRequestHandler):
+    '''
+    Serves a single page of ARTICLES synthetic results for any search.
+    '''
+
+    body = json.dumps({'response': {
+        'status': 'ok', 'total': ARTICLES, 'startIndex': 1,
+        'pageSize': ARTICLES, 'currentPage': 1, 'pages': 1,
+        'orderBy': 'newest',
+        'results': [_article(index) for index in range(ARTICLES)],
+    }}).encode('utf-8')
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def build_package(directory: str) -> str:
+    '''
+    Builds src.zip from the repository's src directory, leaving out
+    bytecode caches, and unpacks it into directory/task.
+
+    Returns:
+        string containing the path of the unpacked package.
+    '''
+    package = os.path.join(directory, 'src.zip')
+    with zipfile.ZipFile(package, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for root, folders, files in os.walk(os.path.join(REPOSITORY, 'src')):
+            folders[:] = [name for name in folders if name != '__pycache__']
+            for name in files:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, REPOSITORY))
+    task = os.path.join(directory, 'task')
+    with zipfile.ZipFile(package) as archive:
+        archive.extractall(task)
+    return task
+
+
+def _environment(lambda_init: bool) -> dict:
+    environment = {
+        key: value for key, value in os.environ.items()
+        if not key.startswith(('PYTHON', 'AWS_', 'BROKER',
+                               'CHECKPOINT_', 'DEDUP_', 'RESPONSE_CACHE_'))
+    }
+    environment.update({
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': 'eu-west-2',
+        'GUARDIAN_RATE_LIMIT': '1000000',
+    })
+    if lambda_init:
+        environment['AWS_LAMBDA_FUNCTION_NAME'] = 'cold_start'
+    return environment
+
+
+def parse_import_times(output: str) -> list[tuple[str, int, float]]:
+    '''
+    Parses the report written by python -X importtime.
+
+    Returns:
+        list of (module, depth, cumulative milliseconds) tuples, in the
+        order reported (each module after those it imported).
+    '''
+    imports = []
+    for line in output.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            imports.append((match.group(4), len(match.group(3)) // 2,
+                            int(match.group(2)) / 1000))
+    return imports
+
+
+def measure_imports(task: str) -> list[tuple[str, int, float]]:
+    '''
+    Imports src.lambda_handler in a new interpreter under -X importtime.
+    '''
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import src.lambda_handler'],
+        cwd=task, env=_environment(False), capture_output=True, text=True,
+        check=True)
+    return parse_import_times(completed.stderr)
+
+
+def measure_first_record(task: str, url: str) -> dict:
+    '''
+    Runs CHILD_SCRIPT in a new interpreter.
+
+    Returns:
+        dict of the times measured (see the module docstring).
+    '''
+    completed = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, url], cwd=task,
+        env=_environment(True), capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'The cold start failed:\n{completed.stderr}')
+    result = json.loads(completed.stdout.splitlines()[-1])
+    if result['records'] != ARTICLES:
+        raise RuntimeError(
+            f"{result['records']} of {ARTICLES} records written:\n" +
+            completed.stderr)
+    return result
+
+
+def run(runs: int) -> tuple[dict, list[tuple[str, float]]]:
+    '''
+    Returns:
+        tuple of a dict holding the median of each time, in milliseconds,
+        and a list of the slowest imports of the first run, as (module,
+        cumulative milliseconds) tuples.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _GuardianHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/search'
+    samples = {'import_ms': [], 'init_ms': [], 'first_record_ms': [],
+               'cold_start_ms': []}
+    slowest = None
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            task = build_package(directory)
+            for _ in range(runs):
+                imports = measure_imports(task)
+                samples['import_ms'].append(next(
+                    milliseconds for module, _, milliseconds in imports
+                    if module == 'src.lambda_handler'))
+                if slowest is None:
+                    slowest = sorted(
+                        ((module, milliseconds)
+                         for module, depth, milliseconds in imports
+                         if depth == 1),
+                        key=lambda item: item[1],
+                        reverse=True)[:SLOWEST_IMPORTS]
+                result = measure_first_record(task, url)
+                for key in ('init_ms', 'first_record_ms', 'cold_start_ms'):
+                    samples[key].append(result[key])
+    finally:
+        server.shutdown()
+        server.server_close()
+    medians = {key: round(statistics.median(values), 1)
+               for key, values in samples.items()}
+    return medians, slowest
+
+
+def check(medians: dict, targets: dict = TARGETS) -> list[str]:
+    '''
+    Returns:
+        list of messages describing each time over its target.
+    '''
+    return [f'{key}: {medians[key]} ms, target {target} ms'
+            for key, target in targets.items()
+            if medians.get(key, math.inf) > target]
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cold start of the packaged handler.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts measured (the median is '
+                             'reported)')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if a target is missed')
+    args = parser.parse_args(argv)
+
+    medians, slowest = run(args.runs)
+    print('slowest imports of src.lambda_handler (cumulative):')
+    for module, milliseconds in slowest:
+        print(f'  {module:<28} {milliseconds:>8.1f} ms')
+    for key, value in medians.items():
+        target = TARGETS.get(key)
+        suffix = f'  (target {target} ms)' if target else ''
+        print(f'{key:<16} {value:>8.1f} ms{suffix}')
+    if args.check:
+        misses = check(medians)
+        for message in misses:
+            print(f'Target missed: {message}', file=sys.stderr)
+        return 1 if misses else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+'''
+End-to-end benchmarks of lambda_handler.
+
+Each scenario runs the handler against moto's Kinesis and Secrets Manager
+and a Guardian API mocked with responses, which serves synthetic result
+sets of the requested size. No network or AWS account is needed.
+
+Scenarios cover 10, 1k and 100k articles, and at 1k articles sweep the
+number of search terms per event, the PutRecords batch size and the
+record serializer. With --broker memory or segment, records are published
+to a local broker (see src.brokers) instead of moto's Kinesis, which
+measures the pipeline without the cost of the mock. For each scenario the
+benchmark reports:
+
+    - records/s: articles published per second (median run).
+    - p50/p99: handler latency over the runs, and PutRecords latency.
+    - peak RSS: the peak resident set size of the process so far, so
+      scenarios run in ascending size.
+    - AWS calls: API calls made per run, by service and operation.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --sizes 10 1000 --repeats 5
+    python -m benchmarks.bench_pipeline --broker memory
+    python -m benchmarks.bench_pipeline --save
+    python -m benchmarks.bench_pipeline --compare
+
+moto's Kinesis slows as a stream grows, so at 100k articles its own cost
+dominates the PutRecords latency; compare large runs with their own
+baseline rather than with the smaller sizes.
+
+--save stores the results in benchmarks/baselines.json. --compare exits
+with status 1 if a scenario's throughput has fallen more than the
+tolerance below its baseline, or it makes more AWS calls. Baselines are
+only comparable on the machine which recorded them.
+'''
+import argparse
+import json
+import math
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import responses
+from moto import mock_aws
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+SIZES = (10, 1000, 100000)
+SWEEP_SIZE = 1000
+TERM_COUNTS = (1, 4, 16)
+BATCH_SIZES = (100, 250, 500)
+SERIALIZERS = (('json', None), ('fastjson', None), ('msgpack', None),
+               ('json', 'gzip'), ('json', 'zstd'))
+BROKERS = ('kinesis', 'memory', 'segment')
+TOLERANCE = 0.25
+REGION = 'eu-west-2'
+
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SECURITY_TOKEN': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': REGION,
+    'GUARDIAN_RATE_LIMIT': '1000000',
+    'GUARDIAN_DAILY_QUOTA': '1000000',
+})
+
+from src import message_broker, lambda_handler as handler_module  # noqa
+from src.brokers import reset_broker  # noqa
+from src.connections_aws import connections_aws  # noqa
+from src.guardian_api import BASE_URL, MAX_PAGE_SIZE, set_rate_limiter  # noqa
+from src.lambda_handler import lambda_handler  # noqa
+from src.metrics import get_metrics  # noqa
+from src.serialization import SERIALIZERS as AVAILABLE_SERIALIZERS  # noqa
+
+
+def _article(search_term: str, index: int) -> dict:
+    day = index % 28 + 1
+    return {
+        'id': f'technology/2024/jan/{day:02d}/{search_term}-{index}',
+        'type': 'article',
+        'sectionId': 'technology',
+        'sectionName': 'Technology',
+        'webPublicationDate': f'2024-01-{day:02d}T{index % 24:02d}:00:00Z',
+        'webTitle': f'Article {index} about {search_term}',
+        'webUrl': 'https://www.theguardian.com/technology/2024/jan/' +
+                  f'{day:02d}/{search_term}-{index}',
+        'apiUrl': 'https://content.guardianapis.com/technology/2024/jan/' +
+                  f'{day:02d}/{search_term}-{index}',
+        'isHosted': False,
+        'pillarId': 'pillar/news',
+        'pillarName': 'News'
+    }
+
+
+def _guardian_callback(per_term: int):
+    '''
+    Returns a responses callback serving per_term synthetic articles for
+    every search term, paginated like the Guardian content API.
+    '''
+    def callback(request):
+        params = parse_qs(urlparse(request.url).query)
+        search_term = params['q'][0]
+        page = int(params['page'][0])
+        page_size = int(params['page-size'][0])
+        start = (page - 1) * page_size
+        results = [_article(search_term, index) for index in
+                   range(start, min(start + page_size, per_term))]
+        body = {'response': {
+            'status': 'ok',
+            'total': per_term,
+            'startIndex': start + 1,
+            'pageSize': page_size,
+            'currentPage': page,
+            'pages': max(1, math.ceil(per_term / page_size)),
+            'orderBy': 'newest',
+            'results': results
+        }}
+        return 200, {}, json.dumps(body)
+    return callback
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    '''
+    Returns the nearest-rank percentile of values.
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percentile / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS.
+    return peak / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def scenario_name(scenario: dict) -> str:
+    name = (f"n={scenario['size']} terms={scenario['terms']} " +
+            f"batch={scenario['batch_size']} " +
+            f"serializer={scenario['serializer']}")
+    if scenario['compression']:
+        name += f"+{scenario['compression']}"
+    if scenario['broker'] != 'kinesis':
+        name += f" broker={scenario['broker']}"
+    return name
+
+
+def build_scenarios(sizes: list[int], broker: str = 'kinesis') -> list[dict]:
+    '''
+    Returns the scenarios to run: every size with the default settings,
+    then the sweeps at SWEEP_SIZE articles. Serializers whose optional
+    package is not installed are skipped.
+    '''
+    def scenario(size, terms=1, batch_size=500, serializer='json',
+                 compression=None):
+        return {'size': size, 'terms': terms, 'batch_size': batch_size,
+                'serializer': serializer, 'compression': compression,
+                'broker': broker}
+
+    scenarios = [scenario(size) for size in sorted(sizes)]
+    scenarios += [scenario(SWEEP_SIZE, terms=terms)
+                  for terms in TERM_COUNTS]
+    scenarios += [scenario(SWEEP_SIZE, batch_size=batch_size)
+                  for batch_size in BATCH_SIZES]
+    for serializer, compression in SERIALIZERS:
+        try:
+            AVAILABLE_SERIALIZERS[serializer]()
+            if compression == 'zstd':
+                import zstandard  # noqa: F401
+        except ImportError:
+            continue
+        scenarios.append(scenario(
+            SWEEP_SIZE, serializer=serializer, compression=compression))
+
+    unique = {}
+    for item in scenarios:
+        unique.setdefault(scenario_name(item), item)
+    return list(unique.values())
+
+
+def run_scenario(scenario: dict, repeats: int) -> dict:
+    '''
+    Runs lambda_handler repeats times for a scenario.
+
+    Each run publishes to a new stream, with the process-wide caches
+    (clients, secrets, streams and rate limiter) cleared first, so every
+    run pays for creating its stream.
+
+    Returns:
+        dict of the scenario's results.
+
+    Raises:
+        RuntimeError: If a run does not publish every article.
+    '''
+    size = scenario['size']
+    terms = [f'term{index}' for index in range(scenario['terms'])]
+    per_term = math.ceil(size / len(terms))
+    expected = per_term * len(terms)
+    event = {
+        'date_from': '2024-01-01',
+        'search_terms': terms,
+        'max_pages': math.ceil(per_term / MAX_PAGE_SIZE)
+    }
+    environment = {'SERIALIZER': scenario['serializer'],
+                   'COMPRESSION': scenario['compression'] or '',
+                   'BROKER': scenario['broker']}
+    if scenario['broker'] == 'segment':
+        environment['BROKER_PATH'] = tempfile.mkdtemp(prefix='segments-')
+    calls = Counter()
+
+    def count_call(model, **kwargs):
+        calls[f'{model.service_model.service_name}.{model.name}'] += 1
+
+    durations = []
+    put_durations = []
+    with mock_aws(), \
+            responses.RequestsMock(assert_all_requests_are_fired=False) \
+            as mocked_api, \
+            patch.dict(os.environ, environment), \
+            patch.object(message_broker, 'MAX_BATCH_RECORDS',
+                         scenario['batch_size']), \
+            patch.object(handler_module, 'MAX_BATCH_RECORDS',
+                         scenario['batch_size']), \
+            patch('src.metrics.Metrics.emit'):
+        mocked_api.add_callback(
+            responses.GET, BASE_URL, callback=_guardian_callback(per_term))
+        boto3.client('secretsmanager', region_name=REGION).create_secret(
+            Name='Guardian-Key', SecretString='benchmark-key')
+        events = boto3.DEFAULT_SESSION.events
+        events.register('before-call', count_call)
+        try:
+            for run in range(repeats):
+                connections_aws.clear_cache()
+                message_broker.forget_stream()
+                reset_broker()
+                set_rate_limiter(None)
+                event['stream_id'] = f'benchmark-{run}'
+                start = time.perf_counter()
+                summaries = lambda_handler(event, None)
+                durations.append(time.perf_counter() - start)
+                written = sum(summary['records']
+                              for summary in summaries or [])
+                if written != expected:
+                    raise RuntimeError(
+                        f'{scenario_name(scenario)}: {written} of ' +
+                        f'{expected} records written.')
+                put_durations += get_metrics().get('KinesisPutDuration') \
+                    or []
+        finally:
+            events.unregister('before-call', count_call)
+            reset_broker()
+
+    median = statistics.median(durations)
+    return {
+        'records': expected,
+        'records_per_second': round(expected / median, 1),
+        'p50_ms': round(_percentile(durations, 50) * 1000, 1),
+        'p99_ms': round(_percentile(durations, 99) * 1000, 1),
+        'put_p50_ms': round(_percentile(put_durations, 50), 2),
+        'put_p99_ms': round(_percentile(put_durations, 99), 2),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'aws_calls': {name: count // repeats
+                      for name, count in sorted(calls.items())}
+    }
+
+
+def compare(results: dict, baselines: dict,
+            tolerance: float = TOLERANCE) -> list[str]:
+    '''
+    Returns:
+        list of messages describing each regression from the baselines.
+    '''
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        floor = baseline['records_per_second'] * (1 - tolerance)
+        if result['records_per_second'] < floor:
+            regressions.append(
+                f"{name}: {result['records_per_second']} records/s, " +
+                f"baseline {baseline['records_per_second']}")
+        for call, count in result['aws_calls'].items():
+            if count > baseline['aws_calls'].get(call, 0):
+                regressions.append(
+                    f'{name}: {count} {call} calls, baseline ' +
+                    f"{baseline['aws_calls'].get(call, 0)}")
+    return regressions
+
+
+def _print_result(name: str, result: dict):
+    calls = ', '.join(f'{call}={count}'
+                      for call, count in result['aws_calls'].items())
+    print(f"{name:<52} {result['records_per_second']:>10.1f} rec/s  " +
+          f"p50 {result['p50_ms']:>9.1f} ms  " +
+          f"p99 {result['p99_ms']:>9.1f} ms  " +
+          f"put p50/p99 {result['put_p50_ms']}/{result['put_p99_ms']} ms  " +
+          f"rss {result['peak_rss_mb']:.1f} MB  [{calls}]")
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark lambda_handler end to end.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='numbers of articles to benchmark')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='runs per scenario (one for 100k articles '
+                             'or more)')
+    parser.add_argument('--broker', choices=BROKERS, default='kinesis',
+                        help='broker published to (default kinesis)')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baselines')
+    parser.add_argument('--compare', action='store_true',
+                        help='exit with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed fall in throughput (default 0.25)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for scenario in build_scenarios(args.sizes, args.broker):
+        name = scenario_name(scenario)
+        repeats = 1 if scenario['size'] >= 100000 else args.repeats
+        results[name] = run_scenario(scenario, repeats)
+        _print_result(name, results[name])
+
+    if args.save:
+        with open(BASELINE_PATH, 'w') as file:
+            json.dump(results, file, indent=2)
+            file.write('\n')
+        print(f'Baselines saved to {BASELINE_PATH}.')
+    if args.compare:
+        with open(BASELINE_PATH) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+'''
+Micro-benchmark of filter_response.
+
+Compares the field projector (src.projection.FieldProjector) with the
+dict comprehension filter_response used before it, which scanned every
+key of every record against the list of fields. Each case filters a page
+of MAX_PAGE_SIZE synthetic results shaped like the Guardian's, with a
+'fields' dict as returned for show-fields.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_projection
+    python -m benchmarks.bench_projection --pages 500 --repeats 7
+'''
+import argparse
+import statistics
+import sys
+import timeit
+
+from src.guardian_api import DEFAULT_FIELDS, MAX_PAGE_SIZE, filter_response
+from src.projection import FieldProjector
+
+NESTED_FIELDS = (*DEFAULT_FIELDS, ('fields.bodyText', 'body'),
+                 'fields.wordcount')
+
+
+def legacy_filter_response(response: dict, fields=list(DEFAULT_FIELDS)):
+    '''
+    The implementation of filter_response before the field projector.
+    '''
+    if not response:
+        return []
+    records = response['response']['results']
+    return [{key: value for key, value in record.items()
+            if key in fields} for record in records]
+
+
+def legacy_nested(response: dict) -> list[dict]:
+    '''
+    Projects NESTED_FIELDS in the style of the legacy filter_response, for
+    comparison.
+    '''
+    results = []
+    for record in legacy_filter_response(
+            response, [*DEFAULT_FIELDS, 'fields']):
+        fields = record.pop('fields', None) or {}
+        if 'bodyText' in fields:
+            record['body'] = fields['bodyText']
+        if 'wordcount' in fields:
+            record['wordcount'] = fields['wordcount']
+        results.append(record)
+    return results
+
+
+def synthetic_page(size: int = MAX_PAGE_SIZE) -> dict:
+    results = [{
+        'id': f'technology/2024/jan/01/article-{index}',
+        'type': 'article',
+        'sectionId': 'technology',
+        'sectionName': 'Technology',
+        'webPublicationDate': '2024-01-01T00:00:00Z',
+        'webTitle': f'Article {index}',
+        'webUrl': f'https://www.theguardian.com/article-{index}',
+        'apiUrl': f'https://content.guardianapis.com/article-{index}',
+        'fields': {'bodyText': 'text ' * 100, 'wordcount': '100',
+                   'headline': f'Article {index}'},
+        'tags': [],
+        'isHosted': False,
+        'pillarId': 'pillar/news',
+        'pillarName': 'News',
+        'lang': 'en',
+    } for index in range(size)]
+    return {'response': {'status': 'ok', 'results': results}}
+
+
+def time_per_record(function, page: dict, pages: int,
+                    repeats: int) -> float:
+    '''
+    Returns:
+        float, the median time to filter one record, in nanoseconds.
+    '''
+    runs = timeit.repeat(lambda: function(page), number=pages,
+                         repeat=repeats)
+    records = pages * len(page['response']['results'])
+    return statistics.median(runs) / records * 1e9
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark filter_response against the field '
+                    'projector.')
+    parser.add_argument('--pages', type=int, default=200,
+                        help='pages filtered per run')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='runs per case (the median is reported)')
+    args = parser.parse_args(argv)
+
+    page = synthetic_page()
+    nested = FieldProjector(NESTED_FIELDS)
+    assert filter_response(page) == legacy_filter_response(page)
+    assert nested.project_page(page['response']['results']) == \
+        legacy_nested(page)
+    cases = [
+        ('default fields', legacy_filter_response, filter_response),
+        ('nested fields', legacy_nested,
+         lambda response: nested.project_page(
+             response['response']['results'])),
+    ]
+    for name, legacy, projected in cases:
+        before = time_per_record(legacy, page, args.pages, args.repeats)
+        after = time_per_record(projected, page, args.pages, args.repeats)
+        print(f'{name:<16} legacy {before:>8.1f} ns/record  '
+              f'projector {after:>8.1f} ns/record  '
+              f'speed-up {before / after:.2f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
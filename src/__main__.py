@@ -0,0 +1,241 @@
+'''
+Runs lambda_handler locally, without deploying it as a Lambda.
+
+Events are built from the command line, or read from a file holding a
+JSON event, a JSON list of events or one event per line (JSON lines).
+Each event is processed in turn, and the records published are written to
+a sink:
+
+    - stdout: JSON lines on standard output (the default).
+    - jsonl: JSON lines appended to the file given by --output.
+    - segment: memory-mapped segment files in the --output directory
+      (see src.brokers.SegmentFileBroker), for high-throughput runs.
+    - kinesis: the Kinesis stream named in the event, as in AWS.
+
+The Guardian API key is taken from --api-key or the GUARDIAN_KEY variable
+(which may be set in a .env file), falling back to AWS Secrets Manager.
+Logs, metrics and the per-event summaries are written to standard error,
+so standard output holds only the records.
+
+Usage (from the repository root):
+
+    python -m src --search-term "machine learning" --date-from 2024-01-01
+    python -m src --events events.jsonl --sink jsonl --output records.jsonl
+    python -m src --events events.jsonl --workers 16 --profile run.prof
+
+--profile writes a cProfile dump (readable with pstats or snakeviz), or
+with --profiler pyinstrument, the pyinstrument report as text, or as HTML
+if the path ends in .html.
+'''
+import argparse
+import cProfile
+import json
+import logging
+import os
+import sys
+from dotenv import load_dotenv
+from src.brokers import JsonlFileBroker, SegmentFileBroker, StdoutBroker
+from src.connections_aws import connections_aws
+from src.lambda_handler import (
+    EventFailedError, lambda_handler, request_failed)
+from src.metrics import set_stream
+
+DEFAULT_STREAM_ID = 'guardian_content'
+SINKS = ('stdout', 'jsonl', 'segment', 'kinesis')
+PROFILERS = ('cprofile', 'pyinstrument')
+
+
+def load_events(path: str) -> list[dict]:
+    '''
+    Reads events from a file.
+
+    Args:
+        path: string specifying a file containing a JSON event, a JSON
+        list of events, or one JSON event per line.
+
+    Returns:
+        list of event dictionaries.
+
+    Raises:
+        ValueError: If the file does not contain JSON events.
+    '''
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    try:
+        events = json.loads(text)
+    except json.JSONDecodeError:
+        events = [json.loads(line) for line in text.splitlines()
+                  if line.strip()]
+    if isinstance(events, dict):
+        events = [events]
+    if not isinstance(events, list) or not all(
+            isinstance(event, dict) for event in events):
+        raise ValueError(f'{path} does not contain JSON events.')
+    return events
+
+
+def build_events(args: argparse.Namespace) -> list[dict]:
+    '''
+    Returns the events to process. Options given on the command line are
+    used as defaults for events read from a file.
+    '''
+    events = load_events(args.events) if args.events else [{}]
+    defaults = {
+        'search_terms': args.search_term,
+        'date_from': args.date_from,
+        'stream_id': args.stream_id,
+        'max_pages': args.max_pages,
+        'max_workers': args.workers
+    }
+    for event in events:
+        for key, value in defaults.items():
+            if value is None:
+                continue
+            if key == 'search_terms' and 'search_term' in event:
+                continue
+            event.setdefault(key, value)
+    return events
+
+
+def create_broker(sink: str, output: str = None):
+    '''
+    Returns:
+        Broker for the sink (see src.brokers), or None for kinesis, which
+        the handler uses by default.
+
+    Raises:
+        ValueError: If a file sink is chosen without an output path.
+    '''
+    if sink == 'stdout':
+        return StdoutBroker()
+    if sink == 'kinesis':
+        return None
+    if not output:
+        raise ValueError(f'The {sink} sink requires --output.')
+    if sink == 'jsonl':
+        return JsonlFileBroker(output)
+    return SegmentFileBroker(output)
+
+
+def run(events: list[dict], broker=None) -> int:
+    '''
+    Processes each event with lambda_handler.
+
+    Returns:
+        int, the number of events which failed, or which left a search
+        term with an error or records not written, counting each failed
+        message of a batch event (e.g. a saved SQS event). A single
+        EventBridge event which failed counts once.
+    '''
+    failures = 0
+    for event in events:
+        try:
+            result = lambda_handler(event, None, broker)
+        except EventFailedError as error:
+            print(json.dumps({'event': event, 'error': str(error)}),
+                  file=sys.stderr)
+            failures += 1
+            continue
+        if isinstance(result, dict):
+            print(json.dumps(dict(result, event=event)), file=sys.stderr)
+            failures += len(result['batchItemFailures'])
+            continue
+        print(json.dumps({'event': event, 'summaries': result}),
+              file=sys.stderr)
+        if request_failed(result):
+            failures += 1
+    return failures
+
+
+def _profile(function, path: str, profiler: str):
+    '''
+    Calls function under a profiler and writes its output to path.
+
+    Returns:
+        the value returned by function.
+    '''
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        session = Profiler()
+        session.start()
+        try:
+            return function()
+        finally:
+            session.stop()
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(session.output_html() if path.endswith('.html')
+                           else session.output_text())
+    session = cProfile.Profile()
+    try:
+        return session.runcall(function)
+    finally:
+        session.dump_stats(path)
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m src',
+        description='Run the Guardian streaming handler locally.')
+    parser.add_argument('--events', metavar='FILE',
+                        help='JSON or JSON lines file of events')
+    parser.add_argument('--search-term', action='append',
+                        help='search term (may be repeated)')
+    parser.add_argument('--date-from', help='first date, as YYYY-MM-DD')
+    parser.add_argument('--stream-id',
+                        help=f'stream name (default {DEFAULT_STREAM_ID})')
+    parser.add_argument('--max-pages', type=int,
+                        help='fetch every page up to this limit')
+    parser.add_argument('--workers', type=int,
+                        help='search terms fetched concurrently per event')
+    parser.add_argument('--sink', choices=SINKS, default='stdout',
+                        help='where records are written (default stdout)')
+    parser.add_argument('--output', metavar='PATH',
+                        help='file written by the jsonl sink, or '
+                             'directory written by the segment sink')
+    parser.add_argument('--api-key',
+                        help='Guardian API key (default $GUARDIAN_KEY)')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write profiler output to PATH')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile',
+                        help='profiler used by --profile (default cprofile)')
+    args = parser.parse_args(argv)
+    if not args.events and not args.search_term:
+        parser.error('one of --events or --search-term is required')
+    if args.sink in ('jsonl', 'segment') and not args.output:
+        parser.error(f'--sink {args.sink} requires --output')
+    if args.sink != 'kinesis' and args.stream_id is None:
+        args.stream_id = DEFAULT_STREAM_ID
+    if args.profiler == 'pyinstrument' and args.profile:
+        try:
+            import pyinstrument  # noqa: F401
+        except ImportError:
+            parser.error('--profiler pyinstrument requires pyinstrument')
+    return args
+
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(argv)
+    load_dotenv()
+    logging.basicConfig(
+        stream=sys.stderr, format='%(levelname)s %(name)s: %(message)s')
+    set_stream(sys.stderr)
+    api_key = args.api_key or os.environ.get('GUARDIAN_KEY')
+    if api_key:
+        connections_aws.set_credentials('Guardian-Key', api_key)
+
+    events = build_events(args)
+    broker = create_broker(args.sink, args.output)
+    try:
+        if args.profile:
+            failures = _profile(
+                lambda: run(events, broker), args.profile, args.profiler)
+        else:
+            failures = run(events, broker)
+    finally:
+        if broker is not None:
+            broker.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import hashlib
+from src.partitioning import group_by_shard
+
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+MAX_AGGREGATED_SIZE = 1024 * 1024
+
+
+def _encode_varint(value: int) -> bytes:
+    output = bytearray()
+    while value > 0x7f:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
+
+
+def _decode_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _encode_field(number: int, value) -> bytes:
+    '''
+    Encodes a protobuf field: varint (wire type 0) for int values and
+    length-delimited (wire type 2) for bytes values.
+    '''
+    if isinstance(value, int):
+        return _encode_varint(number << 3) + _encode_varint(value)
+    return _encode_varint(number << 3 | 2) + \
+        _encode_varint(len(value)) + value
+
+
+def _decode_fields(data: bytes):
+    '''
+    Yields (field number, value) for each field of a protobuf message.
+    '''
+    position = 0
+    while position < len(data):
+        key, position = _decode_varint(data, position)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, position = _decode_varint(data, position)
+        elif wire_type == 2:
+            length, position = _decode_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}.')
+        yield number, value
+
+
+class RecordAggregator:
+    '''
+    Packs user records into KPL aggregated records.
+
+    The output uses the Kinesis Producer Library aggregation format: the
+    4 magic bytes, an AggregatedRecord protobuf message and the MD5 digest
+    of the message. Consumers using the KCL (or deaggregate) recover the
+    original records with their partition keys. Each aggregated record,
+    including its partition key, stays within max_size bytes.
+
+    Args:
+        max_size: int specifying the maximum size of an aggregated record
+        and its partition key, in bytes.
+    '''
+
+    def __init__(self, max_size: int = MAX_AGGREGATED_SIZE):
+        self.max_size = max_size
+        self._reset()
+
+    def _reset(self):
+        self._partition_keys = {}
+        self._hash_keys = {}
+        self._records = []
+        self._size = len(KPL_MAGIC) + DIGEST_SIZE
+        self._first_key = None
+        self._first_hash_key = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def _added_size(
+            self, data: bytes, partition_key: str,
+            explicit_hash_key: str) -> tuple[int, bytes]:
+        size = 0
+        key_index = self._partition_keys.get(partition_key)
+        if key_index is None:
+            key_index = len(self._partition_keys)
+            size += len(_encode_field(1, partition_key.encode('utf-8')))
+        record = _encode_field(1, key_index)
+        if explicit_hash_key is not None:
+            hash_index = self._hash_keys.get(explicit_hash_key)
+            if hash_index is None:
+                hash_index = len(self._hash_keys)
+                size += len(_encode_field(
+                    2, explicit_hash_key.encode('utf-8')))
+            record += _encode_field(2, hash_index)
+        record += _encode_field(3, data)
+        size += len(_encode_field(3, record))
+        return size, record
+
+    def fits(
+            self, data: bytes, partition_key: str,
+            explicit_hash_key: str = None) -> bool:
+        '''
+        Returns:
+            bool, True if the record can be added without exceeding
+            max_size.
+        '''
+        size, _ = self._added_size(data, partition_key, explicit_hash_key)
+        first_key = self._first_key or partition_key
+        total = self._size + size + len(first_key.encode('utf-8'))
+        return total <= self.max_size
+
+    def add(
+            self, data: bytes, partition_key: str,
+            explicit_hash_key: str = None):
+        '''
+        Adds a user record. Check fits first; a record which does not fit
+        is still added, producing an aggregated record over max_size.
+        '''
+        size, record = self._added_size(
+            data, partition_key, explicit_hash_key)
+        if partition_key not in self._partition_keys:
+            self._partition_keys[partition_key] = len(self._partition_keys)
+        if (explicit_hash_key is not None
+                and explicit_hash_key not in self._hash_keys):
+            self._hash_keys[explicit_hash_key] = len(self._hash_keys)
+        if self._first_key is None:
+            self._first_key = partition_key
+            self._first_hash_key = explicit_hash_key
+        self._records.append(record)
+        self._size += size
+
+    def flush(self) -> dict:
+        '''
+        Returns the pending user records as a single PutRecords entry and
+        starts a new aggregated record.
+
+        Returns:
+            dict containing Data, PartitionKey and (if the first record had
+            one) ExplicitHashKey, or None if no records are pending.
+        '''
+        if not self._records:
+            return None
+        message = b''.join(
+            [_encode_field(1, key.encode('utf-8'))
+             for key in self._partition_keys] +
+            [_encode_field(2, key.encode('utf-8'))
+             for key in self._hash_keys] +
+            [_encode_field(3, record) for record in self._records]
+        )
+        entry = {
+            'Data': KPL_MAGIC + message + hashlib.md5(message).digest(),
+            'PartitionKey': self._first_key
+        }
+        if self._first_hash_key is not None:
+            entry['ExplicitHashKey'] = self._first_hash_key
+        self._reset()
+        return entry
+
+
+def aggregate_entries(
+        entries: list[dict], max_size: int = MAX_AGGREGATED_SIZE,
+        shard_ranges: list[tuple[int, int]] = None
+        ) -> list[tuple[dict, list[int]]]:
+    '''
+    Packs PutRecords entries into as few aggregated entries as possible.
+
+    As in the KPL, only entries routed to the same shard are packed
+    together, so each aggregated record (which takes the keys of its
+    first entry) is written to the shard of every user record it holds.
+    Entries for each shard are packed in order. A group holding a single
+    entry is left unaggregated, as the aggregation format would only add
+    overhead.
+
+    Args:
+        entries: list of PutRecords entries, each containing Data (bytes),
+        PartitionKey (str) and an optional ExplicitHashKey (str).
+        max_size: int specifying the maximum size of an aggregated record.
+        shard_ranges: list of the (starting hash key, ending hash key)
+        tuples of the stream's shards (see src.partitioning). If None,
+        only entries with the same hash key are packed together.
+
+    Returns:
+        list of (entry, indices) tuples, ordered by their first index,
+        where indices lists the positions in entries of the user records
+        packed into entry.
+    '''
+    groups = []
+    aggregator = RecordAggregator(max_size)
+    indices = []
+
+    def close_group():
+        if len(indices) == 1:
+            groups.append((entries[indices[0]], list(indices)))
+            aggregator._reset()
+        elif indices:
+            groups.append((aggregator.flush(), list(indices)))
+        indices.clear()
+
+    for shard in group_by_shard(entries, shard_ranges):
+        for index in shard:
+            entry = entries[index]
+            args = (entry['Data'], entry['PartitionKey'],
+                    entry.get('ExplicitHashKey'))
+            if indices and not aggregator.fits(*args):
+                close_group()
+            aggregator.add(*args)
+            indices.append(index)
+        close_group()
+    groups.sort(key=lambda group: group[1][0])
+    return groups
+
+
+def is_aggregated(data: bytes) -> bool:
+    '''
+    Returns:
+        bool, True if data is a KPL aggregated record with a valid digest.
+    '''
+    if len(data) < len(KPL_MAGIC) + DIGEST_SIZE or \
+            not data.startswith(KPL_MAGIC):
+        return False
+    message = data[len(KPL_MAGIC):-DIGEST_SIZE]
+    return hashlib.md5(message).digest() == data[-DIGEST_SIZE:]
+
+
+def deaggregate(data: bytes, partition_key: str = None) -> list[dict]:
+    '''
+    Extracts the user records from a Kinesis record.
+
+    Args:
+        data: bytes containing the Data of a Kinesis record.
+        partition_key: string containing the partition key of the Kinesis
+        record, returned for records which are not aggregated.
+
+    Returns:
+        list of dictionaries containing Data, PartitionKey and
+        ExplicitHashKey (None if not set) for each user record. A record
+        which is not aggregated is returned as a single item.
+    '''
+    if not is_aggregated(data):
+        return [{'Data': data, 'PartitionKey': partition_key,
+                 'ExplicitHashKey': None}]
+    partition_keys = []
+    hash_keys = []
+    records = []
+    for number, value in _decode_fields(
+            data[len(KPL_MAGIC):-DIGEST_SIZE]):
+        if number == 1:
+            partition_keys.append(value.decode('utf-8'))
+        elif number == 2:
+            hash_keys.append(value.decode('utf-8'))
+        elif number == 3:
+            records.append(value)
+
+    output = []
+    for record in records:
+        fields = dict(_decode_fields(record))
+        hash_index = fields.get(2)
+        output.append({
+            'Data': fields.get(3, b''),
+            'PartitionKey': partition_keys[fields[1]],
+            'ExplicitHashKey': None if hash_index is None
+            else hash_keys[hash_index]
+        })
+    return output
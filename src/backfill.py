@@ -0,0 +1,210 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from src.guardian_api import get_all_guardian_content, filter_response
+from src.brokers import Broker, KinesisBroker
+from src.message_broker import make_entry
+from src.partitioning import TermPartitioner
+
+logger = logging.getLogger('GuardianLogger')
+
+DEFAULT_WINDOW_DAYS = 30
+MAX_WINDOW_PAGES = 25
+CHECKPOINT_PREFIX = 'backfill:'
+
+
+def split_date_range(
+        date_from: str, date_to: str,
+        window_days: int = DEFAULT_WINDOW_DAYS) -> list[tuple[str, str]]:
+    '''
+    Splits a date range into consecutive windows.
+
+    Args:
+        date_from: string specifying the first date, as YYYY-MM-DD.
+        date_to: string specifying the last date (inclusive).
+        window_days: int specifying the number of days in each window;
+        the last window may be shorter.
+
+    Returns:
+        list of (from-date, to-date) tuples, both inclusive, in
+        chronological order.
+
+    Raises:
+        ValueError: If date_to is before date_from.
+    '''
+    start = date.fromisoformat(date_from)
+    end = date.fromisoformat(date_to)
+    if end < start:
+        raise ValueError('Parameter (date_to) cannot be before date_from.')
+    windows = []
+    while start <= end:
+        window_end = min(start + timedelta(days=window_days - 1), end)
+        windows.append((start.isoformat(), window_end.isoformat()))
+        start = window_end + timedelta(days=1)
+    return windows
+
+
+def _halve(window: tuple[str, str]) -> list[tuple[str, str]]:
+    start = date.fromisoformat(window[0])
+    end = date.fromisoformat(window[1])
+    middle = start + (end - start) // 2
+    return [(window[0], middle.isoformat()),
+            ((middle + timedelta(days=1)).isoformat(), window[1])]
+
+
+def fetch_window(
+        api_key: str, search_term: str, window: tuple[str, str],
+        max_pages: int = MAX_WINDOW_PAGES) -> list[dict]:
+    '''
+    Retrieves every record published in a window, oldest first.
+
+    The first page reports how many pages the window holds. If there are
+    more than max_pages, the window is split in half and each half is
+    fetched in turn, so no window needs more than max_pages requests at
+    the maximum page size. A single day holding more than max_pages pages
+    is truncated, with a warning.
+
+    Returns:
+        list of filtered records, each tagged with the search term under
+        the key 'keyword'.
+    '''
+    responses = get_all_guardian_content(
+        api_key, search_term, window[0], max_pages=max_pages,
+        max_workers=1, date_to=window[1])
+    first_page = next(responses)
+    pages = first_page['response'].get('pages', 1)
+    if pages > max_pages:
+        if window[0] < window[1]:
+            responses.close()
+            return [record for half in _halve(window)
+                    for record in fetch_window(
+                        api_key, search_term, half, max_pages)]
+        logger.warning(f'Backfill of {search_term} on {window[0]} ' +
+                       f'truncated to {max_pages} of {pages} pages.')
+
+    records = []
+    for response in (first_page, *responses):
+        results = filter_response(response)
+        for record in results:
+            record['keyword'] = search_term
+        records.extend(results)
+    records.reverse()
+    return records
+
+
+def backfill(
+        api_key: str, search_term: str, date_from: str, date_to: str,
+        stream_id: str, kinesis, window_days: int = DEFAULT_WINDOW_DAYS,
+        max_workers: int = 4, checkpoints=None, serializer=None,
+        deadline=None, partitioner=None) -> dict:
+    '''
+    Streams every article for a search term in a date range to a stream.
+
+    The range is split into windows (see split_date_range), which are
+    fetched concurrently on a thread pool with at most max_workers windows
+    in flight. Windows are written to the stream one at a time in
+    chronological order, each with its records oldest first, so each
+    shard receives its records of the range in order.
+
+    If a checkpoint store is given, the last date of each window is stored
+    once every record in it, and in every earlier window, has been written.
+    The date is stored for the term, stream and date_from, as the range
+    from date_from up to it is complete whatever the date_to or
+    window_days. A later backfill of the same term and stream from the same
+    date_from skips those windows, so an interrupted backfill resumes where
+    it stopped; a backfill from another date_from, e.g. of an earlier
+    range, starts afresh. The backfill stops
+    at the first window which cannot be fetched or fully written, and
+    when a deadline is given no new windows are fetched once it expires.
+
+    Args:
+        kinesis: boto3 Kinesis client, or a Broker (see src.brokers).
+        window_days: int specifying the number of days in each window.
+        max_workers: int specifying the number of windows fetched at once.
+        checkpoints: CheckpointStore recording completed windows.
+        serializer: Serializer for the records (see src.serialization).
+        deadline: Deadline after which no new windows are fetched.
+        partitioner: PartitionStrategy assigning records to shards (see
+        src.partitioning). By default records are partitioned by search
+        term.
+
+    Returns:
+        dict containing 'search_term', 'date_from', 'date_to', 'windows'
+        (number in the range), 'skipped' (already completed), 'completed',
+        'records', 'failed', 'resume_from' (first date still to be
+        written, or None if the range is complete) and 'error'.
+    '''
+    windows = split_date_range(date_from, date_to, window_days)
+    checkpoint_term = f'{CHECKPOINT_PREFIX}{search_term}:{date_from}'
+    done = None
+    if checkpoints is not None:
+        done = checkpoints.get_watermark(checkpoint_term, stream_id)
+    pending = [window for window in windows
+               if done is None or window[1] > done]
+    summary = {
+        'search_term': search_term, 'date_from': date_from,
+        'date_to': date_to, 'windows': len(windows),
+        'skipped': len(windows) - len(pending), 'completed': 0,
+        'records': 0, 'failed': 0,
+        'resume_from': pending[0][0] if pending else None, 'error': None
+    }
+    if not pending:
+        return summary
+    broker = kinesis if isinstance(kinesis, Broker) else \
+        KinesisBroker(kinesis)
+    partitioner = partitioner or TermPartitioner()
+    if broker.ensure_stream(stream_id):
+        logger.info(f'New stream created: {stream_id}.')
+
+    queued = iter(pending)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        try:
+            while True:
+                while len(in_flight) < max_workers and not (
+                        deadline is not None and deadline.expired()):
+                    window = next(queued, None)
+                    if window is None:
+                        break
+                    in_flight.append((window, executor.submit(
+                        fetch_window, api_key, search_term, window)))
+                if not in_flight:
+                    break
+                window, future = in_flight.popleft()
+                try:
+                    records = future.result()
+                except Exception as err:
+                    summary['error'] = str(err)
+                    logger.error(f'Backfill of {search_term} stopped at ' +
+                                 f'window {window[0]}: {err}')
+                    break
+                entries = []
+                for record in records:
+                    keys = partitioner.keys(record, search_term)
+                    entries.append(make_entry(
+                        record, keys['PartitionKey'],
+                        keys.get('ExplicitHashKey'), serializer))
+                results = broker.put(stream_id, entries)
+                failed = sum('ErrorCode' in result for result in results)
+                summary['records'] += len(records) - failed
+                summary['failed'] += failed
+                if failed:
+                    break
+                if checkpoints is not None:
+                    checkpoints.set_watermark(
+                        checkpoint_term, stream_id, window[1])
+                summary['completed'] += 1
+        finally:
+            for _, future in in_flight:
+                future.cancel()
+            broker.flush()
+
+    if summary['completed'] < len(pending):
+        summary['resume_from'] = pending[summary['completed']][0]
+    else:
+        summary['resume_from'] = None
+    logger.info(f"{summary['records']} records added to stream: " +
+                f"{stream_id} ({summary['completed']} of " +
+                f"{len(pending)} windows).")
+    return summary
@@ -0,0 +1,433 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections import deque
+from botocore.exceptions import ClientError
+from src.message_broker import (
+    create_stream, forget_stream, put_entries, STREAM_READY_TIMEOUT,
+    SHARD_COUNT
+)
+from src.partitioning import ShardRouter, even_shard_ranges
+from src.serialization import decode_records
+
+LOCAL_SHARD_ID = 'shardId-000000000000'
+DEFAULT_RING_CAPACITY = 100000
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_SEGMENT_PATH = '/tmp/streams'
+FRAME_HEADER = struct.Struct('>IH')
+SEGMENT_INDEX_PATTERN = '[0-9]' * 6
+
+_broker = None
+
+
+class Broker:
+    '''
+    Destination to which the handler publishes records.
+
+    Records are passed as PutRecords entries (see
+    src.message_broker.make_entry), and put returns one result per entry
+    in the form used by PutRecords: a dict containing 'ShardId' and
+    'SequenceNumber' if the entry was written, or 'ErrorCode' and
+    'ErrorMessage' if it was not.
+    '''
+
+    def ensure_stream(
+            self, stream_id: str,
+            timeout: float = STREAM_READY_TIMEOUT) -> bool:
+        '''
+        Makes sure a stream can accept records.
+
+        Returns:
+            bool, True if the stream was created.
+        '''
+        return False
+
+    def put(self, stream_id: str, entries: list[dict],
+            max_retries: int = 3) -> list[dict]:
+        '''
+        Writes entries to a stream.
+
+        Returns:
+            list of results, in the same order as entries.
+        '''
+        raise NotImplementedError
+
+    def flush(self):
+        '''
+        Writes out any buffered records.
+        '''
+
+    def close(self):
+        '''
+        Flushes the broker and releases its resources.
+        '''
+        self.flush()
+
+
+class KinesisBroker(Broker):
+    '''
+    Publishes records to Kinesis Data Streams.
+
+    If a put fails because the stream no longer exists (e.g. it was
+    deleted after it was created by an earlier invocation), the stream is
+    created again, waiting as long as the last ensure_stream allowed, and
+    the put is retried once.
+
+    Args:
+        kinesis: boto3 Kinesis client.
+        put: function writing entries to a stream, with the signature of
+        src.message_broker.put_entries, e.g. put_aggregated_entries.
+    '''
+
+    def __init__(self, kinesis, put=put_entries):
+        self.kinesis = kinesis
+        self._put = put
+        self._timeout = STREAM_READY_TIMEOUT
+
+    def ensure_stream(
+            self, stream_id: str,
+            timeout: float = STREAM_READY_TIMEOUT) -> bool:
+        self._timeout = timeout
+        return create_stream(self.kinesis, stream_id, timeout) is not None
+
+    def put(self, stream_id: str, entries: list[dict],
+            max_retries: int = 3) -> list[dict]:
+        try:
+            return self._put(self.kinesis, stream_id, entries, max_retries)
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+        forget_stream(stream_id)
+        create_stream(self.kinesis, stream_id, self._timeout)
+        return self._put(self.kinesis, stream_id, entries, max_retries)
+
+
+class LineBroker(Broker):
+    '''
+    Writes records to a text file as JSON lines.
+
+    Each line is an object containing the 'stream_id', the
+    'partition_key' and the decoded 'record', whatever serializer the
+    entries were written with (see src.serialization.decode_records).
+
+    Args:
+        file: text file object to write to.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def put(self, stream_id: str, entries: list[dict],
+            max_retries: int = 3) -> list[dict]:
+        results = []
+        with self._lock:
+            for entry in entries:
+                for record in decode_records(entry['Data']):
+                    self.file.write(json.dumps({
+                        'stream_id': stream_id,
+                        'partition_key': entry['PartitionKey'],
+                        'record': record
+                    }) + '\n')
+                self._sequence += 1
+                results.append({'ShardId': LOCAL_SHARD_ID,
+                                'SequenceNumber': str(self._sequence)})
+        return results
+
+    def flush(self):
+        with self._lock:
+            self.file.flush()
+
+
+class JsonlFileBroker(LineBroker):
+    '''
+    Appends records to a JSON lines file (see LineBroker).
+
+    Args:
+        path: string specifying the file, which is created if required.
+    '''
+
+    def __init__(self, path: str):
+        super().__init__(open(path, 'a', encoding='utf-8'))
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class StdoutBroker(LineBroker):
+    '''
+    Writes records to standard output as JSON lines (see LineBroker).
+    '''
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+
+class MemoryBroker(Broker):
+    '''
+    Keeps the records of each stream in an in-memory ring buffer.
+
+    Once a stream holds capacity records, each new record replaces the
+    oldest, which is counted in dropped. Records are assigned to shards as
+    by a Kinesis stream of shard_count shards, so partitioning can be
+    tested and benchmarked without AWS.
+
+    Args:
+        capacity: int specifying the number of records kept per stream.
+        shard_count: int specifying the number of shards simulated.
+    '''
+
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY,
+                 shard_count: int = SHARD_COUNT):
+        self.capacity = capacity
+        self.dropped = 0
+        self._router = ShardRouter(even_shard_ranges(shard_count))
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._sequence = 0
+
+    def ensure_stream(
+            self, stream_id: str,
+            timeout: float = STREAM_READY_TIMEOUT) -> bool:
+        with self._lock:
+            if stream_id in self._streams:
+                return False
+            self._streams[stream_id] = deque(maxlen=self.capacity)
+            return True
+
+    def put(self, stream_id: str, entries: list[dict],
+            max_retries: int = 3) -> list[dict]:
+        results = []
+        with self._lock:
+            ring = self._streams.setdefault(
+                stream_id, deque(maxlen=self.capacity))
+            for entry in entries:
+                if len(ring) == self.capacity:
+                    self.dropped += 1
+                self._sequence += 1
+                result = {'ShardId': self._router.shard_id(entry),
+                          'SequenceNumber': str(self._sequence)}
+                ring.append(dict(result, PartitionKey=entry['PartitionKey'],
+                                 Data=entry['Data']))
+                results.append(result)
+        return results
+
+    def records(self, stream_id: str) -> list[dict]:
+        '''
+        Returns:
+            list of the records held for a stream, oldest first, each a
+            dict containing 'ShardId', 'SequenceNumber', 'PartitionKey'
+            and 'Data'.
+        '''
+        with self._lock:
+            return list(self._streams.get(stream_id, ()))
+
+
+class _Segment:
+    '''
+    A segment file of a stream, mapped into memory for appending.
+    '''
+
+    def __init__(self, path: str, index: int, size: int):
+        self.index = index
+        self.file = open(path, 'a+b')
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.offset = _end_of_frames(self.map)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+def _end_of_frames(data) -> int:
+    '''
+    Returns the offset after the last frame written to a segment, which is
+    followed by zeros or the end of the segment.
+    '''
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        length, key_length = FRAME_HEADER.unpack_from(data, offset)
+        if length == 0:
+            break
+        offset += FRAME_HEADER.size + key_length + length
+    return offset
+
+
+def _segment_paths(directory: str, stream_id: str) -> list[str]:
+    pattern = f'{glob.escape(stream_id)}.{SEGMENT_INDEX_PATTERN}.seg'
+    return sorted(glob.glob(os.path.join(glob.escape(directory), pattern)))
+
+
+def read_segments(directory: str, stream_id: str):
+    '''
+    Reads back the records written to a stream by SegmentFileBroker.
+
+    Yields:
+        dict containing the 'PartitionKey' and 'Data' of each record,
+        oldest first.
+    '''
+    for path in _segment_paths(directory, stream_id):
+        with open(path, 'rb') as file:
+            data = file.read()
+        offset = 0
+        end = _end_of_frames(data)
+        while offset < end:
+            length, key_length = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            key = data[offset:offset + key_length].decode('utf-8')
+            offset += key_length
+            yield {'PartitionKey': key, 'Data': data[offset:offset + length]}
+            offset += length
+
+
+class SegmentFileBroker(Broker):
+    '''
+    Appends the records of each stream to memory-mapped segment files.
+
+    Each stream is written to files named <stream_id>.<index>.seg in
+    directory. A segment is preallocated to segment_size bytes and records
+    are copied into it as frames (a big-endian 4-byte data length and
+    2-byte partition key length, the key, then the data), so appending a
+    record is a memory copy rather than a write call. When a record does
+    not fit, the next segment is started. The zeros after the last frame
+    mark the end of a segment, so a broker reopening a stream carries on
+    appending where it stopped.
+    Records are read back with read_segments.
+
+    Args:
+        directory: string specifying the directory holding the segments,
+        which is created if required.
+        segment_size: int specifying the size of each segment in bytes.
+        shard_count: int specifying the number of shards simulated.
+    '''
+
+    def __init__(self, directory: str = DEFAULT_SEGMENT_PATH,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 shard_count: int = SHARD_COUNT):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self._router = ShardRouter(even_shard_ranges(shard_count))
+        self._lock = threading.Lock()
+        self._segments = {}
+
+    def _path(self, stream_id: str, index: int) -> str:
+        return os.path.join(self.directory, f'{stream_id}.{index:06d}.seg')
+
+    def _open(self, stream_id: str) -> _Segment:
+        segment = self._segments.get(stream_id)
+        if segment is None:
+            paths = _segment_paths(self.directory, stream_id)
+            index = int(paths[-1].rsplit('.', 2)[-2]) if paths else 0
+            segment = _Segment(self._path(stream_id, index), index,
+                               self.segment_size)
+            self._segments[stream_id] = segment
+        return segment
+
+    def ensure_stream(
+            self, stream_id: str,
+            timeout: float = STREAM_READY_TIMEOUT) -> bool:
+        with self._lock:
+            created = (stream_id not in self._segments and not
+                       _segment_paths(self.directory, stream_id))
+            self._open(stream_id)
+            return created
+
+    def put(self, stream_id: str, entries: list[dict],
+            max_retries: int = 3) -> list[dict]:
+        results = []
+        with self._lock:
+            segment = self._open(stream_id)
+            for entry in entries:
+                key = entry['PartitionKey'].encode('utf-8')
+                size = FRAME_HEADER.size + len(key) + len(entry['Data'])
+                if size > self.segment_size:
+                    results.append({
+                        'ErrorCode': 'InvalidArgumentException',
+                        'ErrorMessage': f'Record of {size} bytes does ' +
+                                        'not fit in a segment.'})
+                    continue
+                if segment.offset + size > self.segment_size:
+                    segment.close()
+                    segment = _Segment(
+                        self._path(stream_id, segment.index + 1),
+                        segment.index + 1, self.segment_size)
+                    self._segments[stream_id] = segment
+                offset = segment.offset
+                FRAME_HEADER.pack_into(segment.map, offset,
+                                       len(entry['Data']), len(key))
+                start = offset + FRAME_HEADER.size
+                segment.map[start:start + len(key)] = key
+                segment.map[start + len(key):offset + size] = entry['Data']
+                segment.offset = offset + size
+                results.append({
+                    'ShardId': self._router.shard_id(entry),
+                    'SequenceNumber': f'{segment.index:06d}{offset:012d}'})
+        return results
+
+    def flush(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.map.flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+
+def get_broker() -> Broker:
+    '''
+    Returns the broker selected by the environment.
+
+    The BROKER variable chooses 'kinesis' (the default), 'memory' (a
+    MemoryBroker holding BROKER_CAPACITY records per stream) or 'segment'
+    (a SegmentFileBroker writing to the directory BROKER_PATH, default
+    /tmp/streams). Local brokers are kept for the lifetime of the
+    process, so they are shared by warm invocations.
+
+    Returns:
+        Broker, or None for kinesis, which is published to through the
+        client from connections_aws.
+
+    Raises:
+        ValueError: If BROKER names an unknown broker.
+    '''
+    global _broker
+    name = os.environ.get('BROKER') or 'kinesis'
+    brokers = {'memory': MemoryBroker, 'segment': SegmentFileBroker}
+    if name == 'kinesis':
+        return None
+    if name not in brokers:
+        raise ValueError('Parameter (BROKER) must be one of ' +
+                         f"'kinesis', 'memory' or 'segment', not '{name}'.")
+    if isinstance(_broker, brokers[name]):
+        return _broker
+    reset_broker()
+    if name == 'memory':
+        _broker = MemoryBroker(int(os.environ.get(
+            'BROKER_CAPACITY', DEFAULT_RING_CAPACITY)))
+    else:
+        _broker = SegmentFileBroker(
+            os.environ.get('BROKER_PATH', DEFAULT_SEGMENT_PATH))
+    return _broker
+
+
+def reset_broker():
+    '''
+    Closes and discards the broker kept for the lifetime of the process.
+    '''
+    global _broker
+    if _broker is not None:
+        _broker.close()
+    _broker = None
@@ -0,0 +1,147 @@
+import os
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from src.connections_aws import connections_aws
+
+
+class CheckpointStore:
+    '''
+    Base class for stores holding the high-water mark of each search term.
+
+    The high-water mark is the most recent webPublicationDate which has been
+    written to a stream for a (search_term, stream_id) pair. Marks are ISO
+    8601 strings, which order correctly when compared as strings.
+    '''
+
+    def get_watermark(self, search_term: str, stream_id: str) -> str:
+        '''
+        Returns:
+            str containing the high-water mark, or None if there is none.
+        '''
+        raise NotImplementedError
+
+    def set_watermark(
+            self, search_term: str, stream_id: str, watermark: str):
+        '''
+        Advances the high-water mark. A mark older than the stored value is
+        ignored, so the mark never moves backwards.
+        '''
+        raise NotImplementedError
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    '''
+    Checkpoint store backed by a local SQLite database file.
+    '''
+
+    def __init__(self, path: str = '/tmp/guardian_checkpoints.db'):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                'search_term TEXT NOT NULL, '
+                'stream_id TEXT NOT NULL, '
+                'watermark TEXT NOT NULL, '
+                'PRIMARY KEY (search_term, stream_id))'
+            )
+
+    @contextmanager
+    def _connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_watermark(self, search_term: str, stream_id: str) -> str:
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT watermark FROM watermarks '
+                'WHERE search_term = ? AND stream_id = ?',
+                (search_term, stream_id)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(
+            self, search_term: str, stream_id: str, watermark: str):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO watermarks (search_term, stream_id, watermark) '
+                'VALUES (?, ?, ?) '
+                'ON CONFLICT (search_term, stream_id) DO UPDATE '
+                'SET watermark = excluded.watermark '
+                'WHERE excluded.watermark > watermarks.watermark',
+                (search_term, stream_id, watermark)
+            )
+
+
+class DynamoDBCheckpointStore(CheckpointStore):
+    '''
+    Checkpoint store backed by a DynamoDB table.
+
+    The table must have a string partition key named 'checkpoint_id'.
+    '''
+
+    def __init__(self, table_name: str, dynamodb=None):
+        self.table_name = table_name
+        self.dynamodb = dynamodb or connections_aws.get_database()
+
+    @staticmethod
+    def _key(search_term: str, stream_id: str) -> dict:
+        return {'checkpoint_id': {'S': f'{stream_id}#{search_term}'}}
+
+    def get_watermark(self, search_term: str, stream_id: str) -> str:
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key=self._key(search_term, stream_id),
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        return None if item is None else item['watermark']['S']
+
+    def set_watermark(
+            self, search_term: str, stream_id: str, watermark: str):
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(search_term, stream_id),
+                UpdateExpression='SET watermark = :watermark',
+                ConditionExpression=(
+                    'attribute_not_exists(watermark) '
+                    'OR watermark < :watermark'
+                ),
+                ExpressionAttributeValues={':watermark': {'S': watermark}}
+            )
+        except ClientError as err:
+            code = err.response['Error']['Code']
+            if code != 'ConditionalCheckFailedException':
+                raise
+
+
+def get_checkpoint_store() -> CheckpointStore:
+    '''
+    Returns the checkpoint store selected by the environment.
+
+    The store is chosen by the CHECKPOINT_STORE variable:
+        - 'sqlite': SQLiteCheckpointStore at CHECKPOINT_PATH (optional).
+        - 'dynamodb': DynamoDBCheckpointStore for the table CHECKPOINT_TABLE.
+
+    Returns:
+        CheckpointStore, or None if CHECKPOINT_STORE is not set.
+
+    Raises:
+        ValueError: If CHECKPOINT_STORE names an unknown store.
+    '''
+    store = os.environ.get('CHECKPOINT_STORE')
+    if not store:
+        return None
+    if store == 'sqlite':
+        path = os.environ.get('CHECKPOINT_PATH')
+        return SQLiteCheckpointStore(path) if path \
+            else SQLiteCheckpointStore()
+    if store == 'dynamodb':
+        return DynamoDBCheckpointStore(os.environ['CHECKPOINT_TABLE'])
+    raise ValueError('Parameter (CHECKPOINT_STORE) must be one of ' +
+                     f"'sqlite' or 'dynamodb', not '{store}'.")
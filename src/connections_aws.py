@@ -1,33 +1,206 @@
-import boto3
+import math
+import threading
+import time
+from botocore.exceptions import ClientError
 
 
 class connections_aws:
 
     _current_region = 'eu-west-2'
+    _secret_ttl = 300
+    _secret_timeout = 5
+    _client_timeouts = {'secretsmanager': _secret_timeout}
+    _auth_error_codes = (
+        'AccessDeniedException',
+        'ExpiredTokenException',
+        'UnrecognizedClientException',
+    )
+
+    _lock = threading.Lock()
+    _clients = {}
+    _secrets = {}
+    _stats = {
+        'client_hits': 0, 'client_misses': 0,
+        'secret_hits': 0, 'secret_misses': 0,
+    }
+
+    @classmethod
+    def _get_client(cls, service_name: str, timeout: int = None):
+        '''
+        Returns a boto3 client from the registry, creating it if required.
+
+        Clients are kept for the lifetime of the process so they are reused
+        across warm Lambda invocations. boto3 is imported on first use, so
+        runs which never call AWS (e.g. locally, with a local broker) do
+        not pay for it.
+
+        Args:
+            service_name:
+                str containing the AWS service name e.g. kinesis.
+            timeout:
+                int specifying the seconds a call may take, or None for the
+                service's default in _client_timeouts. A client with a
+                timeout makes a single attempt per call, with half of the
+                timeout to connect and half to read the response. Each
+                timeout has its own client.
+
+        Returns:
+            boto3 client object for the service in the current region.
+        '''
+        if timeout is None:
+            timeout = cls._client_timeouts.get(service_name)
+        key = (service_name, cls._current_region, timeout)
+        with cls._lock:
+            client = cls._clients.get(key)
+            if client is not None:
+                cls._stats['client_hits'] += 1
+                return client
+            cls._stats['client_misses'] += 1
+            import boto3
+            config = None
+            if timeout is not None:
+                from botocore.config import Config
+                config = Config(
+                    connect_timeout=timeout / 2, read_timeout=timeout / 2,
+                    retries={'total_max_attempts': 1})
+            client = boto3.client(
+                service_name, region_name=key[1], config=config)
+            cls._clients[key] = client
+            return client
+
+    @classmethod
+    def create_clients(cls, *service_names: str):
+        '''
+        Creates clients ahead of their first use, e.g. during the Lambda
+        init phase, so the first invocation does not wait for them.
+
+        Args:
+            service_names:
+                str containing an AWS service name, for each client.
+        '''
+        for service_name in service_names:
+            cls._get_client(service_name)
 
     @classmethod
     def get_credentials(
-            cls, secret_id: str) -> str:
+            cls, secret_id: str, timeout: float = None) -> str:
         '''
         Args:
             secret_id:
                 str containing the secret id.
+            timeout:
+                float specifying the seconds Secrets Manager may take to
+                return the secret, rounded up to whole seconds and capped
+                at _secret_timeout (the default), so the client created
+                ahead of the first invocation is normally reused.
 
         Returns:
-            str containing the secret value.
+            str containing the secret value. Values are cached for
+            _secret_ttl seconds.
 
         Raises:
             ClientError: If the secret_id is not found.
             ParamValidationError: If the secret_id is not a string.
         '''
-        conn = boto3.client('secretsmanager', region_name=cls._current_region)
-        response = conn.get_secret_value(SecretId=secret_id)
+        with cls._lock:
+            cached = cls._secrets.get(secret_id)
+            if cached is not None and cached[1] > time.monotonic():
+                cls._stats['secret_hits'] += 1
+                return cached[0]
+            cls._stats['secret_misses'] += 1
+
+        if timeout is not None:
+            timeout = max(1, min(math.ceil(timeout), cls._secret_timeout))
+        conn = cls._get_client('secretsmanager', timeout)
+        try:
+            response = conn.get_secret_value(SecretId=secret_id)
+        except ClientError as err:
+            if err.response['Error']['Code'] in cls._auth_error_codes:
+                cls.invalidate_credentials(secret_id)
+                cls.clear_clients()
+            raise
+        with cls._lock:
+            cls._secrets[secret_id] = (
+                response['SecretString'], time.monotonic() + cls._secret_ttl
+            )
         return response['SecretString']
 
+    @classmethod
+    def set_credentials(cls, secret_id: str, value: str):
+        '''
+        Stores a secret value in the cache, so it is returned by
+        get_credentials without calling Secrets Manager, e.g. when running
+        locally. The value does not expire.
+
+        Args:
+            secret_id:
+                str containing the secret id.
+            value:
+                str containing the secret value.
+        '''
+        with cls._lock:
+            cls._secrets[secret_id] = (value, math.inf)
+
     @classmethod
     def get_message_broker(cls):
         '''
         Returns:
             Kinesis client object.
         '''
-        return boto3.client('kinesis', region_name=cls._current_region)
+        return cls._get_client('kinesis')
+
+    @classmethod
+    def get_database(cls):
+        '''
+        Returns:
+            DynamoDB client object.
+        '''
+        return cls._get_client('dynamodb')
+
+    @classmethod
+    def invalidate_credentials(cls, secret_id: str = None):
+        '''
+        Removes a secret from the cache so the next call fetches it again.
+
+        Should be called when a request made with the secret fails with an
+        authentication error.
+
+        Args:
+            secret_id:
+                str containing the secret id. If None, every cached secret
+                is removed.
+        '''
+        with cls._lock:
+            if secret_id is None:
+                cls._secrets.clear()
+            else:
+                cls._secrets.pop(secret_id, None)
+
+    @classmethod
+    def clear_clients(cls):
+        '''
+        Removes every client from the registry.
+        '''
+        with cls._lock:
+            cls._clients.clear()
+
+    @classmethod
+    def clear_cache(cls):
+        '''
+        Removes every cached client and secret and resets the counters.
+        '''
+        cls.clear_clients()
+        cls.invalidate_credentials()
+        with cls._lock:
+            for key in cls._stats:
+                cls._stats[key] = 0
+
+    @classmethod
+    def get_cache_stats(cls) -> dict:
+        '''
+        Returns:
+            dict containing the hit and miss counts for the client registry
+            and the secret cache.
+        '''
+        with cls._lock:
+            return dict(cls._stats)
@@ -0,0 +1,85 @@
+import math
+import time
+
+DEFAULT_RESERVE = 5.0
+STAGE_SHARES = {
+    'secret': 0.2,
+    'fetch': 0.8,
+    'stream': 1.0,
+}
+
+
+class Deadline:
+    '''
+    Tracks the time left in an invocation and divides it between stages.
+
+    The last reserve seconds are kept back for publishing the records
+    already fetched and returning a result, so the work before them (the
+    secret fetch, API fetch and stream readiness stages) is given a share
+    of the time available when it starts (see STAGE_SHARES). A deadline
+    created without a time limit never expires.
+
+    Args:
+        remaining: float specifying the seconds left, or None for no limit.
+        reserve: float specifying the seconds kept back for publishing.
+    '''
+
+    def __init__(
+            self, remaining: float = None,
+            reserve: float = DEFAULT_RESERVE, clock=time.monotonic):
+        self.reserve = reserve
+        self._clock = clock
+        self._end = None if remaining is None else clock() + remaining
+
+    @classmethod
+    def from_context(cls, context, reserve: float = DEFAULT_RESERVE):
+        '''
+        Returns a deadline from an AWS Lambda context object, or one with
+        no time limit if the context does not report the remaining time.
+        '''
+        if not hasattr(context, 'get_remaining_time_in_millis'):
+            return cls(None, reserve)
+        return cls(context.get_remaining_time_in_millis() / 1000, reserve)
+
+    def remaining(self) -> float:
+        '''
+        Returns:
+            float, the seconds left before the invocation times out.
+        '''
+        if self._end is None:
+            return math.inf
+        return max(self._end - self._clock(), 0.0)
+
+    def available(self) -> float:
+        '''
+        Returns:
+            float, the seconds left before the reserve is reached.
+        '''
+        return max(self.remaining() - self.reserve, 0.0)
+
+    def expired(self) -> bool:
+        '''
+        Returns:
+            bool, True once only the reserve is left, after which no new
+            work should be started.
+        '''
+        return self.available() <= 0
+
+    def budget(self, stage: str, default: float = None) -> float:
+        '''
+        Returns the seconds allowed for a stage starting now.
+
+        Args:
+            stage: string naming a stage in STAGE_SHARES.
+            default: value returned if the deadline has no time limit.
+        '''
+        if self._end is None:
+            return default
+        return self.available() * STAGE_SHARES[stage]
+
+    def stage(self, stage: str):
+        '''
+        Returns a deadline for a stage starting now, which expires once the
+        stage's share of the available time is used.
+        '''
+        return Deadline(self.budget(stage), 0.0, self._clock)
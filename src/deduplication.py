@@ -0,0 +1,306 @@
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+DIGEST_SIZE = 16
+DEFAULT_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.001
+
+logger = logging.getLogger('GuardianLogger')
+
+_deduplicator = None
+
+
+class Deduplicator:
+    '''
+    Base class for bounded indexes of keys which have already been seen.
+
+    Keys (e.g. article URLs) are stored as fixed size hashes, so the memory
+    used depends only on the capacity and not on the length of the keys.
+    The number of records suppressed by filter_records is counted in the
+    suppressed attribute. Keys may be added and records filtered from
+    several threads, e.g. by the messages of a batch.
+    '''
+
+    _mode = b''
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(key: str, namespace: str = '') -> bytes:
+        return hashlib.blake2b(
+            f'{namespace}\n{key}'.encode('utf-8'),
+            digest_size=DIGEST_SIZE
+        ).digest()
+
+    def contains(self, key: str, namespace: str = '') -> bool:
+        digest = self._digest(key, namespace)
+        with self._lock:
+            return self._contains(digest)
+
+    def add(self, key: str, namespace: str = ''):
+        digest = self._digest(key, namespace)
+        with self._lock:
+            self._add(digest)
+
+    def _contains(self, digest: bytes) -> bool:
+        raise NotImplementedError
+
+    def _add(self, digest: bytes):
+        raise NotImplementedError
+
+    def filter_records(
+            self, records: list[dict], namespace: str = '',
+            field: str = 'webUrl', pending: set = None) -> list[dict]:
+        '''
+        Removes records which have already been seen.
+
+        Records are compared on the value of field, within the namespace
+        (e.g. the stream id). Repeated records within the list, or already
+        in pending, are also removed. The records kept are not added to the
+        index; call add once they have been published, so a failed write is
+        not suppressed when it is retried.
+
+        Args:
+            records: list of dictionaries to be filtered.
+            namespace: string prefixed to each key before hashing.
+            field: string specifying the key holding the value to compare.
+            pending: set of digests of records awaiting publication, shared
+            between calls. Digests of the records kept are added to it.
+
+        Returns:
+            list of records which have not been seen before.
+        '''
+        kept = []
+        pending = set() if pending is None else pending
+        digests = [self._digest(record.get(field), namespace)
+                   for record in records]
+        with self._lock:
+            for record, digest in zip(records, digests):
+                if digest in pending or self._contains(digest):
+                    self.suppressed += 1
+                    continue
+                pending.add(digest)
+                kept.append(record)
+        return kept
+
+    def to_bytes(self) -> bytes:
+        raise NotImplementedError
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        raise NotImplementedError
+
+    def save(self, path: str):
+        '''
+        Writes the index to a file, replacing it atomically.
+        '''
+        with self._lock:
+            data = self._mode + self.to_bytes()
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path: str):
+        '''
+        Reads an index written by save.
+
+        Returns:
+            LRUDeduplicator or BloomDeduplicator, depending on the file.
+        '''
+        with open(path, 'rb') as file:
+            data = file.read()
+        for cls in (LRUDeduplicator, BloomDeduplicator):
+            if data[:1] == cls._mode:
+                return cls.from_bytes(data[1:])
+        raise ValueError('Parameter (path) must be a deduplication ' +
+                         f'index, {path} is not.')
+
+
+class LRUDeduplicator(Deduplicator):
+    '''
+    Exact index holding the most recently seen capacity keys.
+
+    Uses DIGEST_SIZE bytes per key (plus dictionary overhead). When full,
+    the least recently seen key is evicted.
+    '''
+
+    _mode = b'L'
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        super().__init__(capacity)
+        self._digests = OrderedDict()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def _contains(self, digest: bytes) -> bool:
+        if digest not in self._digests:
+            return False
+        self._digests.move_to_end(digest)
+        return True
+
+    def _add(self, digest: bytes):
+        self._digests[digest] = None
+        self._digests.move_to_end(digest)
+        while len(self._digests) > self.capacity:
+            self._digests.popitem(last=False)
+
+    def to_bytes(self) -> bytes:
+        return struct.pack('>Q', self.capacity) + b''.join(self._digests)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        deduplicator = cls(struct.unpack('>Q', data[:8])[0])
+        for start in range(8, len(data), DIGEST_SIZE):
+            deduplicator._add(data[start:start + DIGEST_SIZE])
+        return deduplicator
+
+
+class BloomDeduplicator(Deduplicator):
+    '''
+    Memory-compact probabilistic index of recently seen keys.
+
+    Keys are held in a Bloom filter sized for capacity keys at the given
+    false positive rate (around 1.8 bytes per key at 0.1%). A false
+    positive suppresses a record which has not been seen; keys are never
+    missed. To stay bounded the filter is rotated when it holds capacity
+    keys: the current filter becomes the previous one and a new filter is
+    started, so between capacity and twice capacity keys are remembered.
+    '''
+
+    _mode = b'B'
+
+    def __init__(
+            self, capacity: int = DEFAULT_CAPACITY,
+            error_rate: float = DEFAULT_ERROR_RATE):
+        super().__init__(capacity)
+        self.error_rate = error_rate
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self._size = max(8, math.ceil(bits / 8) * 8)
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._count = 0
+        self._current = bytearray(self._size // 8)
+        self._previous = bytearray(self._size // 8)
+
+    def _positions(self, digest: bytes):
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        for index in range(self._hashes):
+            yield (first + index * second) % self._size
+
+    @staticmethod
+    def _test(bits: bytearray, positions: list[int]) -> bool:
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in positions)
+
+    def _contains(self, digest: bytes) -> bool:
+        positions = list(self._positions(digest))
+        return (self._test(self._current, positions)
+                or self._test(self._previous, positions))
+
+    def _add(self, digest: bytes):
+        if self._count >= self.capacity:
+            self._previous = self._current
+            self._current = bytearray(self._size // 8)
+            self._count = 0
+        for position in self._positions(digest):
+            self._current[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def to_bytes(self) -> bytes:
+        header = struct.pack(
+            '>QdQ', self.capacity, self.error_rate, self._count)
+        return header + bytes(self._current) + bytes(self._previous)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        capacity, error_rate, count = struct.unpack('>QdQ', data[:24])
+        deduplicator = cls(capacity, error_rate)
+        length = deduplicator._size // 8
+        deduplicator._count = count
+        deduplicator._current = bytearray(data[24:24 + length])
+        deduplicator._previous = bytearray(data[24 + length:])
+        return deduplicator
+
+
+def _convert(loaded: Deduplicator, cls, capacity: int) -> Deduplicator:
+    '''
+    Returns a saved index as an index of class cls. The keys of an LRU
+    index are added to a Bloom filter; a Bloom filter cannot be converted
+    to an exact index, so it is discarded and an empty index returned.
+    '''
+    if isinstance(loaded, cls):
+        return loaded
+    converted = cls(capacity)
+    if isinstance(loaded, LRUDeduplicator):
+        for digest in loaded._digests:
+            converted._add(digest)
+    else:
+        logger.warning('Saved deduplication index discarded, as it ' +
+                       'cannot be converted to DEDUP_MODE.')
+    return converted
+
+
+def get_deduplicator() -> Deduplicator:
+    '''
+    Returns the deduplication index selected by the environment.
+
+    The index is kept for the lifetime of the process, so it is shared by
+    warm invocations. It is chosen by the DEDUP_MODE variable ('lru' or
+    'bloom'), with DEDUP_CAPACITY keys (default 100000). If DEDUP_PATH is
+    set, an index saved there by a previous invocation is loaded. DEDUP_MODE
+    wins over the mode of a saved index, which is converted if possible
+    (see _convert).
+
+    Returns:
+        Deduplicator, or None if DEDUP_MODE is not set.
+
+    Raises:
+        ValueError: If DEDUP_MODE names an unknown mode.
+    '''
+    global _deduplicator
+    mode = os.environ.get('DEDUP_MODE')
+    if not mode:
+        return None
+    modes = {'lru': LRUDeduplicator, 'bloom': BloomDeduplicator}
+    if mode not in modes:
+        raise ValueError('Parameter (DEDUP_MODE) must be one of ' +
+                         f"'lru' or 'bloom', not '{mode}'.")
+    if isinstance(_deduplicator, modes[mode]):
+        return _deduplicator
+
+    path = os.environ.get('DEDUP_PATH')
+    capacity = int(os.environ.get('DEDUP_CAPACITY', DEFAULT_CAPACITY))
+    if path and os.path.exists(path):
+        _deduplicator = _convert(
+            Deduplicator.load(path), modes[mode], capacity)
+    else:
+        _deduplicator = modes[mode](capacity)
+    return _deduplicator
+
+
+def reset_deduplicator():
+    '''
+    Discards the index kept for the lifetime of the process.
+    '''
+    global _deduplicator
+    _deduplicator = None
+
+
+def save_deduplicator():
+    '''
+    Saves the current index to DEDUP_PATH, if both are set.
+    '''
+    path = os.environ.get('DEDUP_PATH')
+    if _deduplicator is not None and path:
+        _deduplicator.save(path)
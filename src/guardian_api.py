@@ -1,14 +1,317 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from src.metrics import get_metrics
+from src.projection import FieldProjector, get_projector
+from src.response_cache import get_response_cache
+
+BASE_URL = 'https://content.guardianapis.com/search'
+MAX_PAGE_SIZE = 200
+REQUEST_TIMEOUT = 10.0
+POOL_SIZE = 10
+DEFAULT_RATE_LIMIT = 12.0
+DEFAULT_DAILY_QUOTA = 5000
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_FIELDS = ('webPublicationDate', 'webTitle', 'webUrl')
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limiter = None
+
+
+class QuotaExceededError(RuntimeError):
+    '''Raised when the daily Guardian API request quota is used up.'''
+
+
+class RateLimiter:
+    '''Token-bucket scheduler for requests to the Guardian API.
+
+    Requests are released at no more than rate per second, with bursts of
+    up to burst requests, and no more than daily_quota requests are made
+    per UTC day. Requests answered with 429 or a 5xx status are retried
+    with jittered exponential backoff, honouring any Retry-After header.
+    The quota is counted per process, so it should be set to the share of
+    the key's quota available to each Lambda container.
+
+    Args:
+        rate:
+            float specifying the number of requests released per second.
+        burst:
+            int specifying the size of the bucket. Defaults to rate.
+        daily_quota:
+            int specifying the maximum requests per day, or None.
+        max_retries:
+            int specifying the number of times a request is retried.
+        base_delay:
+            float specifying the backoff before the first retry, in seconds.
+        max_delay:
+            float specifying the maximum backoff, in seconds.
+    '''
+
+    def __init__(
+            self, rate: float = DEFAULT_RATE_LIMIT, burst: int = None,
+            daily_quota: int = DEFAULT_DAILY_QUOTA, max_retries: int = 3,
+            base_delay: float = 0.5, max_delay: float = 30.0):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self.daily_quota = daily_quota
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._day = None
+        self._used_today = 0
+        self._stats = {
+            'requests': 0, 'delayed': 0, 'delay_seconds': 0.0,
+            'throttled': 0, 'retries': 0,
+        }
+
+    def acquire(self, max_wait: float = None):
+        '''Blocks until a request may be sent.
+
+        Args:
+            max_wait:
+                float specifying the longest the request may wait, in
+                seconds, or None to wait as long as required.
+
+        Raises:
+            QuotaExceededError: If the daily quota has been used.
+            TimeoutError: If the request could not be sent within
+            max_wait. Neither the rate nor the quota is spent.
+        '''
+        with self._lock:
+            today = datetime.now(timezone.utc).date()
+            if today != self._day:
+                self._day = today
+                self._used_today = 0
+            if (self.daily_quota is not None
+                    and self._used_today >= self.daily_quota):
+                raise QuotaExceededError(
+                    'Guardian API daily quota of ' +
+                    f'{self.daily_quota} requests exhausted.')
+
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 \
+                else 0.0
+            if max_wait is not None and wait > max_wait:
+                raise TimeoutError(
+                    'Guardian API request could not be sent within ' +
+                    f'{max(max_wait, 0.0):.2f} seconds.')
+            self._tokens -= 1
+            self._used_today += 1
+            self._stats['requests'] += 1
+            if wait > 0:
+                self._stats['delayed'] += 1
+                self._stats['delay_seconds'] += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def retry_delay(self, attempt: int, retry_after: str = None) -> float:
+        '''Returns the number of seconds to wait before a retry.
+
+        Uses the Retry-After header if present (a negative or past value
+        is treated as no delay), otherwise a full-jitter exponential
+        backoff based on the attempt number.
+        '''
+        with self._lock:
+            self._stats['retries'] += 1
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), self.max_delay)
+            except ValueError:
+                try:
+                    delay = (parsedate_to_datetime(retry_after)
+                             - datetime.now(timezone.utc)).total_seconds()
+                    return min(max(delay, 0.0), self.max_delay)
+                except (TypeError, ValueError):
+                    pass
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, backoff)
+
+    def record_throttle(self):
+        with self._lock:
+            self._stats['throttled'] += 1
+
+    def get_stats(self) -> dict:
+        '''
+        Returns:
+            dict containing the number of requests made, requests delayed
+            by the rate limit (and the total delay in seconds), responses
+            throttled with 429, and retries.
+        '''
+        with self._lock:
+            return dict(self._stats)
+
+
+def get_rate_limiter() -> RateLimiter:
+    '''
+    Returns the rate limiter shared by every request.
+
+    The limiter is created on first use from the GUARDIAN_RATE_LIMIT
+    (requests per second) and GUARDIAN_DAILY_QUOTA environment variables,
+    and kept for the lifetime of the process.
+    '''
+    global _rate_limiter
+    with _session_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(
+                rate=float(os.environ.get(
+                    'GUARDIAN_RATE_LIMIT', DEFAULT_RATE_LIMIT)),
+                daily_quota=int(os.environ.get(
+                    'GUARDIAN_DAILY_QUOTA', DEFAULT_DAILY_QUOTA))
+            )
+        return _rate_limiter
+
+
+def set_rate_limiter(rate_limiter: RateLimiter):
+    '''
+    Replaces the rate limiter shared by every request. If None, a new
+    limiter is created from the environment on next use.
+    '''
+    global _rate_limiter
+    with _session_lock:
+        _rate_limiter = rate_limiter
+
+
+def _create_session(pool_size: int = POOL_SIZE) -> requests.Session:
+    '''
+    Creates a requests session keeping up to pool_size keep-alive
+    connections to the Guardian API.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    '''
+    Returns the session shared by every synchronous request.
+
+    The session is created on first use and kept for the lifetime of the
+    process, so TCP and TLS connections are reused across requests and
+    warm Lambda invocations.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _create_session()
+        return _session
+
+
+def _build_params(
+        api_key: str, search_term: str, date_from: str,
+        page: int, page_size: int, date_to: str = None,
+        order_by: str = 'newest') -> dict:
+    params = {
+        'api-key': api_key,
+        'q': search_term,
+        'from-date': date_from,
+        'page': page,
+        'page-size': page_size,
+        'order-by': order_by,
+        'show-fields': 'webPublicationData,webTitle,webUrl'
+    }
+    if date_to is not None:
+        params['to-date'] = date_to
+    return params
+
+
+def _request_content(
+        session: requests.Session, params: dict,
+        timeout: float = REQUEST_TIMEOUT, deadline: float = None) -> dict:
+    '''
+    Makes a request, rate limited and retried (see RateLimiter).
+
+    If a deadline (a time.monotonic() value) is given, no wait for the
+    rate limit, request or retry extends past it: TimeoutError is raised
+    rather than waiting for the rate limit, each request's timeout is cut
+    to the time left, and a retry which could not be made in time is not
+    attempted.
+    '''
+    rate_limiter = get_rate_limiter()
+    metrics = get_metrics()
+    cache = get_response_cache()
+    cached = None
+    headers = {}
+    if cache is not None:
+        key = cache.key(params)
+        cached, fresh = cache.lookup(key)
+        if fresh:
+            metrics.add('GuardianCacheHits')
+            metrics.add('GuardianBytesSaved', len(cached.content), 'Bytes')
+            return cached.json()
+        if cached is not None:
+            headers['If-None-Match'] = cached.etag
+    attempt = 0
+    while True:
+        request_timeout = timeout
+        if deadline is not None:
+            rate_limiter.acquire(deadline - time.monotonic())
+            request_timeout = min(timeout, deadline - time.monotonic())
+            if request_timeout <= 0:
+                raise TimeoutError(
+                    'Guardian API request was not sent before its deadline.')
+        else:
+            rate_limiter.acquire()
+        with metrics.timer('GuardianRequest'):
+            response = session.get(BASE_URL, params=params,
+                                   timeout=request_timeout, headers=headers)
+        metrics.add('GuardianRequests')
+        metrics.add('GuardianBytesReceived', len(response.content), 'Bytes')
+        if response.status_code == 304 and cached is not None:
+            cache.revalidate(key, cached)
+            metrics.add('GuardianCacheRevalidations')
+            metrics.add('GuardianBytesSaved', len(cached.content), 'Bytes')
+            return cached.json()
+        if response.status_code == 200:
+            if cache is not None:
+                cache.store(key, response.content,
+                            response.headers.get('ETag'))
+            return response.json()
+        if response.status_code == 429:
+            rate_limiter.record_throttle()
+        if (response.status_code in RETRY_STATUSES
+                and attempt < rate_limiter.max_retries):
+            delay = rate_limiter.retry_delay(
+                attempt, response.headers.get('Retry-After'))
+            if deadline is None or time.monotonic() + delay < deadline:
+                time.sleep(delay)
+                metrics.add('GuardianRetries')
+                attempt += 1
+                continue
+        response.raise_for_status()
+        raise requests.HTTPError(
+            f'Unexpected status code {response.status_code} for url: ' +
+            response.url, response=response)
 
 
 def get_guardian_content(
-        api_key: str, search_term: str, date_from: str
+        api_key: str, search_term: str, date_from: str,
+        page: int = 1, page_size: int = 10, date_to: str = None,
+        order_by: str = 'newest'
 ) -> list[dict]:
     '''Retrieve article data from the Guardian content API.
 
     Submits a request to the Guardian API to get content based on the
     search and returns a list of 10 dictionaries containing the only
-    required fields.
+    required fields. Requests share a persistent session (see get_session)
+    and are scheduled by the shared rate limiter (see get_rate_limiter).
+    If RESPONSE_CACHE_TTL is set, responses are cached and repeated
+    requests are served from the cache or made conditional on the cached
+    ETag (see src.response_cache.get_response_cache).
 
     Args:
         api_key:
@@ -17,6 +320,15 @@ def get_guardian_content(
             str containing the search term.
         date_from:
             str containing the date from which to search.
+        page:
+            int specifying the page of results to request.
+        page_size:
+            int specifying the number of results per page (maximum 200).
+        date_to:
+            str containing the last date to search (inclusive). If None,
+            content up to the present is searched.
+        order_by:
+            str, 'newest' or 'oldest', specifying the order of results.
 
     Returns:
         list of dictionaries containing the following fields:
@@ -38,33 +350,208 @@ def get_guardian_content(
             }
         ]
     '''
-    base_url = 'https://content.guardianapis.com/search'
-    params = {
-        'api-key': api_key,
-        'q': search_term,
-        'from-date': date_from,
-        'page': 1,
-        'page-size': 10,
-        'order-by': 'newest',
-        'show-fields': 'webPublicationData,webTitle,webUrl'
-    }
-    response = requests.get(base_url, params=params)
-    if response.status_code != 200:
-        response.raise_for_status()
-    return response.json()
+    params = _build_params(
+        api_key, search_term, date_from, page, page_size, date_to,
+        order_by)
+    return _request_content(get_session(), params)
+
+
+def get_all_guardian_content(
+        api_key: str, search_term: str, date_from: str,
+        max_pages: int = None, max_workers: int = 4, date_to: str = None,
+        order_by: str = 'newest'
+):
+    '''Retrieve every page of article data from the Guardian content API.
+
+    Requests the first page at the maximum page size and reads the number
+    of available pages from it. The remaining pages are then requested
+    concurrently, with no more than max_workers requests in flight at once.
+    Responses are yielded one page at a time, in page order, so the full
+    result set is never held in memory.
+
+    Args:
+        api_key:
+            str containing the API key.
+        search_term:
+            str containing the search term.
+        date_from:
+            str containing the date from which to search.
+        max_pages:
+            int limiting the number of pages retrieved. If None, all
+            available pages are retrieved.
+        max_workers:
+            int specifying the maximum number of concurrent requests.
+        date_to:
+            str containing the last date to search (inclusive), or None.
+        order_by:
+            str, 'newest' or 'oldest', specifying the order of results.
+
+    Yields:
+        dict containing the json response for each page, in the same format
+        as returned by get_guardian_content.
+    '''
+    first_page = get_guardian_content(
+        api_key, search_term, date_from, page=1, page_size=MAX_PAGE_SIZE,
+        date_to=date_to, order_by=order_by)
+    yield first_page
+    pages = first_page['response'].get('pages', 1)
+    if max_pages is not None:
+        pages = min(pages, max_pages)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        next_page = 2
+        try:
+            while next_page <= pages or in_flight:
+                while next_page <= pages and len(in_flight) < max_workers:
+                    in_flight.append(executor.submit(
+                        get_guardian_content, api_key, search_term,
+                        date_from, page=next_page, page_size=MAX_PAGE_SIZE,
+                        date_to=date_to, order_by=order_by
+                    ))
+                    next_page += 1
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+class AsyncGuardianClient:
+    '''Asynchronous client for the Guardian content API.
+
+    Requests are made over a dedicated pool of keep-alive connections and
+    run on worker threads, so several requests can be awaited concurrently
+    from an asyncio event loop. No more than max_connections requests are
+    in flight at once.
+
+    Example:
+
+        async with AsyncGuardianClient(api_key) as client:
+            pages = await client.gather([
+                ('football', '2024-01-01', 1),
+                ('football', '2024-01-01', 2),
+                ('cricket', '2024-01-01', 1),
+            ])
+
+    Args:
+        api_key:
+            str containing the API key.
+        max_connections:
+            int specifying the size of the connection pool.
+        request_timeout:
+            float specifying the number of seconds allowed per request.
+        total_timeout:
+            float specifying the number of seconds allowed for a gather.
+    '''
+
+    def __init__(
+            self, api_key: str, max_connections: int = POOL_SIZE,
+            request_timeout: float = REQUEST_TIMEOUT,
+            total_timeout: float = 60.0):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.request_timeout = request_timeout
+        self.total_timeout = total_timeout
+        self._session = _create_session(max_connections)
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Closes every pooled connection.'''
+        self._session.close()
+
+    async def get_content(
+            self, search_term: str, date_from: str,
+            page: int = 1, page_size: int = 10) -> dict:
+        '''Retrieve a single page of article data.
+
+        Returns:
+            dict containing the json response, in the same format as
+            returned by get_guardian_content.
+
+        The request, with its rate limit waits and retries, is given
+        request_timeout seconds. A worker thread cannot be cancelled, so
+        if the request times out its connection slot is only released
+        once the thread has returned, which the deadline passed to it
+        bounds.
+
+        Raises:
+            HTTPError: If the request is unsuccessful.
+            TimeoutError: If the request takes longer than request_timeout.
+        '''
+        import asyncio
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        params = _build_params(
+            self.api_key, search_term, date_from, page, page_size)
+        await self._semaphore.acquire()
+        try:
+            request = asyncio.ensure_future(asyncio.to_thread(
+                _request_content, self._session, params,
+                self.request_timeout,
+                time.monotonic() + self.request_timeout))
+        except BaseException:
+            self._semaphore.release()
+            raise
+        request.add_done_callback(self._release)
+        return await asyncio.wait_for(
+            asyncio.shield(request), self.request_timeout)
+
+    def _release(self, request):
+        if not request.cancelled():
+            # Retrieved, so a request which outlived its caller does not
+            # log an unretrieved exception.
+            request.exception()
+        self._semaphore.release()
+
+    async def gather(
+            self, queries: list[tuple], page_size: int = MAX_PAGE_SIZE,
+            return_exceptions: bool = False) -> list[dict]:
+        '''Retrieve several pages of article data concurrently.
+
+        Args:
+            queries:
+                list of (search_term, date_from, page) tuples.
+            page_size:
+                int specifying the number of results per page.
+            return_exceptions:
+                bool, if True a failed request is returned in place of its
+                response instead of raising.
+
+        Returns:
+            list of json responses in the same order as queries.
+
+        Raises:
+            TimeoutError: If every request has not completed within
+            total_timeout.
+        '''
+        import asyncio
+        return await asyncio.wait_for(
+            asyncio.gather(
+                *(self.get_content(search_term, date_from, page, page_size)
+                  for search_term, date_from, page in queries),
+                return_exceptions=return_exceptions
+            ),
+            self.total_timeout
+        )
 
 
 def filter_response(
-        response: dict,
-        fields: list[str] = ['webPublicationDate', 'webTitle', 'webUrl']
-) -> list[dict]:
+        response: dict, fields=DEFAULT_FIELDS) -> list[dict]:
     '''Filter guardian response json to keep only the required fields.
 
     Args:
         response:
             dict containing json response from the Guardian API.
         fields:
-            list contiaining names of fields to be kept.
+            iterable of the fields to be kept, or a FieldProjector. Fields
+            may be nested paths such as 'fields.bodyText' and may be
+            renamed (see src.projection.FieldProjector).
 
     Returns:
         list of dictionaries containing only the entries specified in the
@@ -72,6 +559,8 @@ def filter_response(
     '''
     if not response:
         return []
-    records = response['response']['results']
-    return [{key: value for key, value in record.items()
-            if key in fields} for record in records]
+    if not isinstance(fields, FieldProjector):
+        if isinstance(fields, dict):
+            fields = fields.items()
+        fields = get_projector(tuple(fields))
+    return fields.project_page(response['response']['results'])
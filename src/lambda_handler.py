@@ -1,92 +1,711 @@
+import base64
+import json
 import logging
+import math
+import os
+import queue
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from botocore.exceptions import ClientError
 from requests import HTTPError
-from src.message_broker import create_stream, add_records
-from src.guardian_api import get_guardian_content, filter_response
-from src.validation import check_date_is_valid, check_id_string_is_valid
+from src.message_broker import (
+    put_entries, put_aggregated_entries, put_compressed_entries, make_entry,
+    MAX_BATCH_RECORDS, STREAM_READY_TIMEOUT, SHARD_COUNT
+)
+from src.brokers import KinesisBroker, get_broker
+from src.guardian_api import (
+    get_guardian_content, get_all_guardian_content, filter_response,
+    get_session, QuotaExceededError, MAX_PAGE_SIZE
+)
+from src.validation import (
+    check_date_is_valid, check_id_string_is_valid,
+    check_positive_int_is_valid, check_list_is_valid
+)
 from src.connections_aws import connections_aws
+from src.checkpoint import get_checkpoint_store
+from src.deduplication import get_deduplicator, save_deduplicator
+from src.partitioning import get_partition_strategy, TermPartitioner
+from src.serialization import get_serializer, get_compression
+from src.deadline import Deadline
+from src.metrics import start_invocation, get_metrics, timer
+from src.backfill import backfill, DEFAULT_WINDOW_DAYS
 
 
 logger = logging.getLogger("GuardianLogger")
 logger.setLevel(logging.INFO)
 
+PUBLISH_TIME_RESERVE = 5.0
+DEFAULT_DATE_FROM = '1950-01-01'
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_BACKFILL_WORKERS = 4
+MAX_QUEUED_PAGES = 8
+DEFAULT_MESSAGE_WORKERS = 10
+BATCH_EVENT_SOURCES = ('aws:sqs', 'aws:kinesis')
+QUEUE_POLL_INTERVAL = 0.1
 
-def lambda_handler(event: dict, context: dict):
+
+class EventFailedError(RuntimeError):
+    '''
+    Raised when an EventBridge event invoking the handler asynchronously
+    failed, so that Lambda retries it and then sends it to the function's
+    dead-letter queue or on-failure destination.
     '''
-    AWS Lambda handler to process Guardian API content and uploading
-    results to a message broker to Kinesis stream.
 
-    Parameters:
-    event (dict): Event data passed to the function, containing:
-        - date_from (str): The start date for the Guardian content search,
-            expected in 'YYYY-MM-DD' format.
-        - search_term (str): The term to search for in the Guardian content.
-        - stream_id (str): The ID of the Kinesis stream to which the results
-            will be pushed.
-    context (dict): AWS Lambda context object, providing runtime information
-        to the handler.
 
-    Function Workflow:
-    1. Extracts 'date_from', 'search_term', and 'stream_id'
-        from the event dictionary.
-    2. Validates 'date_from' to ensure it is a correctly formatted date and
-        prior to the current date.
-    3. Validates 'search_term' and 'stream_id' to ensure they are non-empty
-        and do not contain only whitespace.
-    4. Establishes connections to AWS services.
-    5. Retrieves the Guardian API key from AWS credentials.
-    6. Fetches content from the Guardian API based on the search term and
-        date.
-    7. Filters the response to obtain relevant results.
-    8. Checks if the Kinesis stream exists; if not, creates a new stream.
-    9. Adds the filtered results to the Kinesis stream.
-    10. Logs the number of records added to the stream.
+def _aggregation_enabled() -> bool:
+    '''
+    Returns True if the KINESIS_AGGREGATION environment variable enables
+    KPL record aggregation.
+    '''
+    value = os.environ.get('KINESIS_AGGREGATION', '')
+    return value.lower() in ('1', 'true', 'yes')
 
-    Logs (Error):
-    - TypeError: Logs an error if an input parameter has an invalid type,
-        extracting the parameter name from the error message.
-    - ValueError: Logs specific error messages based on the nature of the
-        value error, such as empty input, whitespace-only input, invalid
-        date format, or invalid date value.
-    - HTTPError: Logs an error if the Guardian API request fails.
-    - ClientError: Logs specific error messages based on the type of
-        AWS service error encountered.
 
-    Logs (Info):
-    - Logs the creation of a new Kinesis stream if applicable.
-    - Logs the number of records added to the Kinesis stream.
+def _put_function(compression: str = None):
     '''
+    Returns the function writing entries to Kinesis (see
+    src.brokers.KinesisBroker): as compressed envelopes if compression
+    names a codec, otherwise as KPL aggregated records if
+    KINESIS_AGGREGATION is enabled, or else one record per entry.
+    '''
+    if compression:
+        def put(kinesis, stream_name, entries, max_retries):
+            return put_compressed_entries(
+                kinesis, stream_name, entries, compression, max_retries)
+        return put
+    if _aggregation_enabled():
+        return put_aggregated_entries
+    return put_entries
 
-    date_from = event.get('date_from', '1950-01-01')
-    search_term = event.get('search_term')
+
+def _parse_terms(event: dict) -> list[dict]:
+    '''
+    Extracts and validates every search term in the event.
+
+    The event may contain either a single 'search_term' or a list of
+    'search_terms'. Each item of the list is either a search term string or
+    a dictionary containing 'search_term' and an optional 'date_from'. Terms
+    without their own 'date_from' use the event level value.
+
+    Returns:
+        list of dictionaries containing 'search_term' and 'date_from'.
+
+    Raises:
+        TypeError, ValueError: If any term or date is invalid.
+    '''
+    date_from = event.get('date_from', DEFAULT_DATE_FROM)
+    if 'search_terms' in event:
+        items = event['search_terms']
+        check_list_is_valid(items, 'search_terms')
+    else:
+        items = [event.get('search_term')]
+
+    terms = []
+    for item in items:
+        if isinstance(item, dict):
+            term = {
+                'search_term': item.get('search_term'),
+                'date_from': item.get('date_from', date_from)
+            }
+        else:
+            term = {'search_term': item, 'date_from': date_from}
+        check_date_is_valid(term['date_from'])
+        check_id_string_is_valid(term['search_term'], 'search_term')
+        terms.append(term)
+    return terms
+
+
+def _newer_than(response: dict, watermark: str) -> bool:
+    '''
+    Returns True if a response holds a result published after watermark.
+    '''
+    return any(result.get('webPublicationDate', '') > watermark
+               for result in response['response'].get('results', []))
+
+
+def _fetch_pages(
+        api_key: str, search_term: str, date_from: str, max_pages: int,
+        order_by: str = 'newest', watermark: str = None):
+    '''
+    Yields the Guardian API responses for a search term: the first 10
+    results in order_by order (the 10 most recent by default), or every
+    page up to max_pages.
+
+    If a high-water mark is given, further pages are requested, ignoring
+    max_pages, until one holds a result published after the mark or the
+    results run out. The from-date only has the precision of a day, so
+    otherwise a day with more results at or before the mark than are
+    fetched would return the same results on every run, all of them
+    filtered out, and the mark would never advance.
+    '''
+    def planned_pages():
+        if max_pages is None:
+            yield get_guardian_content(
+                api_key, search_term, date_from, order_by=order_by)
+            return
+        yield from get_all_guardian_content(
+            api_key, search_term, date_from, max_pages=max_pages,
+            order_by=order_by)
+
+    page_size = 10 if max_pages is None else MAX_PAGE_SIZE
+    caught_up = watermark is None
+    page = 0
+    pages = 1
+    for response in planned_pages():
+        page += 1
+        pages = response['response'].get('pages', 1)
+        caught_up = caught_up or _newer_than(response, watermark)
+        yield response
+    while not caught_up and page < pages:
+        page += 1
+        response = get_guardian_content(
+            api_key, search_term, date_from, page=page,
+            page_size=page_size, order_by=order_by)
+        pages = response['response'].get('pages', 1)
+        caught_up = _newer_than(response, watermark)
+        yield response
+
+
+def _filter_pages(responses, watermark: str = None):
+    '''
+    Yields the filtered records of each response, keeping only records
+    published after the high-water mark if one is given.
+    '''
+    for response in responses:
+        with timer('Filter'):
+            records = filter_response(response)
+        if watermark is not None:
+            records = [record for record in records
+                       if record.get('webPublicationDate', '') > watermark]
+        yield records
+
+
+def _enrich_pages(pages, search_term: str):
+    '''
+    Yields each page of records, tagged with the search term under the key
+    'keyword'.
+    '''
+    for records in pages:
+        for record in records:
+            record['keyword'] = search_term
+        yield records
+
+
+def _term_pages(
+        api_key: str, term: dict, max_pages: int, watermark: str = None,
+        order_by: str = 'newest'):
+    '''
+    Chains the fetch, filter and enrich stages for a single search term.
+
+    If a high-water mark is given, content is requested from the later of
+    the term's date_from and the date of the mark, pages are fetched until
+    one holds content published after the mark (see _fetch_pages), and
+    only records published after the mark are kept.
+
+    Yields:
+        list of the filtered and tagged records of each page, one page at
+        a time, so only the page being processed is held in memory.
+    '''
+    date_from = term['date_from']
+    if watermark is not None:
+        date_from = max(date_from, watermark[:10])
+    responses = _fetch_pages(
+        api_key, term['search_term'], date_from, max_pages, order_by,
+        watermark)
+    return _enrich_pages(
+        _filter_pages(responses, watermark), term['search_term'])
+
+
+def _serialize_records(
+        index: int, records: list[dict], search_term: str,
+        partitioner, serializer=None):
+    '''
+    Yields a (term index, PutRecords entry, record) tuple for each record.
+    '''
+    for record in records:
+        keys = partitioner.keys(record, search_term)
+        yield index, make_entry(record, keys['PartitionKey'],
+                                keys.get('ExplicitHashKey'), serializer), \
+            record
+
+
+def _process_terms(
+        api_key: str, terms: list[dict], stream_id: str,
+        max_pages: int, max_workers: int, deadline: Deadline,
+        checkpoints=None, deduplicator=None,
+        partitioner=None, serializer=None,
+        compression: str = None, broker=None) -> list[dict]:
+    '''
+    Fetches every term concurrently and publishes the results to a stream.
+
+    Terms are fetched on a bounded thread pool, each as a chain of
+    generators (see _term_pages) which hands one page of records at a time
+    to a bounded queue. The calling thread takes pages from the queue,
+    serialises their records into a shared buffer and writes the buffer to
+    the stream in full PutRecords batches, so records from several terms
+    can share a request and writes overlap with fetching the next pages.
+    A fetch blocks while MAX_QUEUED_PAGES pages are waiting, so memory use
+    does not grow with the number of pages. A failure while fetching one
+    term is logged and recorded in its summary without affecting the
+    others.
+
+    If a checkpoint store is given, each term only fetches content newer
+    than its stored high-water mark, oldest first, so the records fetched
+    always follow on from the mark however few pages are fetched (the 10
+    oldest by default). The mark is advanced to the newest
+    webPublicationDate written, but only once every record written for the
+    term has been confirmed by the stream; the newer records are left for
+    the next run.
+
+    If a deduplicator is given, records whose webUrl has already been
+    published to the stream (or is queued by another term) are suppressed
+    before publishing. URLs are added to the index once they are written.
+
+    Records are serialised with serializer (json by default). If
+    compression names a codec, each batch is written as compressed
+    envelopes; otherwise records are aggregated if KINESIS_AGGREGATION is
+    enabled. Records are published to broker (see src.brokers), or to
+    Kinesis if none is given.
+
+    Fetching stops taking on new work once the fetch stage's share of the
+    deadline is used: terms not yet fetched are abandoned, and a term being
+    fetched page by page stops requesting pages. Fetches still running
+    when only the reserve is left are abandoned. The records already in
+    hand are still published, without retries once only the reserve is
+    left. Each term which was cut short is given a 'remaining' entry, an
+    item for the 'search_terms' of a later event which completes it. Its
+    watermark is only advanced if a checkpoint store is given, as the
+    records were then fetched oldest first.
+
+    Returns:
+        list of per-term summaries, in the same order as terms, containing
+        'search_term', 'date_from', 'records' (number written), 'failed'
+        (number not written), 'duplicates' (number suppressed),
+        'duration_ms' (fetch time), 'watermark', 'error' and 'remaining'
+        (None if the term was completed).
+    '''
+    summaries = [
+        dict(term, records=0, failed=0, duplicates=0, duration_ms=0,
+             watermark=None, error=None, remaining=None)
+        for term in terms
+    ]
+    deadline = deadline or Deadline()
+    fetch_deadline = deadline.stage('fetch')
+    metrics = get_metrics()
+    newest = {}
+    queued = set()
+    put = _put_function(compression)
+    partitioner = partitioner or TermPartitioner()
+    shard_counts = {}
+    pending = []
+    stream = {}
+    pages = queue.Queue(maxsize=MAX_QUEUED_PAGES)
+    stopped = threading.Event()
+
+    def cut_short(index):
+        summaries[index]['remaining'] = {
+            'search_term': terms[index]['search_term'],
+            'date_from': terms[index]['date_from']
+        }
+
+    def hand_over(item) -> bool:
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(index):
+        if fetch_deadline.expired():
+            hand_over(('done', index, False))
+            return
+        start = time.perf_counter()
+        outcome = True
+        try:
+            order_by = 'newest'
+            if checkpoints is not None:
+                summaries[index]['watermark'] = checkpoints.get_watermark(
+                    terms[index]['search_term'], stream_id)
+                order_by = 'oldest'
+            term_pages = _term_pages(api_key, terms[index], max_pages,
+                                     summaries[index]['watermark'], order_by)
+            for records in term_pages:
+                if not hand_over(('page', index, records)):
+                    break
+                paged = (max_pages is not None
+                         or summaries[index]['watermark'] is not None)
+                if paged and fetch_deadline.expired():
+                    outcome = False
+                    break
+            term_pages.close()
+        except Exception as err:
+            outcome = err
+        finally:
+            summaries[index]['duration_ms'] = round(
+                (time.perf_counter() - start) * 1000)
+            metrics.record('FetchDuration', summaries[index]['duration_ms'])
+        hand_over(('done', index, outcome))
+
+    def publish(batch):
+        if 'broker' not in stream:
+            stream['broker'] = broker or KinesisBroker(
+                connections_aws.get_message_broker(), put)
+            timeout = deadline.budget('stream', STREAM_READY_TIMEOUT)
+            if stream['broker'].ensure_stream(stream_id, timeout):
+                logger.info(f'New stream created: {stream_id}.')
+        if not batch:
+            return
+        max_retries = 0 if deadline.expired() else 3
+        try:
+            with metrics.timer('Publish'):
+                results = stream['broker'].put(
+                    stream_id, [entry for _, entry, _ in batch], max_retries)
+        except ClientError as err:
+            # Count the batch as failed, so the terms are reported as
+            # incomplete and the records are sent again, rather than
+            # abandoning the records already fetched.
+            _log_error(err, stream_id)
+            failure = {'ErrorCode': err.response['Error']['Code'],
+                       'ErrorMessage': str(err)}
+            results = [failure] * len(batch)
+        for (index, _, record), result in zip(batch, results):
+            if 'ErrorCode' in result:
+                summaries[index]['failed'] += 1
+                continue
+            summaries[index]['records'] += 1
+            newest[index] = max(newest.get(index, ''),
+                                record.get('webPublicationDate', ''))
+            if deduplicator is not None:
+                deduplicator.add(record.get('webUrl'), stream_id)
+            shard_counts[result['ShardId']] = \
+                shard_counts.get(result['ShardId'], 0) + 1
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    for index in range(len(terms)):
+        executor.submit(fetch, index)
+    completed = set()
+    try:
+        while len(completed) < len(terms):
+            timeout = deadline.available()
+            try:
+                kind, index, payload = pages.get(
+                    timeout=None if math.isinf(timeout) else timeout)
+            except queue.Empty:
+                break
+            if kind == 'done':
+                completed.add(index)
+                if isinstance(payload, Exception):
+                    summaries[index]['error'] = str(payload)
+                    _log_error(payload, stream_id)
+                elif not payload:
+                    cut_short(index)
+                continue
+            records = payload
+            metrics.add('RecordsFetched', len(records))
+            if deduplicator is not None:
+                fetched = len(records)
+                records = deduplicator.filter_records(
+                    records, stream_id, pending=queued)
+                summaries[index]['duplicates'] += fetched - len(records)
+            pending.extend(_serialize_records(
+                index, records, terms[index]['search_term'],
+                partitioner, serializer))
+            while len(pending) >= MAX_BATCH_RECORDS:
+                publish(pending[:MAX_BATCH_RECORDS])
+                pending = pending[MAX_BATCH_RECORDS:]
+            if deadline.expired():
+                break
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    for index in set(range(len(terms))) - completed:
+        cut_short(index)
+
+    if all(summary['error'] is not None for summary in summaries):
+        return summaries
+    if pending or not deadline.expired():
+        publish(pending)
+    if 'broker' in stream:
+        stream['broker'].flush()
+    for index, summary in enumerate(summaries):
+        complete = summary['remaining'] is None or checkpoints is not None
+        if (summary['error'] is None and summary['failed'] == 0
+                and complete and newest.get(index)):
+            summary['watermark'] = newest[index]
+            if checkpoints is not None:
+                checkpoints.set_watermark(
+                    summary['search_term'], stream_id, newest[index])
+    shards = ', '.join(shard[-3:] for shard in shard_counts)
+    logger.info(f'{sum(shard_counts.values())} records added to ' +
+                f'stream: {stream_id} ({shards}).')
+    duplicates = sum(summary['duplicates'] for summary in summaries)
+    if duplicates > 0:
+        logger.info(f'{duplicates} duplicate records suppressed.')
+    failed = sum(summary['failed'] for summary in summaries)
+    if failed > 0:
+        logger.error(f'{failed} records could not be added to ' +
+                     f'stream: {stream_id}.')
+    remaining = sum(summary['remaining'] is not None
+                    for summary in summaries)
+    metrics.add('RecordsPublished', sum(shard_counts.values()))
+    metrics.add('RecordsFailed', failed)
+    metrics.add('DuplicatesSuppressed', duplicates)
+    metrics.add('TermsRemaining', remaining)
+    if remaining > 0:
+        logger.warning(f'Deadline reached: {remaining} search terms ' +
+                       'were not completed.')
+    return summaries
+
+
+def _parse_request(event: dict) -> dict:
+    '''
+    Extracts and validates a search request.
+
+    Returns:
+        dict containing the 'terms' (see _parse_terms), 'stream_id',
+        'max_pages' and 'max_workers' of the request.
+
+    Raises:
+        TypeError, ValueError: If any parameter is invalid.
+    '''
+    terms = _parse_terms(event)
     stream_id = event.get('stream_id')
+    max_pages = event.get('max_pages')
+    max_workers = event.get('max_workers', DEFAULT_MAX_WORKERS)
+    check_id_string_is_valid(stream_id, 'stream_id')
+    if max_pages is not None:
+        check_positive_int_is_valid(max_pages, 'max_pages')
+    check_positive_int_is_valid(max_workers, 'max_workers')
+    return {'terms': terms, 'stream_id': stream_id, 'max_pages': max_pages,
+            'max_workers': max_workers}
+
+
+def _load_resources(broker=None) -> dict:
+    '''
+    Returns the stores, codecs and broker selected by the environment, as
+    keyword arguments of _process_terms. The broker given is used in
+    place of the one selected by BROKER.
+
+    Raises:
+        ValueError: If a configuration parameter is invalid.
+    '''
+    return {
+        'checkpoints': get_checkpoint_store(),
+        'deduplicator': get_deduplicator(),
+        'partitioner': get_partition_strategy(SHARD_COUNT),
+        'serializer': get_serializer(),
+        'compression': get_compression(),
+        'broker': broker or get_broker(),
+    }
+
+
+def _get_api_key(deadline: Deadline, metrics) -> str:
+    '''
+    Returns the Guardian API key (cached), or None if the deadline has
+    already passed. Secrets Manager is given the secret stage's share of
+    the deadline to return it.
+    '''
+    if deadline.expired():
+        return None
+    with metrics.timer('Secret'):
+        return connections_aws.get_credentials(
+            'Guardian-Key', deadline.budget('secret'))
+
+
+def request_failed(summaries: list[dict]) -> bool:
+    '''
+    Returns True if a search request could not be processed (summaries is
+    None), or any of its terms failed, was left with records not written
+    or was cut short by the deadline.
+    '''
+    return summaries is None or any(
+        summary['error'] is not None or summary['failed']
+        or summary['remaining'] is not None
+        for summary in summaries)
+
+
+def _batch_messages(event) -> list[dict]:
+    '''
+    Returns the messages of a batch event, or None if the event is a
+    single search request.
+
+    A batch is an SQS or Kinesis event source batch (a dict whose
+    'Records' come from 'aws:sqs' or 'aws:kinesis'), or an EventBridge
+    Pipes batch (a list of such records or of EventBridge events). A
+    single EventBridge event is not a batch (see _handle_event).
+    '''
+    if isinstance(event, list):
+        return event
+    records = event.get('Records')
+    if isinstance(records, list) and records and all(
+            isinstance(record, dict)
+            and record.get('eventSource') in BATCH_EVENT_SOURCES
+            for record in records):
+        return records
+    return None
+
+
+def _message_id(message) -> str:
+    '''
+    Returns:
+        string identifying a message in batchItemFailures: the SQS
+        message id, the Kinesis sequence number or the EventBridge event
+        id (None if the message has none).
+    '''
+    if not isinstance(message, dict):
+        return None
+    source = message.get('eventSource')
+    if source == 'aws:sqs':
+        return message.get('messageId')
+    if source == 'aws:kinesis':
+        record = message.get('kinesis')
+        return record.get('sequenceNumber') \
+            if isinstance(record, dict) else None
+    return message.get('id')
+
+
+def _message_body(message) -> object:
+    '''
+    Returns:
+        the body of a message: the SQS message body, the decoded Kinesis
+        record data, or the EventBridge event detail.
+
+    Raises:
+        ValueError: If the message is malformed.
+    '''
+    if not isinstance(message, dict):
+        raise ValueError('Parameter (message) must be a JSON object.')
+    source = message.get('eventSource')
+    if source == 'aws:sqs':
+        return message.get('body')
+    if source == 'aws:kinesis':
+        return base64.b64decode(message['kinesis']['data'], validate=True)
+    return message.get('detail')
+
+
+def _parse_body(body) -> dict:
+    '''
+    Returns:
+        dict containing the search request carried by a message body.
+
+    Raises:
+        ValueError: If the body is not a JSON object.
+    '''
+    if isinstance(body, (str, bytes)):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            body = None
+    if not isinstance(body, dict):
+        raise ValueError('Parameter (body) must be a JSON object.')
+    return body
+
+
+def _handle_batch(
+        messages: list[dict], deadline: Deadline, broker=None) -> dict:
+    '''
+    Processes the search request of every message of a batch
+    concurrently, sharing the clients, stores and API key.
+
+    A message fails if it is malformed, if its body is not a search
+    request, if the request is invalid, or if any of its terms failed, was
+    left with records not written or was cut short by the deadline (see
+    request_failed). Only the failed messages are reported. If the
+    resources shared by the batch cannot be loaded, every message fails.
+
+    Returns:
+        dict containing 'batchItemFailures', a list with an
+        'itemIdentifier' for each failed message, so that only those are
+        retried (ReportBatchItemFailures).
+    '''
+    metrics = start_invocation(Messages=len(messages))
+    start = time.perf_counter()
+    identifiers = [_message_id(message) for message in messages]
+    failed = set()
+
+    def process(index):
+        identifier = identifiers[index]
+        stream_id = None
+        try:
+            event = _parse_body(_message_body(messages[index]))
+            stream_id = event.get('stream_id')
+            request = _parse_request(event)
+            summaries = _process_terms(
+                api_key, deadline=deadline, **request, **resources)
+        except Exception as err:
+            _log_error(err, stream_id)
+            summaries = None
+        if request_failed(summaries):
+            logger.error(f'Message {identifier} failed.')
+            failed.add(index)
 
     try:
-        check_date_is_valid(date_from)
-        check_id_string_is_valid(search_term, 'search_term')
-        check_id_string_is_valid(stream_id, 'stream_id')
-        connections = connections_aws()
-        api_key = connections.get_credentials('Guardian-Key')
-        response = get_guardian_content(api_key, search_term, date_from)
-        results = filter_response(response)
-        for record in results:
-            record['keyword'] = search_term
-        kinesis = connections.get_message_broker()
-        if (create_stream(kinesis, stream_id) is not None):
-            logger.info(f'New stream created: {stream_id}.')
-        shard_id = add_records(kinesis, stream_id, search_term, results)
-        logger.info(f'{len(results)} records added to stream: ' + 
-        f'{stream_id} ({shard_id[-3:]}).')
-    except TypeError as err:
+        resources = _load_resources(broker)
+        api_key = _get_api_key(deadline, metrics)
+        workers = min(len(messages), DEFAULT_MESSAGE_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(process, range(len(messages))))
+        save_deduplicator()
+    except Exception as err:
+        metrics.add('Errors')
+        _log_error(err, None)
+        failed = set(range(len(messages)))
+    finally:
+        metrics.add('MessagesFailed', len(failed))
+        metrics.record('InvocationDuration',
+                       round((time.perf_counter() - start) * 1000, 3))
+        metrics.emit()
+    return {'batchItemFailures': [
+        {'itemIdentifier': identifiers[index]}
+        for index in sorted(failed)
+    ]}
+
+
+def _handle_event(event: dict, deadline: Deadline, broker=None) -> dict:
+    '''
+    Processes the search request in the detail of an EventBridge event
+    (see _handle_batch).
+
+    An EventBridge rule invokes the handler asynchronously, and Lambda
+    ignores the response of an asynchronous invocation, so a failure is
+    raised rather than reported in batchItemFailures.
+
+    Returns:
+        dict containing an empty 'batchItemFailures'.
+
+    Raises:
+        EventFailedError: If the request failed.
+    '''
+    result = _handle_batch([event], deadline, broker)
+    if result['batchItemFailures']:
+        raise EventFailedError(
+            f"EventBridge event {event.get('id')} failed.")
+    return result
+
+
+def _log_error(err: Exception, stream_id: str):
+    '''
+    Logs a message describing an error raised while handling an event.
+    '''
+    if isinstance(err, TypeError):
         param_name = re.findall(r'\(\w+\)', str(err))[0]
         logger.error(f'Invalid input parameter type {param_name}.')
-    except ValueError as err:
+    elif isinstance(err, ValueError):
         log_responses = {
             'cannot be an empty string': 'Empty input parameter',
+            'cannot be an empty list': 'Empty input parameter',
             'cannot contain only whitespace': 'Invalid input parameter',
             'must be formatted as': 'Invalid date format',
-            'must be before current date': 'Invalid date value'
+            'must be before current date': 'Invalid date value',
+            'cannot be before': 'Invalid date value',
+            'must be a positive integer': 'Invalid input parameter value',
+            'must be one of': 'Invalid configuration parameter',
+            'must be a JSON object': 'Invalid message'
         }
         for message in log_responses.keys():
             if re.search(
@@ -94,12 +713,15 @@ def lambda_handler(event: dict, context: dict):
             ) is not None:
                 param_name = re.findall(r'\(\w+\)', str(err))[0]
                 logger.error(f'{log_responses[message]} {param_name}.')
-    except HTTPError as err:
+    elif isinstance(err, HTTPError):
+        if err.response.status_code in (401, 403):
+            connections_aws.invalidate_credentials('Guardian-Key')
         logger.error('Guardian API request failed with status code ' +
                      f'{err.response.status_code}.')
-    except ClientError as err:
+    elif isinstance(err, ClientError):
         log_responses = {}
-        match err.response['Error']['Code']:
+        code = err.response['Error']['Code']
+        match code:
             case 'ResourceNotFoundException':
                 log_responses = {
                     'GetSecretValue': 'Failed to retrieve Guardian ' +
@@ -108,12 +730,271 @@ def lambda_handler(event: dict, context: dict):
             case 'AccessDeniedException':
                 log_responses = {
                     'PutRecord': 'Insufficient permissions to add ' +
-                    'records to stream: {stream_id}.',
+                    f'records to stream: {stream_id}.',
                     'GetSecretValue': 'Insufficient permissions to ' +
                     'retrieve secret.'
                 }
+            case 'ProvisionedThroughputExceededException':
+                log_responses = {
+                    'PutRecord': 'Write throughput exceeded for ' +
+                    f'stream: {stream_id}.',
+                }
         for message in log_responses.keys():
             if re.search(rf'{message}', str(err)) is not None:
                 logger.error(log_responses[message])
-    except Exception as err:
+                break
+        else:
+            logger.error(f'AWS request failed with error code {code}.')
+    elif isinstance(err, QuotaExceededError):
+        logger.error(f'Guardian API request not sent: {str(err)}')
+    elif isinstance(err, TimeoutError):
+        logger.error(f'Operation timed out: {str(err)}')
+    else:
         logger.error(f'An unexpected error occurred: {str(err)}.')
+
+
+def lambda_handler(event: dict, context: dict, broker=None):
+    '''
+    AWS Lambda handler to process Guardian API content and uploading
+    results to a message broker to Kinesis stream.
+
+    Parameters:
+    event (dict): Event data passed to the function, containing:
+        - date_from (str): The start date for the Guardian content search,
+            expected in 'YYYY-MM-DD' format.
+        - search_term (str): The term to search for in the Guardian content.
+        - search_terms (list, optional): Used instead of 'search_term' to
+            process several terms in one invocation. Each item is either a
+            search term or a dict containing 'search_term' and an optional
+            'date_from'.
+        - stream_id (str): The ID of the Kinesis stream to which the results
+            will be pushed.
+        - max_pages (int, optional): If provided, every page of results up
+            to this limit is retrieved at the maximum page size, instead of
+            only the 10 most recent results.
+        - max_workers (int, optional): The maximum number of search terms
+            fetched concurrently (default 8).
+        The event may instead be a batch of such requests: an SQS or
+        Kinesis event source batch, whose message bodies (or record data)
+        are JSON requests, or a list of EventBridge events from
+        EventBridge Pipes, each carrying a request in 'detail'. Up to
+        DEFAULT_MESSAGE_WORKERS messages are processed concurrently,
+        sharing the clients, stores and API key. A single EventBridge
+        event, delivered by an asynchronous rule invocation, carries its
+        request in 'detail' and raises EventFailedError if it fails, so
+        that Lambda retries it and then sends it to the dead-letter queue.
+    context (dict): AWS Lambda context object, providing runtime information
+        to the handler.
+    broker (Broker, optional): Destination for the records, used instead
+        of the broker selected by BROKER when the handler is run locally
+        (see src.__main__).
+
+    Function Workflow:
+    1. Extracts the search terms, 'date_from' and 'stream_id'
+        from the event dictionary.
+    2. Validates every 'date_from' to ensure it is a correctly formatted
+        date and prior to the current date.
+    3. Validates every 'search_term' and 'stream_id' to ensure they are
+        non-empty and do not contain only whitespace.
+    4. Establishes connections to AWS services, reusing clients created
+        by previous warm invocations.
+    5. Retrieves the Guardian API key from AWS credentials (cached).
+    6. Fetches content from the Guardian API for each search term
+        concurrently, one page at a time if 'max_pages' is provided.
+    7. Filters each response to obtain relevant results.
+    8. Checks if the Kinesis stream exists; if not, creates a new stream
+        and waits for it to become ready within the remaining time.
+    9. Adds the filtered results of every term to the Kinesis stream in
+        shared batches, as each page arrives, while later pages are
+        still being fetched.
+    10. Logs the number of records added to the stream.
+
+    If the CHECKPOINT_STORE environment variable is set, only content
+    published since the last confirmed write for each (search_term,
+    stream_id) is fetched (see src.checkpoint.get_checkpoint_store). If the
+    DEDUP_MODE environment variable is set, articles already published to
+    the stream are suppressed (see src.deduplication.get_deduplicator). If
+    KINESIS_AGGREGATION is 'true', records are packed into KPL aggregated
+    records (see src.aggregation). PARTITION_STRATEGY selects how records
+    are spread across shards (see src.partitioning). SERIALIZER selects
+    the record format and COMPRESSION packs records into compressed batch
+    envelopes, taking precedence over aggregation (see src.serialization).
+    BROKER selects where records are published: Kinesis by default, or an
+    in-memory ring buffer or memory-mapped segment files (see
+    src.brokers.get_broker).
+
+    The time remaining in the invocation (from the context) is shared
+    between the stages (see src.deadline). As the deadline approaches no
+    new terms or pages are fetched, and the records already fetched are
+    published within the last PUBLISH_TIME_RESERVE seconds.
+
+    Returns:
+        list of per-term summaries containing 'search_term', 'date_from',
+        'records', 'failed', 'duplicates', 'duration_ms', 'watermark',
+        'error' and 'remaining', or None if the event could not be
+        processed. 'remaining' is None for a completed term; for a term
+        cut short by the deadline it is an item for the 'search_terms' of
+        a later event which completes the work. For a batch event, a dict
+        containing 'batchItemFailures', with the 'itemIdentifier' of each
+        message which failed (see request_failed), so that with
+        ReportBatchItemFailures enabled only those messages are retried.
+        For a single EventBridge event which succeeded, the same dict
+        with an empty 'batchItemFailures'.
+
+    Logs (Error):
+    - TypeError: Logs an error if an input parameter has an invalid type,
+        extracting the parameter name from the error message.
+    - ValueError: Logs specific error messages based on the nature of the
+        value error, such as empty input, whitespace-only input, invalid
+        date format, or invalid date value.
+    - HTTPError: Logs an error if the Guardian API request fails. The
+        cached API key is invalidated if the request was unauthorised.
+        Only the affected search term is abandoned.
+    - ClientError: Logs specific error messages based on the type of
+        AWS service error encountered, or its error code. A failed write
+        to the stream is counted in 'failed' for the records it held.
+    - TimeoutError: Logs an error if the stream is not ready in time.
+    - QuotaExceededError: Logs an error if the daily Guardian API quota
+        has been used.
+
+    Logs (Info):
+    - Logs the creation of a new Kinesis stream if applicable.
+    - Logs the number of records added to the Kinesis stream.
+
+    Logs (Metrics):
+    - Writes one CloudWatch Embedded Metric Format line per invocation to
+        the GuardianMetrics logger, with the duration of each stage,
+        record and byte counts, retries and a cold start flag (see
+        src.metrics).
+    '''
+
+    deadline = Deadline.from_context(context, PUBLISH_TIME_RESERVE)
+    messages = _batch_messages(event)
+    if messages is not None:
+        return _handle_batch(messages, deadline, broker)
+    if 'detail-type' in event:
+        return _handle_event(event, deadline, broker)
+    stream_id = event.get('stream_id')
+    metrics = start_invocation(StreamId=str(stream_id))
+    start = time.perf_counter()
+
+    try:
+        request = _parse_request(event)
+        resources = _load_resources(broker)
+        api_key = _get_api_key(deadline, metrics)
+        summaries = _process_terms(
+            api_key, deadline=deadline, **request, **resources)
+        save_deduplicator()
+        return summaries
+    except Exception as err:
+        metrics.add('Errors')
+        _log_error(err, stream_id)
+        return None
+    finally:
+        metrics.record('InvocationDuration',
+                       round((time.perf_counter() - start) * 1000, 3))
+        metrics.emit()
+
+
+def backfill_handler(event: dict, context: dict):
+    '''
+    AWS Lambda handler to backfill a stream with every article for a
+    search term in a date range (see src.backfill.backfill).
+
+    Parameters:
+    event (dict): Event data passed to the function, containing:
+        - search_term (str): The term to search for in the Guardian content.
+        - date_from (str): The first date of the range, as 'YYYY-MM-DD'.
+        - date_to (str, optional): The last date of the range (default
+            today).
+        - stream_id (str): The ID of the Kinesis stream to which the results
+            will be pushed.
+        - window_days (int, optional): The number of days fetched in each
+            window (default 30). Windows holding too many pages are split.
+        - max_workers (int, optional): The maximum number of windows
+            fetched concurrently (default 4).
+    context (dict): AWS Lambda context object. No new windows are fetched
+        once only PUBLISH_TIME_RESERVE seconds remain.
+
+    If the CHECKPOINT_STORE environment variable is set, completed windows
+    are recorded and skipped by a later invocation with the same
+    search_term, stream_id and date_from, so an interrupted backfill can be
+    resumed by invoking the handler again with the same event.
+
+    Records are partitioned, serialised and written as by lambda_handler:
+    PARTITION_STRATEGY, SERIALIZER, COMPRESSION, KINESIS_AGGREGATION and
+    BROKER apply.
+
+    The metrics of the invocation are written as a single EMF line, as by
+    lambda_handler.
+
+    Returns:
+        dict summarising the backfill, including 'resume_from' (the first
+        date still to be written, or None once the range is complete), or
+        None if the event could not be processed.
+    '''
+    search_term = event.get('search_term')
+    date_from = event.get('date_from')
+    date_to = event.get('date_to', datetime.now().strftime('%Y-%m-%d'))
+    stream_id = event.get('stream_id')
+    window_days = event.get('window_days', DEFAULT_WINDOW_DAYS)
+    max_workers = event.get('max_workers', DEFAULT_BACKFILL_WORKERS)
+    deadline = Deadline.from_context(context, PUBLISH_TIME_RESERVE)
+    metrics = start_invocation(StreamId=str(stream_id))
+    start = time.perf_counter()
+
+    try:
+        check_date_is_valid(date_from)
+        check_date_is_valid(date_to, 'date_to')
+        check_id_string_is_valid(search_term, 'search_term')
+        check_id_string_is_valid(stream_id, 'stream_id')
+        check_positive_int_is_valid(window_days, 'window_days')
+        check_positive_int_is_valid(max_workers, 'max_workers')
+        checkpoints = get_checkpoint_store()
+        partitioner = get_partition_strategy(SHARD_COUNT)
+        serializer = get_serializer()
+        broker = get_broker() or KinesisBroker(
+            connections_aws.get_message_broker(),
+            _put_function(get_compression()))
+        api_key = connections_aws.get_credentials(
+            'Guardian-Key', deadline.budget('secret'))
+        return backfill(
+            api_key, search_term, date_from, date_to, stream_id, broker,
+            window_days, max_workers, checkpoints, serializer, deadline,
+            partitioner)
+    except Exception as err:
+        metrics.add('Errors')
+        _log_error(err, stream_id)
+        return None
+    finally:
+        metrics.record('InvocationDuration',
+                       round((time.perf_counter() - start) * 1000, 3))
+        metrics.emit()
+
+
+def init_clients():
+    '''
+    Creates the clients used by every invocation: the Secrets Manager
+    client, the Kinesis client unless a local broker is selected (see
+    src.brokers.get_broker), the DynamoDB client for a DynamoDB checkpoint
+    store, and the Guardian API session.
+
+    Called when the module is imported in AWS Lambda, so the clients are
+    built during the init phase rather than by the first invocation. An
+    error is logged and otherwise ignored; the handler reports it when the
+    client is next needed.
+    '''
+    try:
+        services = ['secretsmanager']
+        if get_broker() is None:
+            services.append('kinesis')
+        if os.environ.get('CHECKPOINT_STORE') == 'dynamodb':
+            services.append('dynamodb')
+        connections_aws.create_clients(*services)
+        get_session()
+    except Exception as err:
+        logger.warning(f'Clients not created during init: {err}')
+
+
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    init_clients()
@@ -1,69 +1,955 @@
-import json
+import random
+import threading
 import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from src.aggregation import aggregate_entries
+from src.serialization import JsonSerializer, compress_entries
+from src.metrics import get_metrics, timed
+from src.partitioning import even_shard_ranges, get_shards
+from src.throttling import (
+    ThrottleController, entry_size, SHARD_RECORDS_PER_SECOND,
+    SHARD_BYTES_PER_SECOND, THROTTLE_ERROR_CODES
+)
 
-def create_stream(kinesis, stream_name: str) -> dict:
+SHARD_COUNT = 15
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+RETRY_BASE_DELAY = 0.1
+STREAM_READY_TIMEOUT = 60.0
+STREAM_READY_INITIAL_DELAY = 0.1
+STREAM_READY_MAX_DELAY = 2.0
+MAX_THROTTLE_REQUEUES = 10
+MAX_THROTTLE_DELAY = 2.0
+PRODUCER_CAPACITY = 10000
+PRODUCER_CAPACITY_BYTES = 32 * 1024 * 1024
+PRODUCER_LINGER = 0.1
+PRODUCER_MAX_IN_FLIGHT = 4
+
+_READY_STATUSES = ('ACTIVE', 'UPDATING')
+_active_streams = set()
+_stream_shards = {}
+_throttle_controllers = {}
+_default_serializer = JsonSerializer()
+
+
+@timed('StreamReady')
+def create_stream(
+        kinesis, stream_name: str, timeout: float = STREAM_READY_TIMEOUT
+        ) -> dict:
     '''
     Creates a new Kinesis stream if specified stream does not exist.
 
-    This function attemps to create a new Kinesis stream within the boto3
-    client. If the create_stream operation fails, i.e. a stream with the 
-    provided name already exists, then the function returns None. If there
-    operation is successful, the function will increase the retention period
-    to three days. This operation will fail unless the stream creation has
-    been compelted. Hence, there latter operation is looped until successful. 
+    Streams known to be ACTIVE are remembered for the lifetime of the
+    process, so warm invocations return immediately without making any
+    control-plane calls. Otherwise the stream is described: an existing
+    stream is waited on until it can accept records and None is returned.
+    If the stream does not exist it is created, and once it is ready the
+    retention period is increased to three days.
 
     Args:
         stream_name: string specifying data stream to write records to
         e.g. guardian_content.
+        timeout: maximum number of seconds to wait for the stream to
+        become ready, e.g. the remaining Lambda execution time.
 
     Returns:
-        dict containing the response from the create_stream method.
+        dict containing the response from the create_stream method, or None
+        if the stream already exists.
+
+    Raises:
+        TimeoutError: If the stream is not ready within the timeout.
     '''
+    if stream_name in _active_streams:
+        return None
+
+    status = _get_stream_status(kinesis, stream_name)
+    if status is not None:
+        if status not in _READY_STATUSES:
+            wait_for_stream(kinesis, stream_name, timeout)
+        _active_streams.add(stream_name)
+        return None
+
     try:
         response = kinesis.create_stream(
             StreamName=stream_name,
-            ShardCount=15
+            ShardCount=SHARD_COUNT
         )
     except kinesis.exceptions.ResourceInUseException:
+        wait_for_stream(kinesis, stream_name, timeout)
+        _active_streams.add(stream_name)
         return None
-    
-    is_unchanged = True
-    while (is_unchanged):
-        try:
-            kinesis.increase_stream_retention_period(
-                StreamName=stream_name,
-                RetentionPeriodHours=72
-            )
-            is_unchanged = False
-        except kinesis.exceptions.ResourceNotFoundException:
-            time.sleep(0.1)
-        except kinesis.exceptions.ResourceInUseException:
-            time.sleep(0.1)
+
+    wait_for_stream(kinesis, stream_name, timeout)
+    kinesis.increase_stream_retention_period(
+        StreamName=stream_name,
+        RetentionPeriodHours=72
+    )
+    _active_streams.add(stream_name)
     return response
 
+
+def _get_stream_status(kinesis, stream_name: str) -> str:
+    '''
+    Returns the status of a Kinesis stream, or None if it does not exist.
+    '''
+    try:
+        response = kinesis.describe_stream_summary(StreamName=stream_name)
+    except kinesis.exceptions.ResourceNotFoundException:
+        return None
+    return response['StreamDescriptionSummary']['StreamStatus']
+
+
+def wait_for_stream(
+        kinesis, stream_name: str, timeout: float = STREAM_READY_TIMEOUT
+        ):
+    '''
+    Waits until a Kinesis stream is able to accept records.
+
+    The stream is described with an exponentially increasing delay between
+    calls (starting at 0.1 seconds, capped at 2 seconds) until its status
+    is ACTIVE or UPDATING.
+
+    Args:
+        stream_name: string specifying the data stream to wait for.
+        timeout: maximum number of seconds to wait.
+
+    Raises:
+        TimeoutError: If the stream is not ready within the timeout.
+    '''
+    deadline = time.monotonic() + timeout
+    delay = STREAM_READY_INITIAL_DELAY
+    while True:
+        if _get_stream_status(kinesis, stream_name) in _READY_STATUSES:
+            return
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(
+                f'Stream ({stream_name}) was not ready within ' +
+                f'{timeout:.1f} seconds.'
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, STREAM_READY_MAX_DELAY)
+
+
+def forget_stream(stream_name: str = None):
+    '''
+    Removes a stream from the set of streams known to be ACTIVE, along
+    with its shards and throttle controller.
+
+    Args:
+        stream_name: string specifying the data stream. If None, every
+        stream is forgotten.
+    '''
+    if stream_name is None:
+        _active_streams.clear()
+        _stream_shards.clear()
+        _throttle_controllers.clear()
+    else:
+        _active_streams.discard(stream_name)
+        _stream_shards.pop(stream_name, None)
+        _throttle_controllers.pop(stream_name, None)
+
+
+def get_stream_shards(kinesis, stream_name: str) -> list[tuple]:
+    '''
+    Returns the ids and hash key ranges of the open shards of a stream
+    (see src.partitioning.get_shards). They are listed once and kept for
+    the lifetime of the process, like the streams known to be ACTIVE,
+    until the stream is forgotten (see forget_stream).
+
+    Returns:
+        list of (shard id, (starting hash key, ending hash key)) tuples,
+        ordered by starting hash key.
+    '''
+    shards = _stream_shards.get(stream_name)
+    if shards is None:
+        shards = _stream_shards.setdefault(
+            stream_name, get_shards(kinesis, stream_name))
+    return shards
+
+
+def _stream_shard_ranges(kinesis, stream_name: str) -> list[tuple]:
+    return [hash_range for _, hash_range in
+            get_stream_shards(kinesis, stream_name)]
+
+
+def get_throttle_controller(
+        stream_name: str, kinesis=None) -> ThrottleController:
+    '''
+    Returns the throttle controller of a stream (see src.throttling),
+    creating it if required. Controllers are kept for the lifetime of the
+    process, so the rates learned for each shard carry over to warm
+    invocations, until the stream is forgotten (see forget_stream).
+
+    Args:
+        stream_name: string specifying the data stream.
+        kinesis: boto3 Kinesis client. A new controller is built on the
+        ids and hash key ranges of the stream's shards (see
+        get_stream_shards), so that throttles and successes are counted
+        against the same shards. Without a client, it is built on those
+        of a stream created by create_stream.
+    '''
+    controller = _throttle_controllers.get(stream_name)
+    if controller is None:
+        if kinesis is None:
+            controller = ThrottleController(even_shard_ranges(SHARD_COUNT))
+        else:
+            shards = get_stream_shards(kinesis, stream_name)
+            controller = ThrottleController(
+                [hash_range for _, hash_range in shards],
+                shard_ids=[shard_id for shard_id, _ in shards])
+        controller = _throttle_controllers.setdefault(
+            stream_name, controller)
+    return controller
+
+
+def _batch_indices(entries: list[dict]):
+    '''
+    Splits PutRecords entries into batches within the request limits.
+
+    A single PutRecords request accepts at most 500 records and 5 MB of
+    data (record data plus partition keys). Entries are packed into
+    batches in their original order without exceeding either limit.
+
+    Args:
+        entries: list of PutRecords entries, each containing the keys
+        Data (bytes) and PartitionKey (str).
+
+    Yields:
+        list of indices into entries making up a single request.
+    '''
+    batch = []
+    batch_bytes = 0
+    for index, entry in enumerate(entries):
+        size = entry_size(entry)
+        if batch and (len(batch) == MAX_BATCH_RECORDS
+                      or batch_bytes + size > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(index)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _put_records(kinesis, stream_name: str, records: list[dict],
+                 metrics) -> list[dict]:
+    '''
+    Makes a single put_records call.
+
+    A request rejected as a whole because the stream is throttled is
+    reported as every record being throttled, so the records are
+    requeued like those throttled individually. If the stream does not
+    exist (e.g. it was deleted since it was created), it is forgotten, so
+    that create_stream describes it again.
+
+    Returns:
+        list of the result of each record.
+    '''
+    try:
+        with metrics.timer('KinesisPut'):
+            response = kinesis.put_records(
+                StreamName=stream_name, Records=records)
+    except ClientError as err:
+        code = err.response['Error']['Code']
+        if code == 'ResourceNotFoundException':
+            forget_stream(stream_name)
+        if code not in THROTTLE_ERROR_CODES:
+            raise
+        return [{'ErrorCode': code, 'ErrorMessage': str(err)}
+                for _ in records]
+    metrics.add('KinesisRequests')
+    metrics.add('KinesisBytesSent', sum(
+        entry_size(record) for record in records), 'Bytes')
+    return response['Records']
+
+
+def _record_outcomes(throttle: ThrottleController, entries: list[dict],
+                     results: list[dict]) -> int:
+    '''
+    Reports the records written to and throttled by each shard to the
+    throttle controller.
+
+    Returns:
+        int, the number of records throttled.
+    '''
+    written = Counter()
+    written_bytes = Counter()
+    throttled = Counter()
+    for entry, result in zip(entries, results):
+        if 'ErrorCode' not in result:
+            written[result['ShardId']] += 1
+            written_bytes[result['ShardId']] += entry_size(entry)
+        elif result['ErrorCode'] in THROTTLE_ERROR_CODES:
+            throttled[throttle.shard_id(entry)] += 1
+    for shard_id, count in written.items():
+        throttle.record_success(shard_id, count, written_bytes[shard_id])
+    for shard_id, count in throttled.items():
+        throttle.record_throttle(shard_id, count)
+    return sum(throttled.values())
+
+
+def put_entries(
+        kinesis, stream_name: str,
+        entries: list[dict], max_retries: int = 3,
+        throttle: ThrottleController = None
+        ) -> list[dict]:
+    '''
+    Writes entries to a Kinesis stream using batched PutRecords requests.
+
+    Entries are packed into as few put_records calls as the request limits
+    allow. Only the entries reported as failed (those with an ErrorCode)
+    are resubmitted. Entries throttled by their shard
+    (ProvisionedThroughputExceededException) are requeued and paced by the
+    stream's throttle controller, which slows the throttled shards (see
+    src.throttling); a resend of throttled entries alone does not count
+    against max_retries, up to MAX_THROTTLE_REQUEUES resends. Other
+    failures are resubmitted with an exponential backoff between attempts.
+    Nothing is resent if max_retries is 0.
+
+    Args:
+        stream_name: string specifying data stream to write records to
+        e.g. guardian_content.
+        entries: list of PutRecords entries, each containing the keys
+        Data (bytes) and PartitionKey (str), plus an optional
+        ExplicitHashKey.
+        max_retries: maximum number of times failed entries are resent.
+        throttle: ThrottleController pacing the stream's shards. By
+        default, the stream's controller (see get_throttle_controller).
+
+    Returns:
+        list of result dictionaries in the same order as entries. Each
+        result contains either ShardId and SequenceNumber, or ErrorCode
+        and ErrorMessage if the entry could not be written.
+    '''
+    metrics = get_metrics()
+    throttle = throttle or get_throttle_controller(stream_name, kinesis)
+    results = [None] * len(entries)
+    start = time.perf_counter()
+    for batch in _batch_indices(entries):
+        pending = batch
+        retries = 0
+        requeues = 0
+        while True:
+            records = [entries[index] for index in pending]
+            delay = throttle.reserve(records)
+            if delay:
+                time.sleep(min(delay, MAX_THROTTLE_DELAY))
+            response = _put_records(kinesis, stream_name, records, metrics)
+            failed = []
+            for index, result in zip(pending, response):
+                results[index] = result
+                if 'ErrorCode' in result:
+                    failed.append(index)
+            throttled = _record_outcomes(throttle, records, response)
+            if throttled:
+                metrics.add('KinesisThrottles', throttled)
+            if not failed or max_retries == 0:
+                break
+            if (throttled == len(failed)
+                    and requeues < MAX_THROTTLE_REQUEUES):
+                requeues += 1
+                metrics.add('KinesisRequeues', len(failed))
+            elif retries < max_retries:
+                retries += 1
+                time.sleep(RETRY_BASE_DELAY * 2 ** (retries - 1))
+                metrics.add('KinesisRetries', len(failed))
+            else:
+                break
+            pending = failed
+    written = sum('ErrorCode' not in result for result in results)
+    elapsed = time.perf_counter() - start
+    if written and elapsed > 0:
+        metrics.record('KinesisThroughput', round(written / elapsed, 1),
+                       'Count/Second')
+    return results
+
+
+def put_grouped_entries(
+        kinesis, stream_name: str, entries: list[dict],
+        group, max_retries: int = 3) -> list[dict]:
+    '''
+    Writes entries to a Kinesis stream after packing them into fewer
+    records.
+
+    Args:
+        stream_name: string specifying data stream to write records to
+        e.g. guardian_content.
+        entries: list of PutRecords entries, each containing the keys
+        Data (bytes) and PartitionKey (str), plus an optional
+        ExplicitHashKey.
+        group: function packing a list of entries, returning a list of
+        (entry, indices) tuples (e.g. aggregate_entries).
+        max_retries: maximum number of times failed records are resent.
+
+    Returns:
+        list of result dictionaries in the same order as entries; every
+        entry packed into the same record shares its result.
+    '''
+    groups = group(entries)
+    results = put_entries(
+        kinesis, stream_name, [entry for entry, _ in groups], max_retries)
+    expanded = [None] * len(entries)
+    for (_, indices), result in zip(groups, results):
+        for index in indices:
+            expanded[index] = result
+    return expanded
+
+
+def put_aggregated_entries(
+        kinesis, stream_name: str,
+        entries: list[dict], max_retries: int = 3,
+        shard_ranges: list = None
+        ) -> list[dict]:
+    '''
+    Writes entries to a Kinesis stream as KPL aggregated records.
+
+    Entries routed to the same shard are packed into aggregated records of
+    up to 1 MB (see src.aggregation), which are then written with
+    put_entries. Kinesis limits and bills each shard per record, so
+    packing several small entries into one record raises the number of
+    entries each shard can accept. Consumers must de-aggregate the records
+    (the KCL does this automatically).
+
+    Args:
+        shard_ranges: list of the (starting hash key, ending hash key)
+        tuples of the stream's shards. By default, those listed for the
+        stream (see get_stream_shards), so sub-records are only packed
+        with others routed to the shard which receives the record.
+
+    Returns:
+        list of result dictionaries in the same order as entries; every
+        entry packed into the same aggregated record shares its result.
+    '''
+    shard_ranges = shard_ranges or _stream_shard_ranges(kinesis, stream_name)
+    return put_grouped_entries(
+        kinesis, stream_name, entries,
+        lambda group: aggregate_entries(group, shard_ranges=shard_ranges),
+        max_retries)
+
+
+def put_compressed_entries(
+        kinesis, stream_name: str, entries: list[dict],
+        compression: str = 'gzip', max_retries: int = 3,
+        shard_ranges: list = None) -> list[dict]:
+    '''
+    Writes entries to a Kinesis stream as compressed batch envelopes.
+
+    Entries routed to the same shard are packed into envelopes of up to
+    1 MB, compressed with compression ('gzip' or 'zstd'), which reduces
+    the bytes written to (and billed by) each shard. Consumers decode the
+    records with src.serialization.decode_records.
+
+    Args:
+        shard_ranges: list of the (starting hash key, ending hash key)
+        tuples of the stream's shards. By default, those listed for the
+        stream (see get_stream_shards), so entries are only packed with
+        others routed to the shard which receives the envelope.
+
+    Returns:
+        list of result dictionaries in the same order as entries; every
+        entry packed into the same envelope shares its result.
+    '''
+    shard_ranges = shard_ranges or _stream_shard_ranges(kinesis, stream_name)
+    return put_grouped_entries(
+        kinesis, stream_name, entries,
+        lambda group: compress_entries(
+            group, compression, shard_ranges=shard_ranges),
+        max_retries)
+
+
+def make_entry(
+        record: dict, partition_key: str,
+        explicit_hash_key: str = None, serializer=None) -> dict:
+    '''
+    Converts a record into a PutRecords entry.
+
+    Args:
+        record: dictionary to be serialised.
+        partition_key: string used to assign the record to a shard.
+        explicit_hash_key: string overriding the hash of the partition key
+        when assigning the record to a shard.
+        serializer: Serializer converting the record to bytes (see
+        src.serialization). By default the record is serialised as json.
+
+    Returns:
+        dict containing the keys Data (bytes), PartitionKey (str) and, if
+        given, ExplicitHashKey (str).
+    '''
+    serializer = serializer or _default_serializer
+    entry = {
+        'Data': serializer.dumps(record),
+        'PartitionKey': partition_key
+    }
+    if explicit_hash_key is not None:
+        entry['ExplicitHashKey'] = explicit_hash_key
+    return entry
+
+
+def summarise_results(results: list[dict]) -> dict:
+    '''
+    Summarises put_entries results by shard.
+
+    Args:
+        results: list of result dictionaries returned by put_entries.
+
+    Returns:
+        dict containing the number of records written to each shard and
+        the number of records which could not be written. For example:
+
+        {
+            'Shards': {'shardId-000000000003': 8},
+            'FailedRecordCount': 2
+        }
+    '''
+    shards = {}
+    failed = 0
+    for result in results:
+        if 'ErrorCode' in result:
+            failed += 1
+        else:
+            shards[result['ShardId']] = shards.get(result['ShardId'], 0) + 1
+    return {'Shards': shards, 'FailedRecordCount': failed}
+
+
 def add_records(
         kinesis, stream_name: str,
-        search_term: str, records: list[dict]
-        ) -> str:
+        search_term: str, records: list[dict],
+        aggregate: bool = False, partitioner=None,
+        serializer=None, compression: str = None
+        ) -> dict:
     '''
     Adds records to a Kinesis stream.
 
     This function adds records to a Kinesis stream using the boto3 client.
+    Records are sent in batched put_records calls rather than one request
+    per record.
 
     Args:
         stream_name: string specifying data stream to write records to
         e.g. guardian_content.
         search_term: string specifying the search term used to filter records.
         records: list of dictionaries containing the filtered results.
-    '''
+        aggregate: bool, if True records are packed into KPL aggregated
+        records (see put_aggregated_entries).
+        partitioner: PartitionStrategy assigning records to shards (see
+        src.partitioning). By default records are partitioned by search
+        term.
+        serializer: Serializer converting records to bytes (see
+        src.serialization). By default records are serialised as json.
+        compression: string naming a codec ('gzip' or 'zstd'); if given,
+        records are packed into compressed batch envelopes (see
+        put_compressed_entries) instead of being aggregated.
 
-    shard_id = 'None'
+    Returns:
+        dict containing the number of records written per shard and the
+        number of failed records (see summarise_results).
+    '''
+    entries = []
     for record in records:
-        record_bytes = json.dumps(record).encode('utf-8')
-        response = kinesis.put_record(
-            StreamName=stream_name,
-            Data=record_bytes,
-            PartitionKey=search_term
-        )
-        shard_id = response['ShardId']
-    return shard_id
+        if partitioner is None:
+            entries.append(make_entry(
+                record, search_term, serializer=serializer))
+            continue
+        keys = partitioner.keys(record, search_term)
+        entries.append(make_entry(
+            record, keys['PartitionKey'], keys.get('ExplicitHashKey'),
+            serializer))
+    if compression:
+        results = put_compressed_entries(
+            kinesis, stream_name, entries, compression)
+    elif aggregate:
+        results = put_aggregated_entries(kinesis, stream_name, entries)
+    else:
+        results = put_entries(kinesis, stream_name, entries)
+    return summarise_results(results)
+
+
+class BufferFullError(RuntimeError):
+    '''
+    Raised when a record cannot be added to a full producer buffer.
+    '''
+
+
+class _Pending:
+    '''
+    An entry waiting in a producer's buffer or in flight.
+    '''
+
+    __slots__ = ('stream_name', 'entry', 'shard', 'size', 'future',
+                 'enqueued', 'attempts', 'requeues', 'not_before')
+
+    def __init__(self, stream_name: str, entry: dict, shard: str,
+                 future: Future, enqueued: float):
+        self.stream_name = stream_name
+        self.entry = entry
+        self.shard = shard
+        self.size = entry_size(entry)
+        self.future = future
+        self.enqueued = enqueued
+        self.attempts = 0
+        self.requeues = 0
+        self.not_before = enqueued
+
+
+class KinesisProducer:
+    '''
+    Long-lived producer writing entries to Kinesis in the background.
+
+    send adds a PutRecords entry to a bounded buffer and returns at once. A
+    worker thread sends the buffer in batched put_records calls when a
+    full request is buffered (MAX_BATCH_RECORDS records or MAX_BATCH_BYTES
+    bytes), when the oldest entry has waited linger seconds, or when flush
+    is called. Up to max_in_flight requests are in flight at once.
+
+    Each entry is assigned to a shard by its hash key, as Kinesis routes
+    it, and each shard is paced to stay under its write limits of
+    SHARD_RECORDS_PER_SECOND records and SHARD_BYTES_PER_SECOND bytes per
+    second, counting the entries in flight. A burst for one shard waits in
+    the buffer rather than being rejected with
+    ProvisionedThroughputExceededException, while other shards are still
+    sent. Should a shard still throttle its entries (e.g. as another
+    producer writes to it), its rate is lowered and then raised again as
+    writes succeed (see src.throttling.ThrottleController), and the
+    throttled entries are requeued, ahead of newer entries, up to
+    MAX_THROTTLE_REQUEUES times without counting against max_retries.
+    Entries which failed for another reason are requeued until they have
+    been resent max_retries times, each time held back for a jittered
+    exponential backoff (from RETRY_BASE_DELAY, at most MAX_THROTTLE_DELAY
+    seconds), so a failing shard is not retried in a tight loop.
+
+    The buffer holds at most capacity entries and capacity_bytes bytes,
+    including those in flight. When it is full, send either waits for
+    space (backpressure='block'), raising BufferFullError if none is freed
+    within its timeout, or raises BufferFullError at once
+    (backpressure='raise').
+
+    Example:
+
+        producer = KinesisProducer(connections_aws.get_message_broker())
+        futures = [producer.send('guardian_content', entry)
+                   for entry in entries]
+        producer.flush()
+        results = [future.result() for future in futures]
+
+    Args:
+        kinesis: boto3 Kinesis client.
+        capacity: int specifying the maximum number of buffered entries.
+        capacity_bytes: int specifying the maximum size of the buffered
+        entries.
+        linger: float specifying the number of seconds an entry may wait
+        for a batch to fill before it is sent.
+        max_in_flight: int specifying the maximum number of concurrent
+        put_records requests.
+        backpressure: string, 'block' or 'raise', selecting what send does
+        when the buffer is full.
+        shard_ranges: list of the (starting hash key, ending hash key)
+        tuples of the stream's shards (see src.partitioning). By default,
+        those of a stream created by create_stream.
+        max_retries: maximum number of times a failed entry is resent.
+        records_per_second, bytes_per_second: the write limits of a shard.
+        throttle: ThrottleController pacing the shards, e.g. one shared by
+        producers writing to the same stream. By default, a controller for
+        shard_ranges at the given limits.
+
+    Raises:
+        ValueError: If backpressure is not 'block' or 'raise'.
+    '''
+
+    def __init__(
+            self, kinesis, capacity: int = PRODUCER_CAPACITY,
+            capacity_bytes: int = PRODUCER_CAPACITY_BYTES,
+            linger: float = PRODUCER_LINGER,
+            max_in_flight: int = PRODUCER_MAX_IN_FLIGHT,
+            backpressure: str = 'block', shard_ranges: list = None,
+            max_retries: int = 3,
+            records_per_second: float = SHARD_RECORDS_PER_SECOND,
+            bytes_per_second: float = SHARD_BYTES_PER_SECOND,
+            throttle: ThrottleController = None, clock=time.monotonic):
+        if backpressure not in ('block', 'raise'):
+            raise ValueError('Parameter (backpressure) must be one of ' +
+                             f"'block' or 'raise', not '{backpressure}'.")
+        self.kinesis = kinesis
+        self.capacity = capacity
+        self.capacity_bytes = capacity_bytes
+        self.linger = linger
+        self.max_in_flight = max_in_flight
+        self.backpressure = backpressure
+        self.max_retries = max_retries
+        self._clock = clock
+        self.throttle = throttle or ThrottleController(
+            shard_ranges or even_shard_ranges(SHARD_COUNT),
+            records_per_second, bytes_per_second, paced=True, clock=clock)
+        self._condition = threading.Condition()
+        self._buffer = deque()
+        self._in_flight = Counter()
+        self._requests = 0
+        self._outstanding = 0
+        self._outstanding_bytes = 0
+        self._flushing = 0
+        self._closed = False
+        self._stats = {
+            'sent': 0, 'failed': 0, 'retried': 0, 'throttled': 0,
+            'requests': 0, 'buffer_full': 0,
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix='kinesis-put')
+        self._worker = threading.Thread(
+            target=self._run, name='kinesis-producer', daemon=True)
+        self._worker.start()
+
+    def send(self, stream_name: str, entry: dict,
+             timeout: float = None) -> Future:
+        '''
+        Adds an entry to the buffer.
+
+        Args:
+            stream_name: string specifying the data stream.
+            entry: PutRecords entry containing Data (bytes), PartitionKey
+            (str) and an optional ExplicitHashKey (str), e.g. from
+            make_entry.
+            timeout: float specifying the maximum number of seconds to
+            wait for space when backpressure is 'block', or None to wait
+            as long as required.
+
+        Returns:
+            Future resolved with the entry's PutRecords result, containing
+            either ShardId and SequenceNumber, or ErrorCode and
+            ErrorMessage if it could not be written. The future raises the
+            exception if the request itself failed.
+
+        Raises:
+            BufferFullError: If the buffer is full.
+            RuntimeError: If the producer is closed.
+        '''
+        future = Future()
+        pending = _Pending(stream_name, entry, self.throttle.shard_id(entry),
+                           future, self._clock())
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The producer is closed.')
+            if not self._has_space(pending.size):
+                self._stats['buffer_full'] += 1
+                if self.backpressure == 'raise' or not \
+                        self._condition.wait_for(
+                            lambda: self._closed
+                            or self._has_space(pending.size), timeout):
+                    raise BufferFullError(
+                        f'The producer buffer is full ({self._outstanding} '
+                        'entries).')
+                if self._closed:
+                    raise RuntimeError('The producer is closed.')
+            pending.enqueued = self._clock()
+            self._buffer.append(pending)
+            self._outstanding += 1
+            self._outstanding_bytes += pending.size
+            self._condition.notify_all()
+        return future
+
+    def _has_space(self, size: int) -> bool:
+        # An entry larger than the byte capacity is accepted into an empty
+        # buffer, so it is not refused for ever.
+        return self._outstanding < self.capacity and (
+            self._outstanding == 0
+            or self._outstanding_bytes + size <= self.capacity_bytes)
+
+    def flush(self, timeout: float = None) -> bool:
+        '''
+        Sends every buffered entry and waits for the requests in flight.
+
+        Returns:
+            bool, True if every entry was sent within timeout seconds (or
+            None to wait as long as required).
+        '''
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(
+                    lambda: self._outstanding == 0, timeout)
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout: float = None) -> bool:
+        '''
+        Flushes the producer and stops its worker thread. Entries sent
+        after the producer is closed are refused.
+
+        Returns:
+            bool, True if every entry was sent (see flush).
+        '''
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join(timeout)
+        self._executor.shutdown(wait=flushed)
+        return flushed
+
+    def get_stats(self) -> dict:
+        '''
+        Returns:
+            dict containing the number of entries 'buffered' and
+            'in_flight' (also per shard, in 'in_flight_by_shard'), and the
+            number of entries 'sent', 'failed' (not written after every
+            retry), 'retried' and 'throttled' (requeued after
+            ProvisionedThroughputExceededException), of put_records
+            'requests', and of sends which found the buffer full
+            ('buffer_full'). The rate of each shard and the effective
+            throughput are reported by the throttle controller (see
+            self.throttle.get_stats).
+        '''
+        with self._condition:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+            stats['in_flight'] = sum(self._in_flight.values())
+            stats['in_flight_by_shard'] = {
+                shard: count for shard, count in self._in_flight.items()
+                if count}
+        return stats
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if self._closed and not self._buffer:
+                    return
+                wait = self._dispatch()
+                if wait != 0:
+                    self._condition.wait(wait)
+
+    def _dispatch(self) -> float:
+        '''
+        Sends the next batch if one is ready. Called with the lock held.
+
+        Returns:
+            float, 0 if a batch was sent, otherwise the number of seconds
+            to wait before the next batch may be ready (None to wait until
+            notified).
+        '''
+        if not self._buffer or self._requests >= self.max_in_flight:
+            return None
+        now = self._clock()
+        buffered_bytes = sum(pending.size for pending in self._buffer)
+        age = now - self._buffer[0].enqueued
+        if not (len(self._buffer) >= MAX_BATCH_RECORDS
+                or buffered_bytes >= MAX_BATCH_BYTES
+                or age >= self.linger or self._flushing or self._closed):
+            return self.linger - age
+        batch, wait = self._take_batch(now)
+        if not batch:
+            return wait
+        self._requests += 1
+        for pending in batch:
+            self._in_flight[pending.shard] += 1
+        self._executor.submit(self._send, batch)
+        return 0
+
+    def _take_batch(self, now: float) -> tuple[list, float]:
+        '''
+        Removes the entries of the next request from the buffer: entries
+        for the stream of the oldest entry, in order, within the request
+        limits and the budget of each shard, leaving entries whose retry
+        backoff has not passed. Once an entry for a shard is held back,
+        later entries for the shard are too, so each shard's entries are
+        written in order.
+
+        Returns:
+            tuple of the list of entries taken, and the number of seconds
+            until a held back entry may be sent.
+        '''
+        stream_name = self._buffer[0].stream_name
+        batch = []
+        kept = deque()
+        held = set()
+        batch_bytes = 0
+        wait = None
+        for pending in self._buffer:
+            if (pending.stream_name != stream_name or pending.shard in held
+                    or len(batch) == MAX_BATCH_RECORDS
+                    or batch_bytes + pending.size > MAX_BATCH_BYTES):
+                kept.append(pending)
+                continue
+            if pending.not_before > now:
+                held.add(pending.shard)
+                shard_wait = pending.not_before - now
+                wait = shard_wait if wait is None else min(wait, shard_wait)
+                kept.append(pending)
+                continue
+            if not self.throttle.take(pending.shard, pending.size):
+                held.add(pending.shard)
+                shard_wait = self.throttle.wait_time(
+                    pending.shard, pending.size)
+                wait = shard_wait if wait is None else min(wait, shard_wait)
+                kept.append(pending)
+                continue
+            batch.append(pending)
+            batch_bytes += pending.size
+        self._buffer = kept
+        return batch, wait
+
+    def _send(self, batch: list):
+        '''
+        Writes a batch with put_records on an executor thread, resolving
+        the future of each entry written (or failed after every retry) and
+        requeuing the other failed entries.
+        '''
+        metrics = get_metrics()
+        entries = [pending.entry for pending in batch]
+        try:
+            results = _put_records(
+                self.kinesis, batch[0].stream_name, entries, metrics)
+            throttled = _record_outcomes(self.throttle, entries, results)
+        except Exception as err:
+            results = None
+            throttled = 0
+            error = err
+        done = []
+        requeued = []
+        retried = 0
+        for index, pending in enumerate(batch):
+            code = None if results is None else \
+                results[index].get('ErrorCode')
+            if results is None or code is None:
+                done.append((pending, None if results is None
+                             else results[index]))
+            elif (code in THROTTLE_ERROR_CODES
+                    and pending.requeues < MAX_THROTTLE_REQUEUES):
+                pending.requeues += 1
+                requeued.append(pending)
+            elif pending.attempts < self.max_retries:
+                pending.attempts += 1
+                backoff = min(MAX_THROTTLE_DELAY,
+                              RETRY_BASE_DELAY * 2 ** (pending.attempts - 1))
+                pending.not_before = self._clock() + random.uniform(
+                    backoff / 2, backoff)
+                retried += 1
+                requeued.append(pending)
+            else:
+                done.append((pending, results[index]))
+        with self._condition:
+            self._requests -= 1
+            self._stats['requests'] += 1
+            for pending in batch:
+                self._in_flight[pending.shard] -= 1
+            for pending, result in done:
+                self._outstanding -= 1
+                self._outstanding_bytes -= pending.size
+                if result is None or 'ErrorCode' in result:
+                    self._stats['failed'] += 1
+                else:
+                    self._stats['sent'] += 1
+            self._stats['retried'] += retried
+            self._stats['throttled'] += len(requeued) - retried
+            self._buffer.extendleft(reversed(requeued))
+            self._condition.notify_all()
+        if retried:
+            metrics.add('KinesisRetries', retried)
+        if throttled:
+            metrics.add('KinesisThrottles', throttled)
+        for pending, result in done:
+            if result is None:
+                pending.future.set_exception(error)
+            else:
+                pending.future.set_result(result)
@@ -0,0 +1,195 @@
+import functools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = 'GuardianStreaming'
+SERVICE = 'streaming-data-nc'
+MAX_SAMPLES = 100
+
+logger = logging.getLogger('GuardianMetrics')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(_handler)
+
+_cold_start = True
+_metrics = None
+
+
+class Metrics:
+    '''
+    Collects the metrics of a single invocation.
+
+    Durations are recorded as samples, so a stage which runs several times
+    (e.g. one Guardian request per page) reports its runs; counters are
+    summed. EMF accepts at most MAX_SAMPLES values per metric, so once a
+    metric has that many samples a uniform random sample of MAX_SAMPLES
+    is kept (reservoir sampling), and the number of samples recorded is
+    reported as <name>Samples. Metrics may be recorded from several
+    threads. emit writes them
+    as a single CloudWatch Embedded Metric Format (EMF) log line, from
+    which CloudWatch extracts the metrics without any API calls.
+
+    Args:
+        cold_start: bool, True for the first invocation of a container.
+        properties: values logged alongside the metrics, e.g. stream id.
+    '''
+
+    def __init__(self, cold_start: bool = False, **properties):
+        self.cold_start = cold_start
+        self.properties = properties
+        self._lock = threading.Lock()
+        self._units = {}
+        self._values = {}
+        self._counts = {}
+        self._random = random.Random()
+
+    def add(self, name: str, value: float = 1, unit: str = 'Count'):
+        '''
+        Adds value to the counter name.
+        '''
+        with self._lock:
+            self._units[name] = unit
+            self._values[name] = self._values.get(name, 0) + value
+
+    def record(self, name: str, value: float, unit: str = 'Milliseconds'):
+        '''
+        Records a sample of the metric name.
+        '''
+        with self._lock:
+            self._units[name] = unit
+            samples = self._values.setdefault(name, [])
+            count = self._counts[name] = self._counts.get(name, 0) + 1
+            if len(samples) < MAX_SAMPLES:
+                samples.append(value)
+                return
+            index = self._random.randrange(count)
+            if index < MAX_SAMPLES:
+                samples[index] = value
+
+    @contextmanager
+    def timer(self, stage: str):
+        '''
+        Records the duration of the enclosed block as <stage>Duration, in
+        milliseconds, whether or not it raises.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(f'{stage}Duration',
+                        round((time.perf_counter() - start) * 1000, 3))
+
+    def get(self, name: str):
+        '''
+        Returns:
+            the total of a counter, the list of samples of a duration, or
+            None if nothing has been recorded.
+        '''
+        with self._lock:
+            value = self._values.get(name)
+            return list(value) if isinstance(value, list) else value
+
+    def to_emf(self, namespace: str = NAMESPACE) -> dict:
+        '''
+        Returns:
+            dict in CloudWatch Embedded Metric Format, with the metrics
+            under a single Service dimension and cold start flag.
+        '''
+        with self._lock:
+            values = {name: list(value) if isinstance(value, list)
+                      else value for name, value in self._values.items()}
+            units = dict(self._units)
+            for name, count in self._counts.items():
+                if count > MAX_SAMPLES:
+                    values[f'{name}Samples'] = count
+                    units[f'{name}Samples'] = 'Count'
+        values['ColdStart'] = int(self.cold_start)
+        units['ColdStart'] = 'Count'
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]}
+                                for name in values]
+                }]
+            },
+            'Service': SERVICE,
+            **self.properties,
+            **values
+        }
+
+    def emit(self):
+        '''
+        Writes the metrics to the GuardianMetrics logger as EMF JSON.
+        '''
+        logger.info(json.dumps(self.to_emf()))
+
+
+def start_invocation(**properties) -> Metrics:
+    '''
+    Starts collecting metrics for a new invocation.
+
+    The first invocation after the module is imported is flagged as a
+    cold start.
+
+    Returns:
+        Metrics, which is also returned by get_metrics until the next
+        invocation starts.
+    '''
+    global _cold_start, _metrics
+    _metrics = Metrics(_cold_start, **properties)
+    _cold_start = False
+    return _metrics
+
+
+def get_metrics() -> Metrics:
+    '''
+    Returns the metrics of the current invocation. Outside an invocation
+    a collector is created which is never emitted.
+    '''
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def set_stream(stream):
+    '''
+    Redirects the metrics lines, which are written to stdout by default,
+    e.g. to stderr when the handler is run locally.
+
+    Returns:
+        the stream previously used.
+    '''
+    return _handler.setStream(stream)
+
+
+def timer(stage: str):
+    '''
+    Times a block as a stage of the current invocation (see
+    Metrics.timer).
+    '''
+    return get_metrics().timer(stage)
+
+
+def timed(stage: str):
+    '''
+    Decorator timing every call of a function as a stage of the current
+    invocation.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,287 @@
+import bisect
+import hashlib
+import itertools
+import os
+import threading
+
+MAX_HASH_KEY = 2 ** 128 - 1
+
+
+def _hash_key(partition_key: str) -> int:
+    '''
+    Returns the 128-bit hash key Kinesis assigns to a partition key.
+    '''
+    return int.from_bytes(
+        hashlib.md5(partition_key.encode('utf-8')).digest(), 'big')
+
+
+def entry_hash_key(entry: dict) -> int:
+    '''
+    Returns the hash key Kinesis uses to route a PutRecords entry: its
+    ExplicitHashKey if it has one, otherwise the hash of its PartitionKey.
+    '''
+    if 'ExplicitHashKey' in entry:
+        return int(entry['ExplicitHashKey'])
+    return _hash_key(entry['PartitionKey'])
+
+
+def even_shard_ranges(shard_count: int) -> list[tuple[int, int]]:
+    '''
+    Returns the hash key ranges of a stream with shard_count evenly split
+    shards, as created by create_stream.
+
+    Returns:
+        list of (starting hash key, ending hash key) tuples, one per shard.
+    '''
+    size = (MAX_HASH_KEY + 1) // shard_count
+    ranges = [(index * size, (index + 1) * size - 1)
+              for index in range(shard_count)]
+    ranges[-1] = (ranges[-1][0], MAX_HASH_KEY)
+    return ranges
+
+
+class ShardRouter:
+    '''
+    Assigns entries to shards by their hash key, as Kinesis routes them.
+
+    Args:
+        shard_ranges: list of (starting hash key, ending hash key) tuples
+        ordered by starting hash key, e.g. from get_shard_ranges or
+        even_shard_ranges.
+        shard_ids: list of the id of each shard in shard_ranges, e.g. from
+        get_shards. By default, shards are named after their position in
+        the list, e.g. shardId-000000000003, as in a newly created stream.
+    '''
+
+    def __init__(self, shard_ranges: list[tuple[int, int]],
+                 shard_ids: list[str] = None):
+        self._starts = [start for start, _ in shard_ranges]
+        self._ids = shard_ids or [
+            f'shardId-{index:012d}' for index in range(len(shard_ranges))]
+
+    def shard_id(self, entry: dict) -> str:
+        index = bisect.bisect_right(self._starts, entry_hash_key(entry)) - 1
+        return self._ids[max(index, 0)]
+
+
+def group_by_shard(
+        entries: list[dict],
+        shard_ranges: list[tuple[int, int]] = None) -> list[list[int]]:
+    '''
+    Groups PutRecords entries by the shard Kinesis routes them to.
+
+    Args:
+        entries: list of PutRecords entries.
+        shard_ranges: list of (starting hash key, ending hash key) tuples of
+        the stream's shards. If None, entries are grouped by hash key, so
+        each group is routed to a single shard whatever the stream's
+        shards.
+
+    Returns:
+        list of the positions in entries of each group, ordered by their
+        first entry. Positions keep their order within a group.
+    '''
+    route = entry_hash_key if shard_ranges is None else \
+        ShardRouter(shard_ranges).shard_id
+    groups = {}
+    for index, entry in enumerate(entries):
+        groups.setdefault(route(entry), []).append(index)
+    return list(groups.values())
+
+
+def get_shards(kinesis, stream_name: str) -> list[tuple]:
+    '''
+    Returns the ids and hash key ranges of the open shards of a Kinesis
+    stream.
+
+    Returns:
+        list of (shard id, (starting hash key, ending hash key)) tuples,
+        one per open shard, ordered by starting hash key.
+    '''
+    shards = []
+    kwargs = {'StreamName': stream_name}
+    while True:
+        response = kinesis.list_shards(**kwargs)
+        for shard in response['Shards']:
+            if 'EndingSequenceNumber' in shard['SequenceNumberRange']:
+                continue
+            hash_range = shard['HashKeyRange']
+            shards.append((shard['ShardId'],
+                           (int(hash_range['StartingHashKey']),
+                            int(hash_range['EndingHashKey']))))
+        if not response.get('NextToken'):
+            return sorted(shards, key=lambda shard: shard[1])
+        kwargs = {'NextToken': response['NextToken']}
+
+
+def get_shard_ranges(kinesis, stream_name: str) -> list[tuple[int, int]]:
+    '''
+    Returns the hash key ranges of the open shards of a Kinesis stream.
+
+    Returns:
+        list of (starting hash key, ending hash key) tuples, one per open
+        shard, ordered by starting hash key.
+    '''
+    return [hash_range for _, hash_range in get_shards(kinesis, stream_name)]
+
+
+class PartitionStrategy:
+    '''
+    Base class for strategies assigning records to shards.
+
+    A strategy returns the PartitionKey (and optionally ExplicitHashKey) of
+    the PutRecords entry for a record. Kinesis only orders records within a
+    shard, so each strategy documents which records keep their relative
+    order.
+    '''
+
+    def keys(self, record: dict, search_term: str) -> dict:
+        '''
+        Returns:
+            dict containing PartitionKey and optionally ExplicitHashKey.
+        '''
+        raise NotImplementedError
+
+
+class TermPartitioner(PartitionStrategy):
+    '''
+    Partitions by search term (the original behaviour).
+
+    Ordering: every record for a term is written to the same shard, in
+    order. A popular term concentrates its load on that one shard.
+    '''
+
+    def keys(self, record: dict, search_term: str) -> dict:
+        return {'PartitionKey': search_term}
+
+
+class UrlHashPartitioner(PartitionStrategy):
+    '''
+    Partitions by a hash of the record's webUrl.
+
+    Ordering: only records for the same article keep their relative
+    order; records for different articles, including those from the same
+    term, may be read in any order. Load is spread evenly across shards.
+    '''
+
+    def keys(self, record: dict, search_term: str) -> dict:
+        url = str(record.get('webUrl', ''))
+        return {'PartitionKey': hashlib.sha1(
+            url.encode('utf-8')).hexdigest()}
+
+
+class RoundRobinPartitioner(PartitionStrategy):
+    '''
+    Assigns records to shards in turn using explicit hash keys.
+
+    Each hash key is the midpoint of a shard's hash key range, so records
+    are split exactly evenly across the shards. If the stream is resharded
+    the keys remain valid, but the split may no longer be even.
+
+    Ordering: none between records; consecutive records are written to
+    different shards.
+
+    Args:
+        shard_ranges: list of (starting hash key, ending hash key) tuples,
+        e.g. from get_shard_ranges or even_shard_ranges.
+    '''
+
+    def __init__(self, shard_ranges: list[tuple[int, int]]):
+        self.hash_keys = [str((start + end) // 2)
+                          for start, end in shard_ranges]
+        self._lock = threading.Lock()
+        self._cycle = itertools.cycle(range(len(self.hash_keys)))
+
+    def keys(self, record: dict, search_term: str) -> dict:
+        with self._lock:
+            index = next(self._cycle)
+        return {'PartitionKey': search_term,
+                'ExplicitHashKey': self.hash_keys[index]}
+
+
+class SaltedTermPartitioner(PartitionStrategy):
+    '''
+    Partitions by search term plus a salt derived from the webUrl.
+
+    Each term is spread across up to salts partition keys of the form
+    '<search_term>#<salt>'. The salt is a hash of the webUrl, so the same
+    article always receives the same key.
+
+    Ordering: records for the same article keep their relative order, and
+    consumers can recover per-term order by merging the salts partitions
+    of a term.
+
+    Args:
+        salts: int specifying the number of partition keys per term.
+    '''
+
+    def __init__(self, salts: int = 16):
+        self.salts = salts
+
+    def keys(self, record: dict, search_term: str) -> dict:
+        url = str(record.get('webUrl', ''))
+        salt = _hash_key(url) % self.salts
+        return {'PartitionKey': f'{search_term}#{salt}'}
+
+
+def shard_distribution(
+        strategy: PartitionStrategy, records: list[dict], search_term: str,
+        shard_ranges: list[tuple[int, int]]) -> list[int]:
+    '''
+    Reports how a strategy would distribute records across shards.
+
+    No records are written; the shard of each record is calculated from
+    its ExplicitHashKey, or the MD5 hash of its PartitionKey.
+
+    Args:
+        strategy: PartitionStrategy to evaluate.
+        records: list of sample records.
+        search_term: string specifying the search term of the records.
+        shard_ranges: list of (starting hash key, ending hash key) tuples.
+
+    Returns:
+        list containing the number of records assigned to each shard, in
+        the same order as shard_ranges.
+    '''
+    counts = [0] * len(shard_ranges)
+    for record in records:
+        keys = strategy.keys(record, search_term)
+        if 'ExplicitHashKey' in keys:
+            hash_key = int(keys['ExplicitHashKey'])
+        else:
+            hash_key = _hash_key(keys['PartitionKey'])
+        for index, (start, end) in enumerate(shard_ranges):
+            if start <= hash_key <= end:
+                counts[index] += 1
+                break
+    return counts
+
+
+def get_partition_strategy(shard_count: int) -> PartitionStrategy:
+    '''
+    Returns the partitioning strategy selected by the environment.
+
+    The strategy is chosen by the PARTITION_STRATEGY variable:
+        - 'term' (default): TermPartitioner.
+        - 'url': UrlHashPartitioner.
+        - 'round_robin': RoundRobinPartitioner over shard_count evenly
+          split shards.
+        - 'salted': SaltedTermPartitioner with PARTITION_SALTS salts
+          (default 16).
+
+    Raises:
+        ValueError: If PARTITION_STRATEGY names an unknown strategy.
+    '''
+    strategy = os.environ.get('PARTITION_STRATEGY', 'term')
+    if strategy == 'term':
+        return TermPartitioner()
+    if strategy == 'url':
+        return UrlHashPartitioner()
+    if strategy == 'round_robin':
+        return RoundRobinPartitioner(even_shard_ranges(shard_count))
+    if strategy == 'salted':
+        return SaltedTermPartitioner(
+            int(os.environ.get('PARTITION_SALTS', 16)))
+    raise ValueError('Parameter (PARTITION_STRATEGY) must be one of ' +
+                     "'term', 'url', 'round_robin' or 'salted', " +
+                     f"not '{strategy}'.")
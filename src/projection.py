@@ -0,0 +1,100 @@
+import functools
+from operator import itemgetter
+
+
+class FieldProjector:
+    '''
+    Copies a fixed set of fields out of records.
+
+    The field spec is compiled once into operator.itemgetter lookups, so
+    projecting a record costs one lookup per field rather than a scan of
+    every key of the record. Fields missing from a record are left out of
+    its projection, as are nested fields whose parent is missing or not a
+    dict.
+
+    Args:
+        fields: iterable of field specs, each either a path string or a
+        (path, name) tuple, or a dict mapping paths to names. A path names
+        a top-level key, or a nested key with dots between the levels,
+        e.g. 'fields.bodyText'. Fields are output under their name, which
+        defaults to the last part of the path.
+
+    Raises:
+        ValueError: If a path is empty or two fields share a name.
+    '''
+
+    def __init__(self, fields):
+        if isinstance(fields, dict):
+            fields = fields.items()
+        specs = []
+        for field in fields:
+            path, name = (field, None) if isinstance(field, str) else field
+            keys = tuple(path.split('.'))
+            if not all(keys):
+                raise ValueError(
+                    f'Parameter (fields) contains an invalid path: {path}.')
+            specs.append((keys, name or keys[-1]))
+        self.names = tuple(name for _, name in specs)
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('Parameter (fields) contains duplicate names.')
+        self._specs = tuple(
+            (name, keys[:-1], keys[-1]) for keys, name in specs)
+        keys = [key for _, _, key in self._specs]
+        self._flat = bool(keys) and all(
+            not parents for _, parents, _ in self._specs)
+        # itemgetter returns a bare value, not a tuple, for a single key.
+        self._getter = itemgetter(*keys, *keys[:1]) if self._flat else None
+
+    def project(self, record: dict) -> dict:
+        '''
+        Returns:
+            dict containing the record's values for the fields present in
+            it, under their names.
+        '''
+        if self._flat:
+            try:
+                return dict(zip(self.names, self._getter(record)))
+            except KeyError:
+                pass
+        result = {}
+        for name, parents, key in self._specs:
+            value = record
+            for parent in parents:
+                value = value.get(parent)
+                if not isinstance(value, dict):
+                    break
+            else:
+                if key in value:
+                    result[name] = value[key]
+        return result
+
+    def project_page(self, records: list[dict]) -> list[dict]:
+        '''
+        Projects a whole page of records.
+
+        When every field is a top-level key, the page is projected in a
+        single pass, and only records missing a field are projected one
+        field at a time.
+
+        Returns:
+            list of projections, in the same order as records.
+        '''
+        if not self._flat:
+            return [self.project(record) for record in records]
+        names = self.names
+        getter = self._getter
+        try:
+            return [dict(zip(names, getter(record))) for record in records]
+        except KeyError:
+            return [self.project(record) for record in records]
+
+
+@functools.lru_cache(maxsize=32)
+def get_projector(fields: tuple) -> FieldProjector:
+    '''
+    Returns the projector for a field spec, compiling it on first use.
+
+    Args:
+        fields: tuple of field specs (see FieldProjector).
+    '''
+    return FieldProjector(fields)
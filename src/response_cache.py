@@ -0,0 +1,280 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CAPACITY = 256
+DEFAULT_DISK_CAPACITY = 1024
+DEFAULT_TTL = 300.0
+UNCACHED_PARAMS = ('api-key',)
+
+logger = logging.getLogger('GuardianLogger')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class CachedResponse:
+    '''
+    A response body held by the cache.
+
+    Args:
+        content: bytes of the response body.
+        etag: string containing the response's ETag header, or None.
+        stored_at: float, the epoch time at which the body was fetched or
+        last revalidated.
+    '''
+
+    __slots__ = ('content', 'etag', 'stored_at')
+
+    def __init__(self, content: bytes, etag: str = None,
+                 stored_at: float = None):
+        self.content = content
+        self.etag = etag
+        self.stored_at = time.time() if stored_at is None else stored_at
+
+    def json(self) -> dict:
+        '''
+        Returns:
+            dict parsed from the body. A new dict is returned on every
+            call, so callers may modify it.
+        '''
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    '''
+    Two-tier cache of Guardian API responses.
+
+    Responses are kept in memory, least recently used first out once
+    capacity is reached, and if a directory is given also written to disk,
+    so a new container on the same host (or a warm one whose memory tier
+    was cleared) can reuse them. A response is fresh for ttl seconds after
+    it is fetched, and is then served without a request. A stale response
+    with an ETag is kept, so the request can be made conditional: if the
+    API answers 304 Not Modified the stored body is reused and becomes
+    fresh again.
+
+    The disk tier holds at most disk_capacity responses, the least
+    recently written removed first, so it cannot fill the limited space
+    of /tmp. The disk tier is best effort: a response which cannot be
+    written (e.g. the disk is full) is logged and kept in memory only,
+    and a directory which cannot be created disables the disk tier.
+
+    Args:
+        capacity: int specifying the number of responses kept in memory.
+        ttl: float specifying the number of seconds a response is fresh.
+        directory: string specifying a directory for the disk tier, e.g.
+        under /tmp, or None to keep responses in memory only.
+        disk_capacity: int specifying the number of responses kept on
+        disk.
+    '''
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY,
+                 ttl: float = DEFAULT_TTL, directory: str = None,
+                 clock=time.time,
+                 disk_capacity: int = DEFAULT_DISK_CAPACITY):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_capacity = disk_capacity
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {
+            'hits': 0, 'revalidated': 0, 'misses': 0, 'bytes_saved': 0,
+        }
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as err:
+                logger.warning(f'Response cache disk tier disabled: {err}')
+                self.directory = None
+
+    @staticmethod
+    def key(params: dict) -> str:
+        '''
+        Returns the cache key of a request: a hash of its parameters in a
+        canonical order, with whitespace in the search term collapsed and
+        the API key left out.
+        '''
+        normalised = {
+            name: ' '.join(str(value).split()) if name == 'q'
+            else str(value)
+            for name, value in params.items()
+            if name not in UNCACHED_PARAMS and value is not None
+        }
+        return hashlib.sha256(json.dumps(
+            normalised, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _read(self, key: str) -> CachedResponse:
+        try:
+            with open(self._path(key), encoding='utf-8') as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return CachedResponse(stored['content'].encode('utf-8'),
+                              stored['etag'], stored['stored_at'])
+
+    def _write(self, key: str, entry: CachedResponse):
+        path = None
+        try:
+            file, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(file, 'w', encoding='utf-8') as stream:
+                json.dump({'content': entry.content.decode('utf-8'),
+                           'etag': entry.etag,
+                           'stored_at': entry.stored_at}, stream)
+            os.replace(path, self._path(key))
+        except OSError as err:
+            logger.warning(f'Response not written to the cache: {err}')
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+            return
+        self._evict_files(key)
+
+    def _evict_files(self, written: str):
+        '''
+        Removes the least recently written responses from the disk tier,
+        other than the one just written, until it holds at most
+        disk_capacity.
+        '''
+        try:
+            files = [entry for entry in os.scandir(self.directory)
+                     if entry.name.endswith('.json')
+                     and entry.name != f'{written}.json']
+            if len(files) < self.disk_capacity:
+                return
+            files.sort(key=lambda entry: entry.stat().st_mtime_ns)
+            for entry in files[:len(files) - self.disk_capacity + 1]:
+                os.remove(entry.path)
+        except OSError as err:
+            logger.warning(f'Response cache not pruned: {err}')
+
+    def _remember(self, key: str, entry: CachedResponse):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def lookup(self, key: str) -> tuple[CachedResponse, bool]:
+        '''
+        Finds a response in memory, then on disk.
+
+        Returns:
+            tuple of the CachedResponse (or None) and a bool which is True
+            if it is fresh. A fresh response is counted as a hit.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.directory:
+            entry = self._read(key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            return None, False
+        fresh = self._clock() - entry.stored_at < self.ttl
+        if fresh:
+            with self._lock:
+                self._stats['hits'] += 1
+                self._stats['bytes_saved'] += len(entry.content)
+        elif entry.etag is None:
+            return None, False
+        return entry, fresh
+
+    def store(self, key: str, content: bytes, etag: str = None):
+        '''
+        Stores a response fetched in full, counting it as a miss.
+        '''
+        entry = CachedResponse(content, etag, self._clock())
+        self._remember(key, entry)
+        with self._lock:
+            self._stats['misses'] += 1
+        if self.directory:
+            self._write(key, entry)
+
+    def revalidate(self, key: str, entry: CachedResponse):
+        '''
+        Marks a stale response as fresh after the API confirmed it is
+        unchanged (304 Not Modified), counting the body not sent as saved.
+        '''
+        entry.stored_at = self._clock()
+        self._remember(key, entry)
+        with self._lock:
+            self._stats['revalidated'] += 1
+            self._stats['bytes_saved'] += len(entry.content)
+        if self.directory:
+            self._write(key, entry)
+
+    def clear(self):
+        '''
+        Removes every response from the memory tier.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        '''
+        Returns:
+            dict containing the number of 'hits' (fresh responses served
+            without a request), 'revalidated' (stale responses confirmed
+            with a 304) and 'misses' (responses fetched in full), the
+            'hit_ratio' of responses served without a body being sent, and
+            the response 'bytes_saved'.
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+        stats['hit_ratio'] = (
+            (stats['hits'] + stats['revalidated']) / lookups
+            if lookups else 0.0)
+        return stats
+
+
+def get_response_cache() -> ResponseCache:
+    '''
+    Returns the response cache selected by the environment.
+
+    The cache is enabled by setting RESPONSE_CACHE_TTL to the number of
+    seconds a response is fresh. RESPONSE_CACHE_SIZE sets the number of
+    responses kept in memory (default 256), RESPONSE_CACHE_PATH a
+    directory for the disk tier, e.g. /tmp/guardian-cache, and
+    RESPONSE_CACHE_DISK_SIZE the number of responses kept there (default
+    1024). The cache is
+    kept for the lifetime of the process, so it is shared by warm
+    invocations.
+
+    Returns:
+        ResponseCache, or None if RESPONSE_CACHE_TTL is not set.
+    '''
+    global _cache
+    ttl = os.environ.get('RESPONSE_CACHE_TTL')
+    if not ttl:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                int(os.environ.get('RESPONSE_CACHE_SIZE', DEFAULT_CAPACITY)),
+                float(ttl), os.environ.get('RESPONSE_CACHE_PATH') or None,
+                disk_capacity=int(os.environ.get(
+                    'RESPONSE_CACHE_DISK_SIZE', DEFAULT_DISK_CAPACITY)))
+        return _cache
+
+
+def reset_response_cache():
+    '''
+    Discards the cache kept for the lifetime of the process. Responses
+    written to the disk tier are kept.
+    '''
+    global _cache
+    with _cache_lock:
+        _cache = None
@@ -0,0 +1,248 @@
+import functools
+import gzip
+import importlib
+import json
+import os
+import struct
+from src.aggregation import deaggregate, is_aggregated
+from src.partitioning import group_by_shard
+
+FORMAT_MSGPACK = 0x01
+FORMAT_GZIP = 0x02
+FORMAT_ZSTD = 0x03
+MAX_ENVELOPE_SIZE = 1024 * 1024
+ENVELOPE_MARGIN = 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _optional_module(name: str):
+    '''
+    Imports an optional package on first use, so the codecs which are not
+    selected are never loaded.
+
+    Returns:
+        the module, or None if the package is not installed.
+    '''
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def _require(name: str, feature: str):
+    '''
+    Returns:
+        the module of an optional package.
+
+    Raises:
+        ImportError: If the package is not installed.
+    '''
+    module = _optional_module(name)
+    if module is None:
+        raise ImportError(f'The {feature} requires the {name} package.')
+    return module
+
+
+class Serializer:
+    '''
+    Base class for serializers converting a record to the Data of a
+    Kinesis record.
+
+    JSON payloads carry no header, so existing consumers can keep reading
+    them directly; they are recognised by their first byte ('{' or '[').
+    Every other format starts with a header byte identifying it, so
+    decode_records can detect the format automatically.
+    '''
+
+    name = None
+
+    def dumps(self, record: dict) -> bytes:
+        raise NotImplementedError
+
+
+class JsonSerializer(Serializer):
+    '''Serializes records with the standard library json module.'''
+
+    name = 'json'
+
+    def dumps(self, record: dict) -> bytes:
+        return json.dumps(record).encode('utf-8')
+
+
+class FastJsonSerializer(Serializer):
+    '''Serializes records as compact JSON with orjson.'''
+
+    name = 'fastjson'
+
+    def __init__(self):
+        self._orjson = _require('orjson', 'fastjson serializer')
+
+    def dumps(self, record: dict) -> bytes:
+        return self._orjson.dumps(record)
+
+
+class MessagePackSerializer(Serializer):
+    '''Serializes records as MessagePack, after the FORMAT_MSGPACK byte.'''
+
+    name = 'msgpack'
+
+    def __init__(self):
+        self._msgpack = _require('msgpack', 'msgpack serializer')
+
+    def dumps(self, record: dict) -> bytes:
+        return bytes([FORMAT_MSGPACK]) + self._msgpack.packb(record)
+
+
+SERIALIZERS = {
+    serializer.name: serializer
+    for serializer in (JsonSerializer, FastJsonSerializer,
+                       MessagePackSerializer)
+}
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == 'gzip':
+        return bytes([FORMAT_GZIP]) + gzip.compress(data, mtime=0)
+    if compression == 'zstd':
+        zstandard = _require('zstandard', 'zstd compression')
+        return bytes([FORMAT_ZSTD]) + \
+            zstandard.ZstdCompressor().compress(data)
+    raise ValueError('Parameter (compression) must be one of ' +
+                     f"'gzip' or 'zstd', not '{compression}'.")
+
+
+def _decompress(data: bytes) -> bytes:
+    if data[0] == FORMAT_GZIP:
+        return gzip.decompress(data[1:])
+    zstandard = _require('zstandard', 'zstd compression')
+    return zstandard.ZstdDecompressor().decompress(data[1:])
+
+
+def compress_entries(
+        entries: list[dict], compression: str = 'gzip',
+        max_size: int = MAX_ENVELOPE_SIZE,
+        shard_ranges: list[tuple[int, int]] = None
+        ) -> list[tuple[dict, list[int]]]:
+    '''
+    Packs PutRecords entries into compressed batch envelopes.
+
+    Each envelope is a header byte identifying the codec, followed by the
+    compressed payloads of its entries, each prefixed with its length as a
+    4-byte big-endian integer. Repeated field names compress well, so an
+    envelope is much smaller than the sum of its payloads. Only entries
+    routed to the same shard share an envelope, so the envelope (which
+    takes the keys of its first entry) is written to the shard of every
+    entry it holds. Entries for each shard are packed in order until the
+    uncompressed size would reach max_size (less a margin for codec
+    overhead), so each envelope stays within the 1 MB record limit.
+
+    Args:
+        entries: list of PutRecords entries, each containing Data (bytes),
+        PartitionKey (str) and an optional ExplicitHashKey (str).
+        compression: string naming the codec, 'gzip' or 'zstd'.
+        max_size: int specifying the maximum size of an envelope.
+        shard_ranges: list of the (starting hash key, ending hash key)
+        tuples of the stream's shards (see src.partitioning). If None,
+        only entries with the same hash key share an envelope.
+
+    Returns:
+        list of (entry, indices) tuples, ordered by their first index,
+        where indices lists the positions in entries of the payloads
+        packed into entry.
+    '''
+    groups = []
+    payloads = []
+    indices = []
+    size = 0
+    limit = max_size - ENVELOPE_MARGIN
+
+    def close_group():
+        first = entries[indices[0]]
+        data = _compress(b''.join(payloads), compression)
+        envelope = dict(first, Data=data)
+        groups.append((envelope, list(indices)))
+        payloads.clear()
+        indices.clear()
+
+    for shard in group_by_shard(entries, shard_ranges):
+        size = 0
+        for index in shard:
+            entry = entries[index]
+            payload = struct.pack('>I', len(entry['Data'])) + entry['Data']
+            if indices and size + len(payload) > limit:
+                close_group()
+                size = 0
+            payloads.append(payload)
+            indices.append(index)
+            size += len(payload)
+        close_group()
+    groups.sort(key=lambda group: group[1][0])
+    return groups
+
+
+def decode_records(data: bytes) -> list[dict]:
+    '''
+    Decodes the Data of a Kinesis record, detecting its format.
+
+    Handles JSON, MessagePack, compressed batch envelopes and KPL
+    aggregated records (see src.aggregation), in any combination.
+
+    Args:
+        data: bytes containing the Data of a Kinesis record.
+
+    Returns:
+        list of the records contained in data.
+    '''
+    if not data:
+        return []
+    if is_aggregated(data):
+        return [record
+                for user_record in deaggregate(data)
+                for record in decode_records(user_record['Data'])]
+    if data[0] in (FORMAT_GZIP, FORMAT_ZSTD):
+        payloads = _decompress(data)
+        records = []
+        position = 0
+        while position < len(payloads):
+            (length,) = struct.unpack('>I', payloads[position:position + 4])
+            position += 4
+            records.extend(decode_records(
+                payloads[position:position + length]))
+            position += length
+        return records
+    if data[0] == FORMAT_MSGPACK:
+        msgpack = _require('msgpack', 'msgpack serializer')
+        return [msgpack.unpackb(data[1:])]
+    return [json.loads(data)]
+
+
+def get_serializer(name: str = None) -> Serializer:
+    '''
+    Returns the serializer with the given name, or the one selected by the
+    SERIALIZER environment variable ('json' by default).
+
+    Raises:
+        ValueError: If the name is unknown.
+        ImportError: If the serializer's package is not installed.
+    '''
+    name = name or os.environ.get('SERIALIZER', 'json')
+    if name not in SERIALIZERS:
+        raise ValueError('Parameter (SERIALIZER) must be one of ' +
+                         f"{', '.join(map(repr, SERIALIZERS))}, " +
+                         f"not '{name}'.")
+    return SERIALIZERS[name]()
+
+
+def get_compression() -> str:
+    '''
+    Returns the codec selected by the COMPRESSION environment variable
+    ('gzip' or 'zstd'), or None if records are not compressed.
+
+    Raises:
+        ValueError: If the codec is unknown.
+    '''
+    compression = os.environ.get('COMPRESSION') or None
+    if compression not in (None, 'gzip', 'zstd'):
+        raise ValueError('Parameter (COMPRESSION) must be one of ' +
+                         f"'gzip' or 'zstd', not '{compression}'.")
+    return compression
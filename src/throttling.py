@@ -0,0 +1,274 @@
+import threading
+import time
+from src.partitioning import ShardRouter
+
+SHARD_RECORDS_PER_SECOND = 1000
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+DEFAULT_DECREASE_FACTOR = 0.5
+DEFAULT_INCREASE = 0.05
+MIN_RATE_FRACTION = 0.01
+THROTTLE_ERROR_CODES = ('ProvisionedThroughputExceededException',)
+
+
+def entry_size(entry: dict) -> int:
+    '''
+    Returns the size of a PutRecords entry counted against the request
+    and shard limits: its data plus its partition key.
+    '''
+    return len(entry['Data']) + len(entry['PartitionKey'].encode('utf-8'))
+
+
+class ShardBudget:
+    '''
+    Token buckets pacing the records and bytes written to one shard,
+    refilled continuously at the given rates and holding at most one
+    second's worth.
+    '''
+
+    def __init__(self, records_per_second: float, bytes_per_second: float,
+                 now: float):
+        self.records_per_second = records_per_second
+        self.bytes_per_second = bytes_per_second
+        self.records = records_per_second
+        self.bytes = bytes_per_second
+        self._updated = now
+
+    def set_rates(self, records_per_second: float, bytes_per_second: float):
+        self.records_per_second = records_per_second
+        self.bytes_per_second = bytes_per_second
+        self.records = min(self.records, records_per_second)
+        self.bytes = min(self.bytes, bytes_per_second)
+
+    def drain(self):
+        '''
+        Spends every token, e.g. once the shard has reported that its
+        capacity for the second is used.
+        '''
+        self.records = min(self.records, 0.0)
+        self.bytes = min(self.bytes, 0.0)
+
+    def refill(self, now: float):
+        elapsed = max(0.0, now - self._updated)
+        self._updated = now
+        self.records = min(self.records_per_second,
+                           self.records + elapsed * self.records_per_second)
+        self.bytes = min(self.bytes_per_second,
+                         self.bytes + elapsed * self.bytes_per_second)
+
+    def take(self, size: int) -> bool:
+        '''
+        Spends the tokens for one record of size bytes, if there are
+        enough.
+        '''
+        size = min(size, self.bytes_per_second)
+        if self.records < 1 or self.bytes < size:
+            return False
+        self.records -= 1
+        self.bytes -= size
+        return True
+
+    def reserve(self, size: int) -> float:
+        '''
+        Spends the tokens for one record of size bytes, going into debt if
+        there are not enough.
+
+        Returns:
+            float, the seconds to wait before the record is sent.
+        '''
+        self.records -= 1
+        self.bytes -= min(size, self.bytes_per_second)
+        return max(-self.records / self.records_per_second,
+                   -self.bytes / self.bytes_per_second, 0.0)
+
+    def wait_time(self, size: int) -> float:
+        '''
+        Returns the seconds until a record of size bytes can be taken.
+        '''
+        size = min(size, self.bytes_per_second)
+        return max((1 - self.records) / self.records_per_second,
+                   (size - self.bytes) / self.bytes_per_second, 0.0)
+
+
+class ThrottleController:
+    '''
+    Adapts the rate at which each shard of a stream is written with AIMD
+    (additive increase, multiplicative decrease).
+
+    Each shard is written at a fraction of its write limits. When a write
+    to a shard is throttled (ProvisionedThroughputExceededException), the
+    shard's fraction is multiplied by decrease_factor, down to
+    MIN_RATE_FRACTION; each successful write raises it by increase, back
+    up to the limits. Rates are kept per shard, so a hot shard is slowed
+    without slowing the others. Shards are identified by the ShardId
+    returned for a written record, or for a throttled record (which has
+    none) by its hash key (see src.partitioning.ShardRouter), so
+    shard_ranges and shard_ids must be those of the stream.
+
+    Unless paced is True, a shard is not paced until it is first
+    throttled, so writes which stay within the limits are never delayed.
+
+    Args:
+        shard_ranges: list of the (starting hash key, ending hash key)
+        tuples of the stream's shards (see src.partitioning).
+        records_per_second, bytes_per_second: the write limits of a shard.
+        decrease_factor: float by which a throttled shard's rate is
+        multiplied.
+        increase: float, the fraction of the limits added to a shard's
+        rate by each successful write.
+        paced: bool, if True every shard is paced from its first write.
+        shard_ids: list of the id of each shard in shard_ranges (see
+        src.partitioning.get_shards). By default, those of a newly created
+        stream.
+    '''
+
+    def __init__(
+            self, shard_ranges: list,
+            records_per_second: float = SHARD_RECORDS_PER_SECOND,
+            bytes_per_second: float = SHARD_BYTES_PER_SECOND,
+            decrease_factor: float = DEFAULT_DECREASE_FACTOR,
+            increase: float = DEFAULT_INCREASE, paced: bool = False,
+            clock=time.monotonic, shard_ids: list = None):
+        self.records_per_second = records_per_second
+        self.bytes_per_second = bytes_per_second
+        self.decrease_factor = decrease_factor
+        self.increase = increase
+        self.paced = paced
+        self._clock = clock
+        self._router = ShardRouter(shard_ranges, shard_ids)
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._started = None
+
+    def shard_id(self, entry: dict) -> str:
+        '''
+        Returns the shard a PutRecords entry is routed to.
+        '''
+        return self._router.shard_id(entry)
+
+    def _shard(self, shard_id: str, now: float) -> dict:
+        shard = self._shards.get(shard_id)
+        if shard is None:
+            shard = self._shards[shard_id] = {
+                'fraction': 1.0, 'budget': None, 'throttles': 0,
+                'records': 0, 'bytes': 0,
+            }
+            if self.paced:
+                shard['budget'] = ShardBudget(
+                    self.records_per_second, self.bytes_per_second, now)
+        if shard['budget'] is not None:
+            shard['budget'].refill(now)
+        return shard
+
+    def take(self, shard_id: str, size: int) -> bool:
+        '''
+        Spends a shard's budget for one record of size bytes, for callers
+        which hold the record back if it cannot be sent yet.
+
+        Returns:
+            bool, True if the record may be sent now.
+        '''
+        with self._lock:
+            budget = self._shard(shard_id, self._clock())['budget']
+            return budget is None or budget.take(size)
+
+    def wait_time(self, shard_id: str, size: int) -> float:
+        '''
+        Returns the seconds until a record of size bytes may be sent to a
+        shard.
+        '''
+        with self._lock:
+            budget = self._shard(shard_id, self._clock())['budget']
+            return 0.0 if budget is None else budget.wait_time(size)
+
+    def reserve(self, entries: list[dict]) -> float:
+        '''
+        Spends the budget of each entry's shard, for callers which send a
+        request once the returned delay has passed.
+
+        Returns:
+            float, the seconds to wait before sending the entries.
+        '''
+        delay = 0.0
+        with self._lock:
+            now = self._clock()
+            for entry in entries:
+                budget = self._shard(self.shard_id(entry), now)['budget']
+                if budget is not None:
+                    delay = max(delay, budget.reserve(entry_size(entry)))
+        return delay
+
+    def _set_fraction(self, shard: dict, fraction: float, now: float):
+        shard['fraction'] = fraction
+        records = self.records_per_second * fraction
+        size = self.bytes_per_second * fraction
+        if shard['budget'] is None:
+            shard['budget'] = ShardBudget(records, size, now)
+        else:
+            shard['budget'].set_rates(records, size)
+
+    def record_success(self, shard_id: str, records: int = 1,
+                       size: int = 0):
+        '''
+        Counts records written to a shard and, if it is paced, raises its
+        rate.
+        '''
+        with self._lock:
+            now = self._clock()
+            if self._started is None:
+                self._started = now
+            shard = self._shard(shard_id, now)
+            shard['records'] += records
+            shard['bytes'] += size
+            if shard['budget'] is not None and shard['fraction'] < 1.0:
+                self._set_fraction(
+                    shard, min(1.0, shard['fraction'] + self.increase), now)
+
+    def record_throttle(self, shard_id: str, records: int = 1):
+        '''
+        Counts records throttled by a shard in one request and lowers its
+        rate.
+        '''
+        with self._lock:
+            now = self._clock()
+            if self._started is None:
+                self._started = now
+            shard = self._shard(shard_id, now)
+            shard['throttles'] += records
+            self._set_fraction(shard, max(
+                MIN_RATE_FRACTION, shard['fraction'] * self.decrease_factor),
+                now)
+            shard['budget'].drain()
+
+    def get_stats(self) -> dict:
+        '''
+        Returns:
+            dict containing the number of records 'throttled' and
+            'written', the 'effective_records_per_second' and
+            'effective_bytes_per_second' written since the first write,
+            and per shard in 'shards', the records 'throttled' and
+            'written' and the current 'records_per_second' (None if the
+            shard is not paced).
+        '''
+        with self._lock:
+            elapsed = 0.0 if self._started is None else \
+                self._clock() - self._started
+            shards = {
+                shard_id: {
+                    'throttled': shard['throttles'],
+                    'written': shard['records'],
+                    'records_per_second': None if shard['budget'] is None
+                    else round(shard['budget'].records_per_second, 1),
+                }
+                for shard_id, shard in self._shards.items()
+            }
+            written = sum(shard['records'] for shard in self._shards.values())
+            size = sum(shard['bytes'] for shard in self._shards.values())
+        return {
+            'throttled': sum(shard['throttled'] for shard in shards.values()),
+            'written': written,
+            'effective_records_per_second':
+                round(written / elapsed, 1) if elapsed else 0.0,
+            'effective_bytes_per_second':
+                round(size / elapsed, 1) if elapsed else 0.0,
+            'shards': shards,
+        }
@@ -2,7 +2,7 @@ from datetime import datetime
 import re
 
 
-def check_date_is_valid(date: str) -> bool:
+def check_date_is_valid(date: str, param_name: str = 'date_from') -> bool:
     '''
     Validate that a given date string meets specific criteria.
 
@@ -14,6 +14,8 @@ def check_date_is_valid(date: str) -> bool:
     Parameters:
         date (str): The date string to be validated,
                     formatted as `YYYY-MM-DD`.
+        param_name (str): The name of the parameter, used in error
+                    messages (default 'date_from').
 
     Returns:
         bool: True if the `date` is valid.
@@ -24,11 +26,11 @@ def check_date_is_valid(date: str) -> bool:
                     or if it is not before the current date.
     '''
     if not isinstance(date, str):
-        raise TypeError('Parameter (date_from) must be of type string.')
+        raise TypeError(f'Parameter ({param_name}) must be of type string.')
 
     if (len(date) != 10) or (re.search(r'\d{4}-\d{2}-\d{2}', date) is None):
         raise ValueError(
-            'Parameter (date_from) must be formatted as %Y-%m-%d.'
+            f'Parameter ({param_name}) must be formatted as %Y-%m-%d.'
             )
 
     date_from = datetime.date(datetime.now())
@@ -36,11 +38,11 @@ def check_date_is_valid(date: str) -> bool:
         date_from = datetime.strptime(date, '%Y-%m-%d')
     except ValueError:
         raise ValueError(
-            'Parameter (date_from) must be formatted as %Y-%m-%d.'
+            f'Parameter ({param_name}) must be formatted as %Y-%m-%d.'
         )
     if date_from >= datetime.now():
         raise ValueError(
-            'Parameter (date_from) must be before current date.'
+            f'Parameter ({param_name}) must be before current date.'
             )
     return True
 
@@ -74,3 +76,55 @@ def check_id_string_is_valid(id: str, param_name: str) -> bool:
         raise ValueError(f'Parameter ({param_name}) cannot contain ' +
                          'only whitespace.')
     return True
+
+
+def check_positive_int_is_valid(value: int, param_name: str) -> bool:
+    '''
+    Validate that a given value is a positive integer.
+
+    This function checks whether the provided `value` parameter is an
+    integer greater than zero. If the `value` does not meet these criteria,
+    an appropriate exception is raised.
+
+    Parameters:
+        value (int): The value to be validated.
+        param_name (str): The name of the parameter,
+                          used in error messages for clarity.
+
+    Returns:
+        bool: True if the `value` is valid.
+
+    Raises:
+        TypeError: If `value` is not of type `int`.
+        ValueError: If `value` is less than one.
+    '''
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError(f'Parameter ({param_name}) must be of type integer.')
+    if value < 1:
+        raise ValueError(f'Parameter ({param_name}) must be a ' +
+                         'positive integer.')
+    return True
+
+
+def check_list_is_valid(value: list, param_name: str) -> bool:
+    '''
+    Validate that a given value is a non-empty list.
+
+    Parameters:
+        value (list): The value to be validated.
+        param_name (str): The name of the parameter,
+                          used in error messages for clarity.
+
+    Returns:
+        bool: True if the `value` is valid.
+
+    Raises:
+        TypeError: If `value` is not of type `list`.
+        ValueError: If `value` is an empty list.
+    '''
+    if not isinstance(value, list):
+        raise TypeError(f'Parameter ({param_name}) must be of type list.')
+    if len(value) == 0:
+        raise ValueError(f'Parameter ({param_name}) cannot be ' +
+                         'an empty list.')
+    return True
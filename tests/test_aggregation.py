@@ -0,0 +1,135 @@
+import hashlib
+import pytest
+from src.aggregation import (
+    RecordAggregator, aggregate_entries, deaggregate, is_aggregated,
+    KPL_MAGIC, _encode_varint, _decode_varint
+)
+from src.partitioning import ShardRouter, even_shard_ranges
+
+
+def make_entries(count, size=100, partition_key='key'):
+    return [{'Data': bytes([index % 256]) * size,
+             'PartitionKey': partition_key}
+            for index in range(count)]
+
+
+class TestVarint:
+
+    @pytest.mark.parametrize('value', [0, 1, 127, 128, 300, 2 ** 63])
+    def test_round_trips_value(self, value):
+        encoded = _encode_varint(value)
+        assert _decode_varint(encoded, 0) == (value, len(encoded))
+
+    def test_matches_protobuf_encoding(self):
+        assert _encode_varint(300) == b'\xac\x02'
+
+
+class TestRecordAggregator:
+
+    def test_output_has_magic_and_md5_digest(self):
+        aggregator = RecordAggregator()
+        aggregator.add(b'data', 'key')
+        data = aggregator.flush()['Data']
+        assert data.startswith(KPL_MAGIC)
+        message = data[len(KPL_MAGIC):-16]
+        assert data[-16:] == hashlib.md5(message).digest()
+
+    def test_flush_returns_none_when_empty(self):
+        assert RecordAggregator().flush() is None
+
+    def test_round_trips_records_and_keys(self):
+        aggregator = RecordAggregator()
+        aggregator.add(b'first', 'key-1')
+        aggregator.add(b'second', 'key-2', '12345')
+        aggregator.add(b'third', 'key-1')
+        entry = aggregator.flush()
+        assert entry['PartitionKey'] == 'key-1'
+        assert 'ExplicitHashKey' not in entry
+        assert deaggregate(entry['Data']) == [
+            {'Data': b'first', 'PartitionKey': 'key-1',
+             'ExplicitHashKey': None},
+            {'Data': b'second', 'PartitionKey': 'key-2',
+             'ExplicitHashKey': '12345'},
+            {'Data': b'third', 'PartitionKey': 'key-1',
+             'ExplicitHashKey': None},
+        ]
+
+    def test_fits_respects_max_size(self):
+        aggregator = RecordAggregator(max_size=300)
+        entries = make_entries(10)
+        added = 0
+        for entry in entries:
+            if not aggregator.fits(entry['Data'], entry['PartitionKey']):
+                break
+            aggregator.add(entry['Data'], entry['PartitionKey'])
+            added += 1
+        output = aggregator.flush()
+        assert added == 2
+        size = len(output['Data']) + len(output['PartitionKey'])
+        assert size <= 300
+
+
+class TestAggregateEntries:
+
+    def test_packs_entries_within_size_limit(self):
+        entries = make_entries(100, size=1000)
+        groups = aggregate_entries(entries, max_size=10000)
+        assert len(groups) > 1
+        indices = []
+        for entry, group in groups:
+            assert len(entry['Data']) + len(entry['PartitionKey']) <= 10000
+            indices.extend(group)
+        assert indices == list(range(100))
+
+    def test_preserves_records_in_order(self):
+        entries = make_entries(50)
+        output = []
+        for entry, _ in aggregate_entries(entries, max_size=2000):
+            output.extend(record['Data']
+                          for record in deaggregate(entry['Data']))
+        assert output == [entry['Data'] for entry in entries]
+
+    def test_single_entry_is_not_aggregated(self):
+        entries = make_entries(1)
+        assert aggregate_entries(entries) == [(entries[0], [0])]
+
+    def test_oversized_entry_is_sent_alone(self):
+        entries = make_entries(1, size=500) + make_entries(1, size=50)
+        groups = aggregate_entries(entries, max_size=200)
+        assert groups == [(entries[0], [0]), (entries[1], [1])]
+
+    def test_packs_only_entries_for_the_same_shard(self):
+        shard_ranges = even_shard_ranges(4)
+        router = ShardRouter(shard_ranges)
+        entries = [{'Data': b'x' * 10, 'PartitionKey': f'key-{index}'}
+                   for index in range(200)]
+        groups = aggregate_entries(entries, shard_ranges=shard_ranges)
+        assert len(groups) == 4
+        for entry, indices in groups:
+            assert {router.shard_id(entries[index])
+                    for index in indices} == {router.shard_id(entry)}
+        assert sorted(index for _, indices in groups
+                      for index in indices) == list(range(200))
+
+    def test_packs_only_entries_with_the_same_key_by_default(self):
+        entries = make_entries(3, partition_key='a') + \
+            make_entries(3, partition_key='b')
+        groups = aggregate_entries(entries)
+        assert [indices for _, indices in groups] == [[0, 1, 2], [3, 4, 5]]
+        assert [entry['PartitionKey'] for entry, _ in groups] == ['a', 'b']
+
+
+class TestDeaggregate:
+
+    def test_returns_plain_record_unchanged(self):
+        assert deaggregate(b'{"webUrl": "x"}', 'key') == [
+            {'Data': b'{"webUrl": "x"}', 'PartitionKey': 'key',
+             'ExplicitHashKey': None}]
+
+    def test_invalid_digest_is_not_aggregated(self):
+        aggregator = RecordAggregator()
+        aggregator.add(b'data', 'key')
+        data = aggregator.flush()['Data']
+        corrupted = data[:-1] + bytes([data[-1] ^ 0xff])
+        assert is_aggregated(data)
+        assert not is_aggregated(corrupted)
@@ -0,0 +1,292 @@
+from moto import mock_aws
+import boto3
+import json
+import logging
+import os
+import pytest
+import responses
+from datetime import date, timedelta
+from urllib.parse import parse_qs, urlparse
+from unittest.mock import patch
+from src.backfill import split_date_range, fetch_window, backfill
+from src.checkpoint import SQLiteCheckpointStore
+from src.connections_aws import connections_aws
+from src.lambda_handler import backfill_handler
+from src.message_broker import forget_stream
+from src.metrics import get_metrics
+from src.serialization import decode_records
+
+URL = 'https://content.guardianapis.com/search'
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    connections_aws.clear_cache()
+    forget_stream()
+    yield
+    connections_aws.clear_cache()
+    forget_stream()
+
+
+@pytest.fixture(scope='function')
+def mock_broker(aws_credentials):
+    with mock_aws():
+        yield boto3.client('kinesis', region_name='eu-west-2')
+
+
+def guardian_api(per_day, fail_from=None):
+    '''
+    Mocks the Guardian API with per_day articles on every day, newest
+    first. Requests for windows starting on or after fail_from fail.
+    '''
+    def callback(request):
+        params = parse_qs(urlparse(request.url).query)
+        start = date.fromisoformat(params['from-date'][0])
+        end = date.fromisoformat(params['to-date'][0])
+        if fail_from is not None and start >= date.fromisoformat(fail_from):
+            return (404, {}, '')
+        page = int(params['page'][0])
+        page_size = int(params['page-size'][0])
+        articles = [
+            {'webPublicationDate':
+                f'{day}T{index // 60:02d}:{index % 60:02d}:00Z',
+             'webTitle': f'Article {index}',
+             'webUrl': f'https://example.com/{day}/{index}'}
+            for offset in range((end - start).days, -1, -1)
+            for day in [start + timedelta(days=offset)]
+            for index in range(per_day - 1, -1, -1)
+        ]
+        body = {'response': {
+            'pages': max(1, -(-len(articles) // page_size)),
+            'currentPage': page,
+            'results': articles[(page - 1) * page_size:page * page_size]
+        }}
+        return (200, {}, json.dumps(body))
+    responses.add_callback(responses.GET, URL, callback=callback)
+
+
+def read_stream(kinesis, stream_name):
+    records = []
+    response = kinesis.describe_stream(StreamName=stream_name)
+    for shard in response['StreamDescription']['Shards']:
+        iterator = kinesis.get_shard_iterator(
+            StreamName=stream_name, ShardId=shard['ShardId'],
+            ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+        for record in kinesis.get_records(ShardIterator=iterator)['Records']:
+            records.extend(decode_records(record['Data']))
+    return records
+
+
+class TestSplitDateRange:
+
+    def test_splits_range_into_windows(self):
+        assert split_date_range('2024-01-01', '2024-01-10', 4) == [
+            ('2024-01-01', '2024-01-04'),
+            ('2024-01-05', '2024-01-08'),
+            ('2024-01-09', '2024-01-10'),
+        ]
+
+    def test_single_day_range(self):
+        assert split_date_range('2024-01-01', '2024-01-01') == \
+            [('2024-01-01', '2024-01-01')]
+
+    def test_raises_value_error_for_reversed_range(self):
+        with pytest.raises(ValueError, match='cannot be before'):
+            split_date_range('2024-01-10', '2024-01-01')
+
+
+class TestFetchWindow:
+
+    @responses.activate
+    def test_returns_records_oldest_first(self):
+        guardian_api(per_day=3)
+        records = fetch_window('key', 'football',
+                               ('2024-01-01', '2024-01-02'))
+        dates = [record['webPublicationDate'] for record in records]
+        assert len(records) == 6
+        assert dates == sorted(dates)
+        assert all(record['keyword'] == 'football' for record in records)
+
+    @responses.activate
+    def test_splits_window_with_too_many_pages(self):
+        guardian_api(per_day=150)
+        records = fetch_window('key', 'football',
+                               ('2024-01-01', '2024-01-08'), max_pages=2)
+        dates = [record['webPublicationDate'] for record in records]
+        assert len(records) == 8 * 150
+        assert dates == sorted(dates)
+        for call in responses.calls:
+            params = parse_qs(urlparse(call.request.url).query)
+            assert int(params['page'][0]) <= 2
+
+    @responses.activate
+    def test_truncates_single_day_with_too_many_pages(self, caplog):
+        guardian_api(per_day=500)
+        with caplog.at_level(logging.WARNING):
+            records = fetch_window('key', 'football',
+                                   ('2024-01-01', '2024-01-01'), max_pages=2)
+            assert 'truncated to 2 of 3 pages' in caplog.text
+        assert len(records) == 400
+
+
+class TestBackfill:
+
+    @responses.activate
+    def test_streams_every_window_in_order(self, mock_broker, tmp_path):
+        guardian_api(per_day=2)
+        checkpoints = SQLiteCheckpointStore(str(tmp_path / 'marks.db'))
+        summary = backfill('key', 'football', '2024-01-01', '2024-01-20',
+                           'test_stream', mock_broker, window_days=7,
+                           checkpoints=checkpoints)
+        assert summary['windows'] == 3
+        assert summary['completed'] == 3
+        assert summary['records'] == 40
+        assert summary['resume_from'] is None
+        records = read_stream(mock_broker, 'test_stream')
+        dates = [record['webPublicationDate'] for record in records]
+        assert dates == sorted(dates)
+        assert checkpoints.get_watermark(
+            'backfill:football:2024-01-01', 'test_stream') == '2024-01-20'
+
+    @responses.activate
+    def test_resumes_from_first_incomplete_window(
+            self, mock_broker, tmp_path):
+        checkpoints = SQLiteCheckpointStore(str(tmp_path / 'marks.db'))
+        with patch('src.guardian_api.time.sleep'):
+            guardian_api(per_day=1, fail_from='2024-01-08')
+            summary = backfill(
+                'key', 'football', '2024-01-01', '2024-01-20',
+                'test_stream', mock_broker, window_days=7,
+                checkpoints=checkpoints)
+        assert summary['completed'] == 1
+        assert summary['resume_from'] == '2024-01-08'
+        assert summary['error'] is not None
+
+        responses.reset()
+        guardian_api(per_day=1)
+        summary = backfill('key', 'football', '2024-01-01', '2024-01-20',
+                           'test_stream', mock_broker, window_days=7,
+                           checkpoints=checkpoints)
+        assert summary['skipped'] == 1
+        assert summary['completed'] == 2
+        assert summary['records'] == 13
+        assert len(read_stream(mock_broker, 'test_stream')) == 20
+
+    @responses.activate
+    def test_earlier_range_is_not_skipped(self, mock_broker, tmp_path):
+        guardian_api(per_day=1)
+        checkpoints = SQLiteCheckpointStore(str(tmp_path / 'marks.db'))
+        backfill('key', 'football', '2024-01-10', '2024-01-20',
+                 'test_stream', mock_broker, window_days=7,
+                 checkpoints=checkpoints)
+        summary = backfill('key', 'football', '2024-01-01', '2024-01-09',
+                           'test_stream', mock_broker, window_days=7,
+                           checkpoints=checkpoints)
+        assert summary['skipped'] == 0
+        assert summary['completed'] == 2
+        assert summary['records'] == 9
+        assert len(read_stream(mock_broker, 'test_stream')) == 20
+
+    def test_nothing_fetched_when_range_complete(self, tmp_path):
+        checkpoints = SQLiteCheckpointStore(str(tmp_path / 'marks.db'))
+        checkpoints.set_watermark(
+            'backfill:football:2024-01-01', 'test_stream', '2024-01-20')
+        with patch('src.backfill.fetch_window') as mock_fetch:
+            summary = backfill('key', 'football', '2024-01-01',
+                               '2024-01-20', 'test_stream', None,
+                               checkpoints=checkpoints)
+        mock_fetch.assert_not_called()
+        assert summary['skipped'] == 1
+        assert summary['resume_from'] is None
+
+
+class TestBackfillHandler:
+
+    @responses.activate
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_backfills_range_to_stream(
+            self, mock_credentials, mock_kinesis, mock_broker, caplog):
+        guardian_api(per_day=1)
+        mock_kinesis.return_value = mock_broker
+        event = {
+            'search_term': 'football',
+            'date_from': '2024-01-01',
+            'date_to': '2024-01-31',
+            'stream_id': 'test_stream',
+            'window_days': 10
+        }
+        with caplog.at_level(logging.INFO):
+            summary = backfill_handler(event, None)
+            assert '31 records added to stream: test_stream' in caplog.text
+        assert summary['windows'] == 4
+
+    @responses.activate
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_uses_partition_strategy_and_compression(
+            self, mock_credentials, mock_kinesis, mock_broker,
+            monkeypatch):
+        guardian_api(per_day=4)
+        mock_kinesis.return_value = mock_broker
+        monkeypatch.setenv('PARTITION_STRATEGY', 'url')
+        monkeypatch.setenv('COMPRESSION', 'gzip')
+        event = {
+            'search_term': 'football',
+            'date_from': '2024-01-01',
+            'date_to': '2024-01-10',
+            'stream_id': 'test_stream'
+        }
+        summary = backfill_handler(event, None)
+        assert summary['records'] == 40
+        shards = []
+        response = mock_broker.describe_stream(StreamName='test_stream')
+        for shard in response['StreamDescription']['Shards']:
+            iterator = mock_broker.get_shard_iterator(
+                StreamName='test_stream', ShardId=shard['ShardId'],
+                ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+            records = mock_broker.get_records(
+                ShardIterator=iterator)['Records']
+            if records:
+                shards.append(records)
+        assert len(shards) > 1
+        assert all(len(records) == 1 for records in shards)
+        assert len(read_stream(mock_broker, 'test_stream')) == 40
+
+    def test_logs_error_for_reversed_range(self, caplog):
+        event = {
+            'search_term': 'football',
+            'date_from': '2024-02-01',
+            'date_to': '2024-01-01',
+            'stream_id': 'test_stream'
+        }
+        with patch('src.lambda_handler.connections_aws.get_credentials',
+                   return_value='1234567890'):
+            assert backfill_handler(event, None) is None
+        assert 'Invalid date value (date_to).' in caplog.text
+
+    def test_each_invocation_has_its_own_metrics(self):
+        event = {
+            'search_term': 'football',
+            'date_from': '2024-02-01',
+            'date_to': '2024-01-01',
+            'stream_id': 'test_stream'
+        }
+        for _ in range(2):
+            backfill_handler(event, None)
+        metrics = get_metrics()
+        assert metrics.properties == {'StreamId': 'test_stream'}
+        assert len(metrics.get('InvocationDuration')) == 1
+        assert metrics.get('Errors') == 1
@@ -0,0 +1,206 @@
+from moto import mock_aws
+import boto3
+import io
+import json
+import os
+import pytest
+from src.brokers import (
+    KinesisBroker, LineBroker, JsonlFileBroker, MemoryBroker,
+    SegmentFileBroker, FRAME_HEADER, get_broker, reset_broker, read_segments
+)
+from src.message_broker import forget_stream, make_entry
+from src.serialization import MessagePackSerializer, compress_entries
+
+
+@pytest.fixture(scope='function')
+def aws_credentials():
+    '''Mocked AWS Credentials for moto.'''
+    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    os.environ['AWS_SECURITY_TOKEN'] = 'testing'
+    os.environ['AWS_SESSION_TOKEN'] = 'testing'
+    os.environ['AWS_DEFAULT_REGION'] = 'eu-west-2'
+
+
+@pytest.fixture(autouse=True)
+def clear_streams():
+    forget_stream()
+    reset_broker()
+    yield
+    forget_stream()
+    reset_broker()
+
+
+@pytest.fixture(scope='function')
+def mock_kinesis(aws_credentials):
+    with mock_aws():
+        yield boto3.client('kinesis', region_name='eu-west-2')
+
+
+def _entries(count, serializer=None):
+    return [make_entry({'webTitle': f'title {index}'}, 'term',
+                       serializer=serializer)
+            for index in range(count)]
+
+
+class TestKinesisBroker:
+
+    def test_creates_stream_once_and_puts_records(self, mock_kinesis):
+        broker = KinesisBroker(mock_kinesis)
+        assert broker.ensure_stream('test_stream')
+        assert not broker.ensure_stream('test_stream')
+        results = broker.put('test_stream', _entries(3))
+        assert len(results) == 3
+        assert all('SequenceNumber' in result for result in results)
+
+    def test_uses_given_put_function(self):
+        calls = []
+
+        def put(kinesis, stream_name, entries, max_retries):
+            calls.append((kinesis, stream_name, len(entries), max_retries))
+            return []
+
+        KinesisBroker('client', put).put('test_stream', _entries(2), 0)
+        assert calls == [('client', 'test_stream', 2, 0)]
+
+    def test_recreates_deleted_stream_and_retries_put(self, mock_kinesis):
+        broker = KinesisBroker(mock_kinesis)
+        broker.ensure_stream('test_stream')
+        mock_kinesis.delete_stream(StreamName='test_stream')
+        assert not broker.ensure_stream('test_stream')
+        results = broker.put('test_stream', _entries(3))
+        assert all('SequenceNumber' in result for result in results)
+        assert not broker.ensure_stream('test_stream')
+
+
+class TestLineBroker:
+
+    def test_writes_one_line_per_record(self):
+        file = io.StringIO()
+        results = LineBroker(file).put('test_stream', _entries(2))
+        lines = [json.loads(line) for line in file.getvalue().splitlines()]
+        assert lines == [
+            {'stream_id': 'test_stream', 'partition_key': 'term',
+             'record': {'webTitle': f'title {index}'}}
+            for index in range(2)
+        ]
+        assert [result['SequenceNumber'] for result in results] == \
+            ['1', '2']
+
+    def test_decodes_serialized_and_compressed_entries(self):
+        pytest.importorskip('msgpack')
+        file = io.StringIO()
+        entries = _entries(3, MessagePackSerializer())
+        envelopes = [entry for entry, _ in compress_entries(entries)]
+        results = LineBroker(file).put('test_stream', envelopes)
+        assert len(results) == 1
+        assert len(file.getvalue().splitlines()) == 3
+
+    def test_file_broker_appends_to_file(self, tmp_path):
+        path = tmp_path / 'records.jsonl'
+        for _ in range(2):
+            broker = JsonlFileBroker(str(path))
+            broker.put('test_stream', _entries(2))
+            broker.close()
+        assert len(path.read_text().splitlines()) == 4
+
+
+class TestMemoryBroker:
+
+    def test_keeps_records_in_order(self):
+        broker = MemoryBroker()
+        assert broker.ensure_stream('test_stream')
+        assert not broker.ensure_stream('test_stream')
+        results = broker.put('test_stream', _entries(3))
+        records = broker.records('test_stream')
+        assert [record['SequenceNumber'] for record in records] == \
+            [result['SequenceNumber'] for result in results]
+        assert json.loads(records[0]['Data']) == {'webTitle': 'title 0'}
+
+    def test_ring_buffer_replaces_oldest_records(self):
+        broker = MemoryBroker(capacity=2)
+        broker.put('test_stream', _entries(5))
+        records = broker.records('test_stream')
+        assert [json.loads(record['Data'])['webTitle']
+                for record in records] == ['title 3', 'title 4']
+        assert broker.dropped == 3
+
+    def test_routes_records_by_hash_key(self):
+        broker = MemoryBroker(shard_count=4)
+        results = broker.put('test_stream', [
+            {'Data': b'{}', 'PartitionKey': 'key',
+             'ExplicitHashKey': str(2 ** 127)},
+            {'Data': b'{}', 'PartitionKey': 'key',
+             'ExplicitHashKey': '0'},
+        ])
+        assert [result['ShardId'] for result in results] == \
+            ['shardId-000000000002', 'shardId-000000000000']
+
+
+class TestSegmentFileBroker:
+
+    def test_records_are_read_back_in_order(self, tmp_path):
+        broker = SegmentFileBroker(str(tmp_path))
+        assert broker.ensure_stream('test_stream')
+        entries = _entries(3)
+        results = broker.put('test_stream', entries)
+        broker.close()
+        assert all('SequenceNumber' in result for result in results)
+        assert list(read_segments(str(tmp_path), 'test_stream')) == \
+            [{'PartitionKey': 'term', 'Data': entry['Data']}
+             for entry in entries]
+
+    def test_reopened_stream_is_appended_to(self, tmp_path):
+        for _ in range(2):
+            broker = SegmentFileBroker(str(tmp_path))
+            broker.put('test_stream', _entries(2))
+            broker.close()
+        assert not SegmentFileBroker(str(tmp_path)).ensure_stream(
+            'test_stream')
+        assert len(list(read_segments(str(tmp_path), 'test_stream'))) == 4
+
+    def test_new_segment_started_when_full(self, tmp_path):
+        entries = _entries(5)
+        frame_size = FRAME_HEADER.size + len('term') + \
+            len(entries[0]['Data'])
+        broker = SegmentFileBroker(str(tmp_path), frame_size * 2)
+        broker.put('test_stream', entries)
+        broker.close()
+        assert len(list(tmp_path.glob('test_stream.*.seg'))) == 3
+        assert [record['Data'] for record in
+                read_segments(str(tmp_path), 'test_stream')] == \
+            [entry['Data'] for entry in entries]
+
+    def test_rejects_record_larger_than_segment(self, tmp_path):
+        broker = SegmentFileBroker(str(tmp_path), 16)
+        results = broker.put('test_stream', _entries(1))
+        broker.close()
+        assert results[0]['ErrorCode'] == 'InvalidArgumentException'
+
+    def test_streams_are_kept_apart(self, tmp_path):
+        broker = SegmentFileBroker(str(tmp_path))
+        broker.put('test', _entries(1))
+        broker.put('test.stream', _entries(2))
+        broker.close()
+        assert len(list(read_segments(str(tmp_path), 'test'))) == 1
+
+
+class TestGetBroker:
+
+    def test_kinesis_by_default(self, monkeypatch):
+        monkeypatch.delenv('BROKER', raising=False)
+        assert get_broker() is None
+
+    def test_local_broker_is_kept(self, monkeypatch, tmp_path):
+        monkeypatch.setenv('BROKER', 'memory')
+        broker = get_broker()
+        assert isinstance(broker, MemoryBroker)
+        assert get_broker() is broker
+        monkeypatch.setenv('BROKER', 'segment')
+        monkeypatch.setenv('BROKER_PATH', str(tmp_path))
+        assert isinstance(get_broker(), SegmentFileBroker)
+
+    def test_raises_for_unknown_broker(self, monkeypatch):
+        monkeypatch.setenv('BROKER', 'kafka')
+        with pytest.raises(ValueError, match='must be one of'):
+            get_broker()
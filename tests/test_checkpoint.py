@@ -0,0 +1,82 @@
+from moto import mock_aws
+import boto3
+import pytest
+import os
+from src.checkpoint import (
+    SQLiteCheckpointStore, DynamoDBCheckpointStore, get_checkpoint_store
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope='function')
+def mock_database(aws_credentials):
+    with mock_aws():
+        dynamodb = boto3.client('dynamodb', region_name='eu-west-2')
+        dynamodb.create_table(
+            TableName='checkpoints',
+            KeySchema=[{'AttributeName': 'checkpoint_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'checkpoint_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        yield dynamodb
+
+
+@pytest.fixture(params=['sqlite', 'dynamodb'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        yield SQLiteCheckpointStore(str(tmp_path / 'checkpoints.db'))
+    else:
+        dynamodb = request.getfixturevalue('mock_database')
+        yield DynamoDBCheckpointStore('checkpoints', dynamodb)
+
+
+class TestCheckpointStore:
+
+    def test_returns_none_without_watermark(self, store):
+        assert store.get_watermark('test_term', 'test_stream') is None
+
+    def test_returns_stored_watermark(self, store):
+        store.set_watermark('test_term', 'test_stream', '2024-04-19T09:50:43Z')
+        assert store.get_watermark('test_term', 'test_stream') == \
+            '2024-04-19T09:50:43Z'
+
+    def test_watermark_never_moves_backwards(self, store):
+        store.set_watermark('test_term', 'test_stream', '2024-04-19T09:50:43Z')
+        store.set_watermark('test_term', 'test_stream', '2024-01-01T00:00:00Z')
+        assert store.get_watermark('test_term', 'test_stream') == \
+            '2024-04-19T09:50:43Z'
+
+    def test_watermarks_are_kept_per_term_and_stream(self, store):
+        store.set_watermark('term_1', 'stream_1', '2024-01-01T00:00:00Z')
+        assert store.get_watermark('term_2', 'stream_1') is None
+        assert store.get_watermark('term_1', 'stream_2') is None
+
+
+class TestGetCheckpointStore:
+
+    def test_returns_none_if_not_configured(self, monkeypatch):
+        monkeypatch.delenv('CHECKPOINT_STORE', raising=False)
+        assert get_checkpoint_store() is None
+
+    def test_returns_sqlite_store(self, monkeypatch, tmp_path):
+        path = str(tmp_path / 'checkpoints.db')
+        monkeypatch.setenv('CHECKPOINT_STORE', 'sqlite')
+        monkeypatch.setenv('CHECKPOINT_PATH', path)
+        store = get_checkpoint_store()
+        assert isinstance(store, SQLiteCheckpointStore)
+        assert store.path == path
+
+    def test_raises_error_for_unknown_store(self, monkeypatch):
+        monkeypatch.setenv('CHECKPOINT_STORE', 'redis')
+        with pytest.raises(ValueError):
+            get_checkpoint_store()
@@ -2,6 +2,7 @@ from moto import mock_aws
 import pytest
 import boto3
 import os
+from unittest.mock import patch
 from botocore.exceptions import ClientError, ParamValidationError
 from src.connections_aws import connections_aws
 
@@ -16,6 +17,13 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
 
 
+@pytest.fixture(autouse=True)
+def clear_connections_cache():
+    connections_aws.clear_cache()
+    yield
+    connections_aws.clear_cache()
+
+
 @pytest.fixture(scope='function')
 def mock_credentials(aws_credentials):
     with mock_aws():
@@ -49,3 +57,91 @@ class TestGetGuardianCredentials:
             'Parameter validation failed:\n' +
             'Invalid type for parameter SecretId,'
         ) >= 0
+
+
+class TestClientRegistry:
+
+    def test_reuses_message_broker_client(self, aws_credentials):
+        first = connections_aws.get_message_broker()
+        second = connections_aws.get_message_broker()
+        assert first is second
+        stats = connections_aws.get_cache_stats()
+        assert stats['client_misses'] == 1
+        assert stats['client_hits'] == 1
+
+    def test_clear_cache_creates_new_client(self, aws_credentials):
+        first = connections_aws.get_message_broker()
+        connections_aws.clear_cache()
+        assert connections_aws.get_message_broker() is not first
+
+    def test_create_clients_registers_each_client(self, aws_credentials):
+        connections_aws.create_clients('kinesis', 'secretsmanager')
+        connections_aws.get_message_broker()
+        stats = connections_aws.get_cache_stats()
+        assert stats['client_misses'] == 2
+        assert stats['client_hits'] == 1
+
+    def test_secret_client_has_timeout(self, aws_credentials):
+        connections_aws.create_clients('secretsmanager')
+        client = connections_aws._get_client('secretsmanager')
+        assert client.meta.config.read_timeout == \
+            connections_aws._secret_timeout / 2
+        assert client.meta.config.retries['total_max_attempts'] == 1
+        assert connections_aws.get_cache_stats()['client_misses'] == 1
+
+    def test_secret_timeout_is_capped_and_rounded(self, mock_credentials):
+        mock_credentials.create_secret(
+            Name='Guardian-Key', SecretString='1234567890')
+        connections_aws.create_clients('secretsmanager')
+        connections_aws.get_credentials('Guardian-Key', timeout=30.0)
+        assert connections_aws.get_cache_stats()['client_misses'] == 1
+        connections_aws.invalidate_credentials()
+        connections_aws.get_credentials('Guardian-Key', timeout=0.3)
+        client = connections_aws._get_client('secretsmanager', 1)
+        assert client.meta.config.read_timeout == 0.5
+        assert connections_aws.get_cache_stats()['client_misses'] == 2
+
+
+class TestSecretCache:
+
+    def test_returns_cached_value_within_ttl(self, mock_credentials):
+        mock_credentials.create_secret(
+            Name='Guardian-Key', SecretString='1234567890')
+        connections_aws.get_credentials('Guardian-Key')
+        mock_credentials.put_secret_value(
+            SecretId='Guardian-Key', SecretString='0987654321')
+        assert connections_aws.get_credentials('Guardian-Key') == \
+            '1234567890'
+        stats = connections_aws.get_cache_stats()
+        assert stats['secret_misses'] == 1
+        assert stats['secret_hits'] == 1
+
+    def test_refetches_value_after_ttl(self, mock_credentials):
+        mock_credentials.create_secret(
+            Name='Guardian-Key', SecretString='1234567890')
+        with patch('src.connections_aws.time.monotonic', return_value=0):
+            connections_aws.get_credentials('Guardian-Key')
+        mock_credentials.put_secret_value(
+            SecretId='Guardian-Key', SecretString='0987654321')
+        with patch('src.connections_aws.time.monotonic',
+                   return_value=connections_aws._secret_ttl + 1):
+            assert connections_aws.get_credentials('Guardian-Key') == \
+                '0987654321'
+
+    def test_refetches_value_after_invalidation(self, mock_credentials):
+        mock_credentials.create_secret(
+            Name='Guardian-Key', SecretString='1234567890')
+        connections_aws.get_credentials('Guardian-Key')
+        mock_credentials.put_secret_value(
+            SecretId='Guardian-Key', SecretString='0987654321')
+        connections_aws.invalidate_credentials('Guardian-Key')
+        assert connections_aws.get_credentials('Guardian-Key') == \
+            '0987654321'
+
+    def test_set_value_is_returned_without_secrets_manager(self):
+        connections_aws.set_credentials('Guardian-Key', 'local-key')
+        with patch('src.connections_aws.time.monotonic',
+                   return_value=connections_aws._secret_ttl * 1000):
+            assert connections_aws.get_credentials('Guardian-Key') == \
+                'local-key'
+        assert connections_aws.get_cache_stats()['secret_misses'] == 0
@@ -0,0 +1,56 @@
+import math
+import pytest
+from unittest.mock import MagicMock
+from src.deadline import Deadline
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeadline:
+
+    def test_without_limit_never_expires(self):
+        deadline = Deadline()
+        assert deadline.remaining() == math.inf
+        assert not deadline.expired()
+        assert deadline.budget('fetch', 60.0) == 60.0
+
+    def test_from_context_reads_remaining_time(self):
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 30000
+        deadline = Deadline.from_context(context, reserve=5.0)
+        assert deadline.remaining() == pytest.approx(30.0, abs=0.1)
+        assert deadline.available() == pytest.approx(25.0, abs=0.1)
+
+    def test_from_context_without_remaining_time(self):
+        assert Deadline.from_context(None).remaining() == math.inf
+
+    def test_expires_when_only_reserve_is_left(self):
+        clock = FakeClock()
+        deadline = Deadline(10.0, reserve=4.0, clock=clock)
+        clock.now += 5.9
+        assert not deadline.expired()
+        clock.now += 0.2
+        assert deadline.expired()
+        assert deadline.remaining() == pytest.approx(3.9)
+
+    def test_budget_is_share_of_available_time(self):
+        clock = FakeClock()
+        deadline = Deadline(15.0, reserve=5.0, clock=clock)
+        assert deadline.budget('fetch') == pytest.approx(8.0)
+        assert deadline.budget('stream') == pytest.approx(10.0)
+        assert deadline.budget('secret') == pytest.approx(2.0)
+
+    def test_stage_expires_after_its_share(self):
+        clock = FakeClock()
+        deadline = Deadline(15.0, reserve=5.0, clock=clock)
+        stage = deadline.stage('fetch')
+        clock.now += 8.1
+        assert stage.expired()
+        assert not deadline.expired()
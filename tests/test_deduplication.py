@@ -0,0 +1,144 @@
+import pytest
+from src.deduplication import (
+    Deduplicator, LRUDeduplicator, BloomDeduplicator,
+    get_deduplicator, reset_deduplicator
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_deduplicator():
+    reset_deduplicator()
+    yield
+    reset_deduplicator()
+
+
+def make_records(start, stop):
+    return [{'webUrl': f'https://www.theguardian.com/{index}/'}
+            for index in range(start, stop)]
+
+
+@pytest.fixture(params=[LRUDeduplicator, BloomDeduplicator])
+def deduplicator(request):
+    return request.param(capacity=100)
+
+
+class TestFilterRecords:
+
+    def test_keeps_unseen_records(self, deduplicator):
+        records = make_records(0, 10)
+        assert deduplicator.filter_records(records) == records
+        assert deduplicator.suppressed == 0
+
+    def test_removes_published_records(self, deduplicator):
+        for record in make_records(0, 5):
+            deduplicator.add(record['webUrl'])
+        output = deduplicator.filter_records(make_records(0, 10))
+        assert output == make_records(5, 10)
+        assert deduplicator.suppressed == 5
+
+    def test_removes_repeats_within_records(self, deduplicator):
+        records = make_records(0, 3) + make_records(0, 3)
+        assert deduplicator.filter_records(records) == make_records(0, 3)
+        assert deduplicator.suppressed == 3
+
+    def test_keys_are_separated_by_namespace(self, deduplicator):
+        deduplicator.add('https://www.theguardian.com/0/', 'stream_1')
+        records = make_records(0, 1)
+        assert deduplicator.filter_records(records, 'stream_2') == records
+
+    def test_shares_pending_set_between_calls(self, deduplicator):
+        pending = set()
+        deduplicator.filter_records(make_records(0, 5), pending=pending)
+        output = deduplicator.filter_records(
+            make_records(0, 10), pending=pending)
+        assert output == make_records(5, 10)
+
+
+class TestBoundedIndex:
+
+    def test_lru_evicts_least_recently_seen(self):
+        deduplicator = LRUDeduplicator(capacity=2)
+        deduplicator.add('a')
+        deduplicator.add('b')
+        deduplicator.contains('a')
+        deduplicator.add('c')
+        assert len(deduplicator) == 2
+        assert deduplicator.contains('a')
+        assert not deduplicator.contains('b')
+
+    def test_bloom_forgets_keys_after_two_rotations(self):
+        deduplicator = BloomDeduplicator(capacity=10)
+        deduplicator.add('first')
+        for index in range(20):
+            deduplicator.add(f'key-{index}')
+        assert not deduplicator.contains('first')
+        assert deduplicator.contains('key-19')
+
+    def test_bloom_false_positive_rate_is_bounded(self):
+        deduplicator = BloomDeduplicator(capacity=1000, error_rate=0.01)
+        for index in range(1000):
+            deduplicator.add(f'seen-{index}')
+        false_positives = sum(deduplicator.contains(f'unseen-{index}')
+                              for index in range(1000))
+        assert false_positives < 30
+
+
+class TestPersistence:
+
+    def test_round_trips_through_file(self, deduplicator, tmp_path):
+        path = str(tmp_path / 'index.bin')
+        deduplicator.add('https://www.theguardian.com/0/')
+        deduplicator.save(path)
+        loaded = Deduplicator.load(path)
+        assert type(loaded) is type(deduplicator)
+        assert loaded.contains('https://www.theguardian.com/0/')
+        assert not loaded.contains('https://www.theguardian.com/1/')
+
+    def test_get_deduplicator_loads_saved_index(
+            self, monkeypatch, tmp_path):
+        path = str(tmp_path / 'index.bin')
+        saved = LRUDeduplicator()
+        saved.add('https://www.theguardian.com/0/')
+        saved.save(path)
+        monkeypatch.setenv('DEDUP_MODE', 'lru')
+        monkeypatch.setenv('DEDUP_PATH', path)
+        assert get_deduplicator().contains('https://www.theguardian.com/0/')
+
+    def test_saved_lru_index_is_converted_to_bloom(
+            self, monkeypatch, tmp_path):
+        path = str(tmp_path / 'index.bin')
+        saved = LRUDeduplicator()
+        saved.add('https://www.theguardian.com/0/')
+        saved.save(path)
+        monkeypatch.setenv('DEDUP_MODE', 'bloom')
+        monkeypatch.setenv('DEDUP_PATH', path)
+        deduplicator = get_deduplicator()
+        assert isinstance(deduplicator, BloomDeduplicator)
+        assert deduplicator.contains('https://www.theguardian.com/0/')
+        assert get_deduplicator() is deduplicator
+
+    def test_saved_bloom_index_is_discarded_for_lru(
+            self, monkeypatch, tmp_path, caplog):
+        path = str(tmp_path / 'index.bin')
+        saved = BloomDeduplicator()
+        saved.add('https://www.theguardian.com/0/')
+        saved.save(path)
+        monkeypatch.setenv('DEDUP_MODE', 'lru')
+        monkeypatch.setenv('DEDUP_PATH', path)
+        deduplicator = get_deduplicator()
+        assert isinstance(deduplicator, LRUDeduplicator)
+        assert len(deduplicator) == 0
+        assert get_deduplicator() is deduplicator
+        assert 'Saved deduplication index discarded' in caplog.text
+
+    def test_get_deduplicator_is_reused(self, monkeypatch):
+        monkeypatch.setenv('DEDUP_MODE', 'bloom')
+        monkeypatch.delenv('DEDUP_PATH', raising=False)
+        assert isinstance(get_deduplicator(), BloomDeduplicator)
+        assert get_deduplicator() is get_deduplicator()
+
+    def test_get_deduplicator_raises_error_for_unknown_mode(
+            self, monkeypatch):
+        monkeypatch.setenv('DEDUP_MODE', 'exact')
+        with pytest.raises(ValueError):
+            get_deduplicator()
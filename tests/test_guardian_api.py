@@ -1,17 +1,32 @@
-from src.guardian_api import get_guardian_content, filter_response
+from src.guardian_api import (
+    get_guardian_content, get_all_guardian_content, filter_response,
+    get_session, AsyncGuardianClient, RateLimiter, QuotaExceededError,
+    get_rate_limiter, set_rate_limiter
+)
 from unittest.mock import patch, MagicMock
+import asyncio
+import time
 import requests
+import responses
 import pytest
 import json
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
 
+@pytest.fixture(autouse=True)
+def reset_rate_limiter():
+    set_rate_limiter(None)
+    yield
+    set_rate_limiter(None)
+
+
 class TestGetGuardianContent():
 
-    @patch("src.guardian_api.requests.get")
+    @patch("src.guardian_api.requests.Session.get")
     def test_raises_401_exception_for_invalid_key(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 401
@@ -23,6 +38,282 @@ class TestGetGuardianContent():
             api_key = os.getenv('GUARDIAN_KEY')
             get_guardian_content(api_key, 'football', '2024-01-01')
 
+    def test_shares_persistent_session(self):
+        assert get_session() is get_session()
+
+    @responses.activate
+    def test_requests_use_shared_session(self):
+        responses.add(responses.GET,
+                      'https://content.guardianapis.com/search',
+                      json={'response': {'results': []}})
+        with patch('src.guardian_api.get_session',
+                   wraps=get_session) as mock_session:
+            get_guardian_content('key', 'football', '2024-01-01')
+            get_guardian_content('key', 'football', '2024-01-01')
+        assert mock_session.call_count == 2
+        assert len(responses.calls) == 2
+
+
+class TestAsyncGuardianClient:
+
+    url = 'https://content.guardianapis.com/search'
+
+    @staticmethod
+    def _callback(request):
+        params = parse_qs(urlparse(request.url).query)
+        body = {'response': {
+            'term': params['q'][0],
+            'currentPage': int(params['page'][0]),
+        }}
+        return (200, {}, json.dumps(body))
+
+    @responses.activate
+    def test_gather_returns_responses_in_query_order(self):
+        responses.add_callback(
+            responses.GET, self.url, callback=self._callback)
+        queries = [('football', '2024-01-01', 2),
+                   ('cricket', '2024-01-01', 1),
+                   ('football', '2024-01-01', 1)]
+
+        async def run():
+            async with AsyncGuardianClient('key') as client:
+                return await client.gather(queries)
+
+        output = asyncio.run(run())
+        assert [(page['response']['term'], page['response']['currentPage'])
+                for page in output] == [(term, page)
+                                        for term, _, page in queries]
+
+    @responses.activate
+    def test_gather_can_return_exceptions(self):
+        responses.add(responses.GET, self.url, status=429)
+
+        async def run():
+            async with AsyncGuardianClient('key') as client:
+                return await client.gather(
+                    [('football', '2024-01-01', 1)], return_exceptions=True)
+
+        output = asyncio.run(run())
+        assert isinstance(output[0], requests.exceptions.HTTPError)
+
+    @patch('src.guardian_api._request_content',
+           side_effect=lambda *args: time.sleep(0.5))
+    def test_raises_timeout_error_for_slow_request(self, mock_request):
+        async def run():
+            async with AsyncGuardianClient(
+                    'key', request_timeout=0.05) as client:
+                return await client.get_content('football', '2024-01-01')
+
+        with pytest.raises(TimeoutError):
+            asyncio.run(run())
+
+    @patch('src.guardian_api._request_content',
+           side_effect=lambda *args: time.sleep(0.2))
+    def test_limits_requests_in_flight(self, mock_request):
+        async def run():
+            async with AsyncGuardianClient(
+                    'key', max_connections=2, total_timeout=0.3) as client:
+                return await client.gather(
+                    [('football', '2024-01-01', page) for page in range(4)])
+
+        with pytest.raises(TimeoutError):
+            asyncio.run(run())
+
+    def test_timed_out_request_keeps_its_slot(self):
+        running = []
+        overlapped = []
+
+        def request_content(*args):
+            running.append(1)
+            overlapped.append(len(running) > 1)
+            time.sleep(0.2)
+            running.pop()
+            return {'response': {}}
+
+        async def run():
+            async with AsyncGuardianClient(
+                    'key', max_connections=1,
+                    request_timeout=0.05) as client:
+                with pytest.raises(TimeoutError):
+                    await client.get_content('football', '2024-01-01')
+                with pytest.raises(TimeoutError):
+                    await client.get_content('football', '2024-01-01')
+
+        with patch('src.guardian_api._request_content',
+                   side_effect=request_content):
+            asyncio.run(run())
+        assert overlapped == [False, False]
+
+    @responses.activate
+    @patch('src.guardian_api.time.sleep')
+    def test_retries_stop_at_the_deadline(self, mock_sleep):
+        responses.add(responses.GET, self.url, status=503,
+                      headers={'Retry-After': '5'})
+
+        async def run():
+            async with AsyncGuardianClient(
+                    'key', request_timeout=1.0) as client:
+                return await client.get_content('football', '2024-01-01')
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            asyncio.run(run())
+        mock_sleep.assert_not_called()
+        assert len(responses.calls) == 1
+
+
+class TestGetAllGuardianContent:
+
+    url = 'https://content.guardianapis.com/search'
+
+    @staticmethod
+    def _page_callback(total_pages):
+        def callback(request):
+            params = parse_qs(urlparse(request.url).query)
+            page = int(params['page'][0])
+            body = {'response': {
+                'pages': total_pages,
+                'currentPage': page,
+                'pageSize': int(params['page-size'][0]),
+                'results': [{'webUrl': f'https://example.com/{page}'}]
+            }}
+            return (200, {}, json.dumps(body))
+        return callback
+
+    @responses.activate
+    def test_yields_every_page_in_order(self):
+        responses.add_callback(
+            responses.GET, self.url, callback=self._page_callback(5))
+        pages = list(get_all_guardian_content('key', 'football', '2024-01-01'))
+        assert [page['response']['currentPage'] for page in pages] == \
+            [1, 2, 3, 4, 5]
+        assert len(responses.calls) == 5
+
+    @responses.activate
+    def test_requests_maximum_page_size(self):
+        responses.add_callback(
+            responses.GET, self.url, callback=self._page_callback(2))
+        pages = list(get_all_guardian_content('key', 'football', '2024-01-01'))
+        assert all(page['response']['pageSize'] == 200 for page in pages)
+
+    @responses.activate
+    def test_stops_at_max_pages(self):
+        responses.add_callback(
+            responses.GET, self.url, callback=self._page_callback(50))
+        pages = list(get_all_guardian_content(
+            'key', 'football', '2024-01-01', max_pages=3))
+        assert len(pages) == 3
+        assert len(responses.calls) == 3
+
+    @responses.activate
+    def test_passes_date_to_for_every_page(self):
+        responses.add_callback(
+            responses.GET, self.url, callback=self._page_callback(3))
+        list(get_all_guardian_content(
+            'key', 'football', '2024-01-01', date_to='2024-01-31'))
+        for call in responses.calls:
+            params = parse_qs(urlparse(call.request.url).query)
+            assert params['to-date'] == ['2024-01-31']
+
+    @responses.activate
+    @patch('src.guardian_api.time.sleep')
+    def test_raises_http_error_for_failed_page(self, mock_sleep):
+        responses.add(responses.GET, self.url, status=500)
+        with pytest.raises(requests.exceptions.HTTPError):
+            list(get_all_guardian_content('key', 'football', '2024-01-01'))
+
+
+class TestRateLimiter:
+
+    url = 'https://content.guardianapis.com/search'
+
+    @patch('src.guardian_api.time.sleep')
+    def test_burst_requests_are_not_delayed(self, mock_sleep):
+        rate_limiter = RateLimiter(rate=5)
+        for _ in range(5):
+            rate_limiter.acquire()
+        mock_sleep.assert_not_called()
+        assert rate_limiter.get_stats()['delayed'] == 0
+
+    @patch('src.guardian_api.time.sleep')
+    @patch('src.guardian_api.time.monotonic', return_value=100.0)
+    def test_requests_beyond_burst_are_delayed(
+            self, mock_monotonic, mock_sleep):
+        rate_limiter = RateLimiter(rate=4, burst=1)
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        assert delays == [0.25, 0.5]
+        assert rate_limiter.get_stats()['delayed'] == 2
+
+    @patch('src.guardian_api.time.sleep')
+    def test_acquire_raises_rather_than_wait_past_max_wait(
+            self, mock_sleep):
+        rate_limiter = RateLimiter(rate=1, burst=1)
+        rate_limiter.acquire()
+        with pytest.raises(TimeoutError):
+            rate_limiter.acquire(max_wait=0.1)
+        mock_sleep.assert_not_called()
+        assert rate_limiter.get_stats()['requests'] == 1
+
+    def test_raises_error_when_daily_quota_used(self):
+        rate_limiter = RateLimiter(rate=100, daily_quota=2)
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+        with pytest.raises(QuotaExceededError):
+            rate_limiter.acquire()
+
+    def test_retry_delay_honours_retry_after(self):
+        rate_limiter = RateLimiter()
+        assert rate_limiter.retry_delay(0, '7') == 7.0
+
+    def test_retry_delay_ignores_negative_retry_after(self):
+        rate_limiter = RateLimiter()
+        assert rate_limiter.retry_delay(0, '-3') == 0.0
+
+    def test_retry_delay_is_jittered_exponential_backoff(self):
+        rate_limiter = RateLimiter(base_delay=1.0, max_delay=5.0)
+        for attempt, limit in [(0, 1.0), (2, 4.0), (5, 5.0)]:
+            assert 0 <= rate_limiter.retry_delay(attempt) <= limit
+
+    @responses.activate
+    @patch('src.guardian_api.time.sleep')
+    def test_retries_throttled_request(self, mock_sleep):
+        responses.add(responses.GET, self.url, status=429,
+                      headers={'Retry-After': '2'})
+        responses.add(responses.GET, self.url,
+                      json={'response': {'results': []}})
+        output = get_guardian_content('key', 'football', '2024-01-01')
+        assert output == {'response': {'results': []}}
+        mock_sleep.assert_called_once_with(2.0)
+        stats = get_rate_limiter().get_stats()
+        assert stats['throttled'] == 1
+        assert stats['retries'] == 1
+        assert stats['requests'] == 2
+
+    @responses.activate
+    @patch('src.guardian_api.time.sleep')
+    def test_raises_http_error_after_max_retries(self, mock_sleep):
+        set_rate_limiter(RateLimiter(max_retries=2))
+        responses.add(responses.GET, self.url, status=503)
+        with pytest.raises(requests.exceptions.HTTPError):
+            get_guardian_content('key', 'football', '2024-01-01')
+        assert len(responses.calls) == 3
+
+    @responses.activate
+    def test_unexpected_status_raises_http_error(self):
+        responses.add(responses.GET, self.url, status=302)
+        with pytest.raises(requests.exceptions.HTTPError) as error:
+            get_guardian_content('key', 'football', '2024-01-01')
+        assert error.value.response.status_code == 302
+
+    @responses.activate
+    def test_client_errors_are_not_retried(self):
+        responses.add(responses.GET, self.url, status=401)
+        with pytest.raises(requests.exceptions.HTTPError):
+            get_guardian_content('key', 'football', '2024-01-01')
+        assert len(responses.calls) == 1
+
 
 class TestFormattedResponse:
     @pytest.fixture
@@ -48,6 +339,15 @@ class TestFormattedResponse:
         output = filter_response(response_1)
         assert output == results_1['results']
 
+    def test_keeps_nested_and_renamed_fields(self, response_1):
+        response_1['response']['results'][0]['fields'] = {'bodyText': 'Text'}
+        output = filter_response(
+            response_1, ['webUrl', ('fields.bodyText', 'body')])
+        assert output[0] == {
+            'webUrl': response_1['response']['results'][0]['webUrl'],
+            'body': 'Text'}
+        assert 'body' not in output[1]
+
 
 if __name__ == '__main__':
     api_key = os.getenv('GUARDIAN_KEY')
@@ -4,10 +4,22 @@ import os
 from dotenv import load_dotenv
 import boto3
 from moto import mock_aws
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+import base64
 import json
+import subprocess
+import sys
+import threading
+import time
 import responses
-from src.lambda_handler import lambda_handler
+import requests
+from src.lambda_handler import (
+    EventFailedError, lambda_handler, init_clients)
+from src.connections_aws import connections_aws
+from src.message_broker import forget_stream
+from src.deduplication import reset_deduplicator
+from src.brokers import MemoryBroker, get_broker, reset_broker
 
 load_dotenv()
 
@@ -26,6 +38,19 @@ def aws_credentials():
     os.environ['AWS_DEFAULT_REGION'] = 'eu-west-2'
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    connections_aws.clear_cache()
+    forget_stream()
+    reset_deduplicator()
+    reset_broker()
+    yield
+    connections_aws.clear_cache()
+    forget_stream()
+    reset_deduplicator()
+    reset_broker()
+
+
 @pytest.fixture(scope='function')
 def mock_secret(aws_credentials):
     with mock_aws():
@@ -166,6 +191,25 @@ class TestInputValidation:
             expected = "Invalid input parameter (search_term)."
             assert expected in caplog.text
 
+    @pytest.mark.parametrize('param', [0, -1])
+    def test_logs_error_for_invalid_max_pages(self, caplog, param):
+        '''
+        Ensure errors are logged for a non-positive 'max_pages'.
+
+        Expected Log Messages:
+            'Invalid input parameter value (max_pages).'
+        '''
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': 'test_stream',
+            'max_pages': param
+        }
+        with caplog.at_level(logging.INFO):
+            lambda_handler(event, None)
+            expected = 'Invalid input parameter value (max_pages).'
+            assert expected in caplog.text
+
     def test_logs_error_for_empty_stream_id(self, caplog):
         '''
         Validate error logging for an empty or whitespace-only 'stream_id'.
@@ -342,6 +386,892 @@ class TestDataProcessing:
         output = self.__class__._read_broker(mock_broker, stream_name)
         assert output == []
 
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_all_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_all_pages_uploaded_when_max_pages_given(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            caplog):
+        '''
+        Test that every retrieved page is uploaded to the stream.
+
+        Mocks:
+            - Paginated content retrieval returning two pages.
+            - Guardian API key retrieval.
+            - AWS Kinesis client.
+
+        Asserts:
+            - Paginated retrieval is called with the requested page limit.
+            - Records from both pages are added to the stream.
+        '''
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        mock_content.return_value = iter([test_response, test_response])
+        mock_kinesis.return_value = mock_broker
+        stream_name = 'test_stream'
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': stream_name,
+            'max_pages': 2
+        }
+        with caplog.at_level(logging.INFO):
+            lambda_handler(event, None)
+            expected = f'20 records added to stream: {stream_name}'
+            assert expected in caplog.text
+        assert mock_content.call_args.kwargs['max_pages'] == 2
+
+
+class TestMultipleSearchTerms:
+
+    @staticmethod
+    def _content(api_key, search_term, date_from, **kwargs):
+        if search_term == 'failing_term':
+            response = requests.Response()
+            response.status_code = 500
+            raise requests.HTTPError(response=response)
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        return test_response
+
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_records_for_every_term_uploaded(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            caplog):
+        '''
+        Test that the results of every search term are uploaded.
+
+        Asserts:
+            - Each term is fetched with its own date_from, or the event
+              date_from if none is given.
+            - Records for all terms are added to the stream.
+            - The returned summary reports the records written per term.
+        '''
+        mock_content.side_effect = self._content
+        mock_kinesis.return_value = mock_broker
+        stream_name = 'test_stream'
+        event = {
+            'date_from': '2022-01-01',
+            'search_terms': [
+                'term_1',
+                {'search_term': 'term_2', 'date_from': '2023-06-01'}
+            ],
+            'stream_id': stream_name
+        }
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, None)
+            expected = f'20 records added to stream: {stream_name}'
+            assert expected in caplog.text
+
+        calls = sorted(call.args for call in mock_content.call_args_list)
+        assert calls == [('1234567890', 'term_1', '2022-01-01'),
+                         ('1234567890', 'term_2', '2023-06-01')]
+        assert [summary['records'] for summary in output] == [10, 10]
+        assert all(summary['error'] is None for summary in output)
+
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_failed_term_does_not_abort_others(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            caplog):
+        '''
+        Test that a failed fetch for one term does not affect the others.
+
+        Asserts:
+            - The failure is logged.
+            - Records for the remaining term are added to the stream.
+            - The summary records the error against the failed term.
+        '''
+        mock_content.side_effect = self._content
+        mock_kinesis.return_value = mock_broker
+        stream_name = 'test_stream'
+        event = {
+            'date_from': '2022-01-01',
+            'search_terms': ['failing_term', 'term_1'],
+            'stream_id': stream_name
+        }
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, None)
+            assert 'Guardian API request failed with status code 500.' \
+                in caplog.text
+            assert f'10 records added to stream: {stream_name}' \
+                in caplog.text
+        assert output[0]['error'] is not None
+        assert output[0]['records'] == 0
+        assert output[1]['records'] == 10
+
+    @patch('src.lambda_handler.get_guardian_content')
+    def test_invalid_term_rejects_event(self, mock_content, caplog):
+        '''
+        Test that every term is validated before any content is fetched.
+
+        Expected Log Messages:
+            'Invalid input parameter (search_term).'
+        '''
+        event = {
+            'search_terms': ['term_1', '   '],
+            'stream_id': 'test_stream'
+        }
+        with caplog.at_level(logging.INFO):
+            assert lambda_handler(event, None) is None
+            expected = 'Invalid input parameter (search_term).'
+            assert expected in caplog.text
+        mock_content.assert_not_called()
+
+    def test_logs_error_for_empty_term_list(self, caplog):
+        '''
+        Expected Log Messages:
+            'Empty input parameter (search_terms).'
+        '''
+        event = {'search_terms': [], 'stream_id': 'test_stream'}
+        with caplog.at_level(logging.INFO):
+            lambda_handler(event, None)
+            expected = 'Empty input parameter (search_terms).'
+            assert expected in caplog.text
+
+
+class TestIncrementalFetch:
+
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_repeat_invocation_only_adds_new_records(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            monkeypatch,
+            tmp_path,
+            caplog):
+        '''
+        Test that a second run only publishes records newer than the
+        high-water mark stored by the first run.
+
+        Asserts:
+            - The first run adds every record and stores the newest
+              webPublicationDate as the high-water mark.
+            - The second run requests content from the date of the mark
+              and adds no duplicate records.
+        '''
+        monkeypatch.setenv('CHECKPOINT_STORE', 'sqlite')
+        monkeypatch.setenv('CHECKPOINT_PATH', str(tmp_path / 'marks.db'))
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        newest = max(result['webPublicationDate']
+                     for result in test_response['response']['results'])
+        mock_content.side_effect = lambda *args, **kwargs: json.loads(
+            json.dumps(test_response))
+        mock_kinesis.return_value = mock_broker
+        stream_name = 'test_stream'
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': stream_name
+        }
+        output = lambda_handler(event, None)
+        assert output[0]['records'] == 10
+        assert output[0]['watermark'] == newest
+
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, None)
+            expected = f'0 records added to stream: {stream_name}'
+            assert expected in caplog.text
+        assert mock_content.call_args.args[2] == newest[:10]
+        assert output[0]['records'] == 0
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_articles_beyond_first_page_are_not_skipped(
+            self, mock_credentials, mock_content, monkeypatch, tmp_path):
+        '''
+        Test that articles left over when a run fetches only its first
+        page are published by the following runs.
+
+        Mocks:
+            - Guardian API holding 25 articles, honouring from-date,
+              page, page-size and order-by.
+
+        Asserts:
+            - Content is requested oldest first.
+            - Every article is published by the successive runs, exactly
+              once.
+        '''
+        monkeypatch.setenv('CHECKPOINT_STORE', 'sqlite')
+        monkeypatch.setenv('CHECKPOINT_PATH', str(tmp_path / 'marks.db'))
+        articles = [{
+            'id': f'article-{index}',
+            'webPublicationDate': f'2024-01-{index + 1:02d}T00:00:00Z',
+            'webTitle': f'Article {index}',
+            'webUrl': f'https://www.theguardian.com/article-{index}',
+        } for index in range(25)]
+
+        def content(api_key, search_term, date_from, page=1, page_size=10,
+                    order_by='newest'):
+            results = sorted(
+                (article for article in articles
+                 if article['webPublicationDate'][:10] >= date_from),
+                key=lambda article: article['webPublicationDate'],
+                reverse=order_by == 'newest')
+            return {'response': {
+                'status': 'ok', 'pages': -(-len(results) // page_size),
+                'currentPage': page,
+                'results': results[(page - 1) * page_size:page * page_size],
+            }}
+
+        mock_content.side_effect = content
+        broker = MemoryBroker()
+        event = {'date_from': '2024-01-01', 'search_term': 'test_term',
+                 'stream_id': 'test_stream'}
+        written = [lambda_handler(event, None, broker)[0]['records']
+                   for _ in range(3)]
+        assert mock_content.call_args.kwargs['order_by'] == 'oldest'
+        assert written[0] == 10
+        assert sum(written) == 25
+        urls = [json.loads(record['Data'])['webUrl']
+                for record in broker.records('test_stream')]
+        assert sorted(urls) == sorted(
+            article['webUrl'] for article in articles)
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_watermark_advances_past_pages_of_same_day_articles(
+            self, mock_credentials, mock_content, monkeypatch, tmp_path):
+        '''
+        Test that a day with more than a page of articles at or before the
+        high-water mark does not stop the term from publishing.
+
+        Mocks:
+            - Guardian API holding 25 articles published on the same day,
+              honouring from-date, page, page-size and order-by.
+
+        Asserts:
+            - Each run publishes the next articles after the mark,
+              although the third run's first two pages are all at or
+              before it.
+            - Every article is published exactly once.
+        '''
+        monkeypatch.setenv('CHECKPOINT_STORE', 'sqlite')
+        monkeypatch.setenv('CHECKPOINT_PATH', str(tmp_path / 'marks.db'))
+        articles = [{
+            'id': f'article-{index}',
+            'webPublicationDate': f'2024-05-01T{index:02d}:30:00Z',
+            'webTitle': f'Article {index}',
+            'webUrl': f'https://www.theguardian.com/article-{index}',
+        } for index in range(25)]
+
+        def content(api_key, search_term, date_from, page=1, page_size=10,
+                    order_by='newest'):
+            results = sorted(
+                (article for article in articles
+                 if article['webPublicationDate'][:10] >= date_from),
+                key=lambda article: article['webPublicationDate'],
+                reverse=order_by == 'newest')
+            return {'response': {
+                'status': 'ok', 'pages': -(-len(results) // page_size),
+                'currentPage': page,
+                'results': results[(page - 1) * page_size:page * page_size],
+            }}
+
+        mock_content.side_effect = content
+        broker = MemoryBroker()
+        event = {'date_from': '2024-05-01', 'search_term': 'test_term',
+                 'stream_id': 'test_stream'}
+        written = [lambda_handler(event, None, broker)[0]['records']
+                   for _ in range(4)]
+        assert written == [10, 10, 5, 0]
+        urls = [json.loads(record['Data'])['webUrl']
+                for record in broker.records('test_stream')]
+        assert sorted(urls) == sorted(
+            article['webUrl'] for article in articles)
+
+
+class TestDeduplication:
+
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_duplicate_urls_are_suppressed(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            monkeypatch,
+            caplog):
+        '''
+        Test that articles returned for several terms, and by a repeat
+        invocation, are only published once.
+
+        Asserts:
+            - Only the first term's copy of each article is added.
+            - A second invocation adds no records.
+            - The number of suppressed records is logged and reported.
+        '''
+        monkeypatch.setenv('DEDUP_MODE', 'lru')
+        monkeypatch.delenv('DEDUP_PATH', raising=False)
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        mock_content.side_effect = lambda *args, **kwargs: json.loads(
+            json.dumps(test_response))
+        mock_kinesis.return_value = mock_broker
+        stream_name = 'test_stream'
+        event = {
+            'date_from': '2022-01-01',
+            'search_terms': ['term_1', 'term_2'],
+            'stream_id': stream_name
+        }
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, None)
+            assert f'10 records added to stream: {stream_name}' \
+                in caplog.text
+            assert '10 duplicate records suppressed.' in caplog.text
+        assert sorted(summary['duplicates'] for summary in output) == \
+            [0, 10]
+
+        output = lambda_handler(event, None)
+        assert [summary['records'] for summary in output] == [0, 0]
+        assert [summary['duplicates'] for summary in output] == [10, 10]
+
+
+class TestDeadline:
+
+    @staticmethod
+    def _context(seconds):
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = seconds * 1000
+        return context
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_no_work_started_without_time(
+            self,
+            mock_credentials,
+            mock_content,
+            caplog):
+        '''
+        Test that no content is fetched when only the publishing reserve
+        of the invocation is left.
+
+        Asserts:
+            - The Guardian API is not called.
+            - Every term is reported as remaining, in the form of a
+              'search_terms' item.
+            - A warning reports the number of unfinished terms.
+        '''
+        event = {
+            'date_from': '2022-01-01',
+            'search_terms': ['term_1', 'term_2'],
+            'stream_id': 'test_stream'
+        }
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, self._context(4))
+            assert 'Deadline reached: 2 search terms were not completed.' \
+                in caplog.text
+        mock_content.assert_not_called()
+        assert [summary['remaining'] for summary in output] == [
+            {'search_term': 'term_1', 'date_from': '2022-01-01'},
+            {'search_term': 'term_2', 'date_from': '2022-01-01'}
+        ]
+
+    @patch.dict('src.deadline.STAGE_SHARES', {'fetch': 0.1})
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_all_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_fetched_pages_published_when_deadline_nears(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            monkeypatch,
+            tmp_path,
+            caplog):
+        '''
+        Test that a paginated fetch stops requesting pages once its share
+        of the deadline is used, and the pages already fetched are
+        published.
+
+        Asserts:
+            - Only the pages fetched before the fetch deadline are added.
+            - The term is reported as remaining.
+            - The pages were requested oldest first, so the high-water
+              mark is advanced to the newest record added.
+        '''
+        monkeypatch.setenv('CHECKPOINT_STORE', 'sqlite')
+        monkeypatch.setenv('CHECKPOINT_PATH', str(tmp_path / 'marks.db'))
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        pages_requested = []
+
+        def pages(*args, **kwargs):
+            for page in range(1, 4):
+                if page == 2:
+                    time.sleep(0.3)
+                pages_requested.append(page)
+                yield json.loads(json.dumps(test_response))
+
+        mock_content.side_effect = pages
+        mock_kinesis.return_value = mock_broker
+        stream_name = 'test_stream'
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': stream_name,
+            'max_pages': 3
+        }
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, self._context(7))
+            assert f'20 records added to stream: {stream_name}' \
+                in caplog.text
+        assert pages_requested == [1, 2]
+        assert output[0]['remaining'] == {
+            'search_term': 'test_term', 'date_from': '2022-01-01'}
+        assert mock_content.call_args.kwargs['order_by'] == 'oldest'
+        assert output[0]['watermark'] == max(
+            result['webPublicationDate']
+            for result in test_response['response']['results'])
+
+
+class TestMetrics:
+
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_emits_embedded_metric_format_line(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            mock_broker,
+            caplog):
+        '''
+        Test that each invocation writes its stage timings and counts as a
+        CloudWatch Embedded Metric Format log line.
+
+        Asserts:
+            - A single EMF line is written to the GuardianMetrics logger.
+            - It contains the duration of each stage, the records
+              published, the bytes sent and the cold start flag.
+        '''
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        mock_content.return_value = test_response
+        mock_kinesis.return_value = mock_broker
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': 'test_stream'
+        }
+        metrics_logger = logging.getLogger('GuardianMetrics')
+        metrics_logger.addHandler(caplog.handler)
+        try:
+            with caplog.at_level(logging.INFO):
+                lambda_handler(event, None)
+        finally:
+            metrics_logger.removeHandler(caplog.handler)
+
+        lines = [record.message for record in caplog.records
+                 if record.name == 'GuardianMetrics']
+        assert len(lines) == 1
+        emf = json.loads(lines[0])
+        names = [metric['Name'] for metric
+                 in emf['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        for name in ('SecretDuration', 'FilterDuration', 'FetchDuration',
+                     'StreamReadyDuration', 'PublishDuration',
+                     'KinesisPutDuration', 'InvocationDuration'):
+            assert name in names
+        assert emf['RecordsFetched'] == 10
+        assert emf['RecordsPublished'] == 10
+        assert emf['KinesisBytesSent'] > 0
+        assert emf['ColdStart'] in (0, 1)
+        assert emf['StreamId'] == 'test_stream'
+
+
+class TestBroker:
+
+    @patch('src.lambda_handler.connections_aws.get_message_broker')
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_publishes_to_configured_broker(
+            self,
+            mock_credentials,
+            mock_content,
+            mock_kinesis,
+            monkeypatch):
+        '''
+        Test that records are published to the broker selected by the
+        BROKER environment variable instead of Kinesis.
+
+        Asserts:
+            - Every record is held by the in-memory broker.
+            - No Kinesis client is requested.
+        '''
+        monkeypatch.setenv('BROKER', 'memory')
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        mock_content.return_value = test_response
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': 'test_stream'
+        }
+        output = lambda_handler(event, None)
+        assert output[0]['records'] == 10
+        assert len(get_broker().records('test_stream')) == 10
+        mock_kinesis.assert_not_called()
+
+
+class TestStreaming:
+
+    @staticmethod
+    def _pages(count, requested):
+        test_response = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+
+        def pages(*args, **kwargs):
+            for page in range(1, count + 1):
+                requested.append(page)
+                yield json.loads(json.dumps(test_response))
+        return pages
+
+    @patch('src.lambda_handler.MAX_BATCH_RECORDS', 10)
+    @patch('src.lambda_handler.get_all_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_pages_published_while_later_pages_fetched(
+            self,
+            mock_credentials,
+            mock_content):
+        '''
+        Test that each page is published as soon as it fills a batch,
+        without waiting for the remaining pages to be fetched.
+
+        Asserts:
+            - Records are written before the last pages are fetched.
+            - Every page is published.
+        '''
+        broker = MemoryBroker()
+        published_before_last_page = []
+        pages = self._pages(2, [])
+
+        def fetch_pages(*args, **kwargs):
+            yield from pages()
+            wait_until = time.monotonic() + 2
+            while (not broker.records('test_stream')
+                   and time.monotonic() < wait_until):
+                time.sleep(0.01)
+            published_before_last_page.append(
+                len(broker.records('test_stream')))
+            yield from pages()
+
+        mock_content.side_effect = fetch_pages
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': 'test_stream',
+            'max_pages': 4
+        }
+        output = lambda_handler(event, None, broker)
+        assert published_before_last_page[0] >= 10
+        assert output[0]['records'] == 40
+
+    @patch('src.lambda_handler.MAX_QUEUED_PAGES', 1)
+    @patch('src.lambda_handler.MAX_BATCH_RECORDS', 10)
+    @patch('src.lambda_handler.get_all_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_fetch_does_not_run_ahead_of_publishing(
+            self,
+            mock_credentials,
+            mock_content):
+        '''
+        Test that fetching blocks while the page queue is full, so a slow
+        stream bounds the number of pages held in memory.
+
+        Asserts:
+            - While the first batch is being written, no more than the
+              page being published, the queued page and the page waiting
+              to be queued have been fetched.
+            - Every page is eventually published.
+        '''
+        requested = []
+        fetched_during_put = []
+        broker = MemoryBroker()
+        mock_content.side_effect = self._pages(10, requested)
+        original_put = broker.put
+
+        def put(stream_id, entries, max_retries=3):
+            if not fetched_during_put:
+                time.sleep(0.3)
+            fetched_during_put.append(len(requested))
+            return original_put(stream_id, entries, max_retries)
+
+        broker.put = put
+        event = {
+            'date_from': '2022-01-01',
+            'search_term': 'test_term',
+            'stream_id': 'test_stream',
+            'max_pages': 10
+        }
+        output = lambda_handler(event, None, broker)
+        assert fetched_during_put[0] <= 3
+        assert output[0]['records'] == 100
+        assert len(broker.records('test_stream')) == 100
+
+
+class TestBatchEvents:
+
+    @staticmethod
+    def _request(search_term, **overrides):
+        return dict({
+            'date_from': '2022-01-01',
+            'search_term': search_term,
+            'stream_id': 'test_stream'
+        }, **overrides)
+
+    @staticmethod
+    def _sqs_message(message_id, body):
+        return {'messageId': message_id, 'eventSource': 'aws:sqs',
+                'body': body if isinstance(body, str) else json.dumps(body)}
+
+    @staticmethod
+    def _response():
+        return json.load(open('./tests/data/api_content_2/raw_response.json'))
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_reports_failed_sqs_messages(
+            self, mock_credentials, mock_content):
+        '''
+        Test that every message of an SQS batch is processed and only the
+        failed messages are reported.
+
+        Asserts:
+            - The message whose body is not JSON and the message with an
+              invalid date are reported in batchItemFailures.
+            - The records of the valid messages are published.
+            - The API key is fetched once for the batch.
+        '''
+        mock_content.side_effect = lambda *args, **kwargs: self._response()
+        broker = MemoryBroker()
+        event = {'Records': [
+            self._sqs_message('first', self._request('first_term')),
+            self._sqs_message('invalid', 'not json'),
+            self._sqs_message('second', self._request('second_term')),
+            self._sqs_message(
+                'bad-date', self._request('term', date_from='2022-00-01')),
+        ]}
+        output = lambda_handler(event, None, broker)
+        assert output == {'batchItemFailures': [
+            {'itemIdentifier': 'invalid'}, {'itemIdentifier': 'bad-date'}]}
+        assert len(broker.records('test_stream')) == 20
+        mock_credentials.assert_called_once()
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_processes_kinesis_and_eventbridge_messages(
+            self, mock_credentials, mock_content):
+        '''
+        Test that requests are read from Kinesis record data and from the
+        detail of EventBridge events.
+
+        Asserts:
+            - Both batches succeed and every record is published.
+        '''
+        mock_content.side_effect = lambda *args, **kwargs: self._response()
+        broker = MemoryBroker()
+        data = base64.b64encode(
+            json.dumps(self._request('kinesis_term')).encode()).decode()
+        kinesis_event = {'Records': [{
+            'eventSource': 'aws:kinesis',
+            'kinesis': {'sequenceNumber': '4950', 'data': data}
+        }]}
+        eventbridge_event = {
+            'id': 'abc', 'detail-type': 'Search Request',
+            'source': 'guardian.search',
+            'detail': self._request('eventbridge_term')
+        }
+        assert lambda_handler(kinesis_event, None, broker) == \
+            {'batchItemFailures': []}
+        assert lambda_handler(eventbridge_event, None, broker) == \
+            {'batchItemFailures': []}
+        assert len(broker.records('test_stream')) == 20
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_reports_only_malformed_kinesis_record(
+            self, mock_credentials, mock_content):
+        '''
+        Test that a Kinesis record whose data cannot be decoded fails on
+        its own.
+
+        Asserts:
+            - Only the malformed record is reported in batchItemFailures.
+            - The records of the valid message are published.
+        '''
+        mock_content.side_effect = lambda *args, **kwargs: self._response()
+        broker = MemoryBroker()
+        data = base64.b64encode(
+            json.dumps(self._request('kinesis_term')).encode()).decode()
+        event = {'Records': [
+            {'eventSource': 'aws:kinesis',
+             'kinesis': {'sequenceNumber': '1', 'data': 'not base64!'}},
+            {'eventSource': 'aws:kinesis',
+             'kinesis': {'sequenceNumber': '2'}},
+            {'eventSource': 'aws:kinesis',
+             'kinesis': {'sequenceNumber': '3', 'data': data}},
+        ]}
+        output = lambda_handler(event, None, broker)
+        assert output == {'batchItemFailures': [
+            {'itemIdentifier': '1'}, {'itemIdentifier': '2'}]}
+        assert len(broker.records('test_stream')) == 10
+
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_raises_for_failed_eventbridge_event(self, mock_credentials):
+        '''
+        Test that a single EventBridge event, which is invoked
+        asynchronously, raises if its request fails.
+
+        Asserts:
+            - EventFailedError is raised, naming the event.
+        '''
+        event = {
+            'id': 'abc', 'detail-type': 'Search Request',
+            'source': 'guardian.search',
+            'detail': self._request('term', date_from='2022-00-01')
+        }
+        with pytest.raises(EventFailedError, match='abc'):
+            lambda_handler(event, None, MemoryBroker())
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_processes_messages_concurrently(
+            self, mock_credentials, mock_content):
+        '''
+        Test that the messages of a batch are processed at the same time.
+
+        Asserts:
+            - Both messages are fetching at once (the barrier is passed).
+        '''
+        barrier = threading.Barrier(2, timeout=5)
+
+        def content(*args, **kwargs):
+            barrier.wait()
+            return self._response()
+
+        mock_content.side_effect = content
+        event = {'Records': [
+            self._sqs_message('first', self._request('first_term')),
+            self._sqs_message('second', self._request('second_term')),
+        ]}
+        output = lambda_handler(event, None, MemoryBroker())
+        assert output == {'batchItemFailures': []}
+
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_fails_every_message_if_batch_cannot_start(
+            self, mock_credentials, monkeypatch, caplog):
+        '''
+        Test that every message is reported if the configuration shared by
+        the batch is invalid.
+
+        Asserts:
+            - Both messages are reported in batchItemFailures.
+            - The configuration error is logged.
+        '''
+        monkeypatch.setenv('SERIALIZER', 'xml')
+        event = {'Records': [
+            self._sqs_message('first', self._request('first_term')),
+            self._sqs_message('second', self._request('second_term')),
+        ]}
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(event, None, MemoryBroker())
+        assert output == {'batchItemFailures': [
+            {'itemIdentifier': 'first'}, {'itemIdentifier': 'second'}]}
+        assert 'Invalid configuration parameter (SERIALIZER).' in \
+            caplog.text
+
+
+class TestColdStart:
+
+    def test_import_defers_optional_modules(self):
+        '''
+        Test that importing the handler does not load the modules only
+        needed by some configurations.
+
+        Asserts:
+            - boto3, asyncio and sqlite3 are not imported with the handler.
+        '''
+        deferred = ('boto3', 'asyncio', 'sqlite3')
+        completed = subprocess.run(
+            [sys.executable, '-c',
+             'import sys; import src.lambda_handler; '
+             f'print([name for name in {deferred!r} '
+             'if name in sys.modules])'],
+            capture_output=True, text=True, check=True,
+            env={key: value for key, value in os.environ.items()
+                 if key != 'AWS_LAMBDA_FUNCTION_NAME'})
+        assert completed.stdout.strip() == '[]'
+
+    def test_init_clients_creates_clients(self, aws_credentials):
+        '''
+        Test that the clients used by every invocation are created ahead of
+        the first invocation.
+
+        Asserts:
+            - The Secrets Manager and Kinesis clients are created.
+            - The first invocation reuses them.
+        '''
+        init_clients()
+        assert connections_aws.get_cache_stats()['client_misses'] == 2
+        connections_aws.get_message_broker()
+        assert connections_aws.get_cache_stats()['client_misses'] == 2
+
+    def test_init_clients_skips_kinesis_for_local_broker(
+            self, aws_credentials, monkeypatch):
+        '''
+        Test that no Kinesis client is created when a local broker is
+        selected.
+
+        Asserts:
+            - Only the Secrets Manager client is created.
+        '''
+        monkeypatch.setenv('BROKER', 'memory')
+        init_clients()
+        assert connections_aws.get_cache_stats()['client_misses'] == 1
+
 
 class TestErrorLogging:
 
@@ -403,3 +1333,80 @@ class TestErrorLogging:
             lambda_handler(self._test_event, None)
             expected = 'Guardian API request failed with status code 401.'
             assert expected in caplog.text
+
+    @responses.activate
+    def test_invalidates_cached_key_on_unauthorised_request(
+            self, mock_secret, caplog):
+        '''
+        Test that a 401 from the Guardian API invalidates the cached key.
+
+        Mocks:
+            - AWS secrets manager containing the Guardian API key.
+            - Simulated 401 response from the Guardian API.
+
+        Asserts:
+            - The key is fetched from Secrets Manager again on the next
+              invocation rather than served from the cache.
+        '''
+        mock_secret.create_secret(Name='Guardian-Key',
+                                  SecretString='1234567890')
+        responses.add(responses.GET,
+                      'https://content.guardianapis.com/search',
+                      json={'error': 'Unauthorized'},
+                      status=401)
+        lambda_handler(self._test_event, None)
+        lambda_handler(self._test_event, None)
+        stats = connections_aws.get_cache_stats()
+        assert stats['secret_misses'] == 2
+        assert stats['secret_hits'] == 0
+
+    @patch('src.lambda_handler.get_guardian_content')
+    @patch('src.lambda_handler.connections_aws.get_credentials',
+           return_value='1234567890')
+    def test_counts_records_of_throttled_write_as_failed(
+            self, mock_credentials, mock_content, caplog):
+        '''
+        Test handling of a write rejected by the stream with
+        ProvisionedThroughputExceededException.
+
+        Mocks:
+            - Guardian API content.
+            - A broker whose writes are throttled.
+
+        Asserts:
+            - The throttled write is logged.
+            - The records are counted as failed rather than dropped.
+        '''
+        mock_content.return_value = json.load(open(
+            './tests/data/api_content_2/raw_response.json'))
+        broker = MagicMock()
+        broker.put.side_effect = ClientError({'Error': {
+            'Code': 'ProvisionedThroughputExceededException',
+            'Message': 'Rate exceeded'}}, 'PutRecords')
+        with caplog.at_level(logging.INFO):
+            output = lambda_handler(self._test_event, None, broker)
+        assert 'Write throughput exceeded for stream: test_stream.' in \
+            caplog.text
+        assert output[0]['records'] == 0
+        assert output[0]['failed'] == 10
+
+    def test_logs_unmatched_aws_error_code(self, caplog):
+        '''
+        Test that an AWS error without a specific message is logged with
+        its error code.
+
+        Mocks:
+            - Retrieval of the Guardian API key failing with a throttling
+              error.
+
+        Asserts:
+            - The error code is logged.
+        '''
+        error = ClientError({'Error': {
+            'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+            'GetSecretValue')
+        with patch('src.lambda_handler.connections_aws.get_credentials',
+                   side_effect=error), caplog.at_level(logging.INFO):
+            assert lambda_handler(self._test_event, None) is None
+        assert 'AWS request failed with error code ThrottlingException.' \
+            in caplog.text
@@ -0,0 +1,130 @@
+import json
+import logging
+import pytest
+from unittest.mock import patch
+from src.brokers import read_segments
+from src.__main__ import main, load_events, build_events, parse_args
+from src.connections_aws import connections_aws
+from src.message_broker import forget_stream
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(monkeypatch):
+    connections_aws.clear_cache()
+    forget_stream()
+    monkeypatch.setattr('src.__main__.set_stream', lambda stream: None)
+    yield
+    connections_aws.clear_cache()
+    forget_stream()
+
+
+@pytest.fixture(scope='function')
+def test_response():
+    with open('./tests/data/api_content_2/raw_response.json') as file:
+        response = json.load(file)
+    return lambda *args, **kwargs: json.loads(json.dumps(response))
+
+
+class TestEvents:
+
+    def test_loads_json_event_list_and_lines(self, tmp_path):
+        events = [{'search_term': 'one'}, {'search_term': 'two'}]
+        single = tmp_path / 'event.json'
+        single.write_text(json.dumps(events[0]))
+        listed = tmp_path / 'events.json'
+        listed.write_text(json.dumps(events))
+        lines = tmp_path / 'events.jsonl'
+        lines.write_text('\n'.join(json.dumps(event) for event in events) +
+                         '\n\n')
+        assert load_events(str(single)) == events[:1]
+        assert load_events(str(listed)) == events
+        assert load_events(str(lines)) == events
+
+    def test_rejects_file_without_events(self, tmp_path):
+        path = tmp_path / 'events.json'
+        path.write_text('[1, 2]')
+        with pytest.raises(ValueError):
+            load_events(str(path))
+
+    def test_options_are_defaults_for_file_events(self, tmp_path):
+        path = tmp_path / 'events.jsonl'
+        path.write_text(json.dumps({'search_term': 'one'}) + '\n' +
+                        json.dumps({'date_from': '2024-01-01'}) + '\n')
+        args = parse_args(['--events', str(path), '--search-term', 'two',
+                           '--date-from', '2023-01-01', '--workers', '2'])
+        assert build_events(args) == [
+            {'search_term': 'one', 'date_from': '2023-01-01',
+             'stream_id': 'guardian_content', 'max_workers': 2},
+            {'search_terms': ['two'], 'date_from': '2024-01-01',
+             'stream_id': 'guardian_content', 'max_workers': 2},
+        ]
+
+    def test_requires_events_or_search_term(self):
+        with pytest.raises(SystemExit):
+            parse_args([])
+        with pytest.raises(SystemExit):
+            parse_args(['--search-term', 'one', '--sink', 'jsonl'])
+
+
+class TestMain:
+
+    @patch('src.lambda_handler.get_guardian_content')
+    def test_writes_records_to_stdout(self, mock_content, test_response,
+                                      capsys):
+        '''
+        Test that records are written to stdout as JSON lines, with the
+        summaries and metrics on stderr and no AWS calls.
+
+        Asserts:
+            - Every record is written to stdout.
+            - The API key given is passed to the Guardian API.
+            - The exit status is 0.
+        '''
+        mock_content.side_effect = test_response
+        status = main(['--search-term', 'one', '--date-from', '2022-01-01',
+                       '--api-key', 'local-key'])
+        captured = capsys.readouterr()
+        lines = [json.loads(line) for line in captured.out.splitlines()]
+        assert status == 0
+        assert len(lines) == 10
+        assert lines[0]['stream_id'] == 'guardian_content'
+        assert lines[0]['record']['keyword'] == 'one'
+        assert mock_content.call_args.args[0] == 'local-key'
+        assert '"summaries"' in captured.err
+
+    @patch('src.lambda_handler.get_guardian_content')
+    def test_writes_records_to_file(self, mock_content, test_response,
+                                    tmp_path, capsys):
+        mock_content.side_effect = test_response
+        path = tmp_path / 'records.jsonl'
+        status = main(['--search-term', 'one', '--search-term', 'two',
+                       '--sink', 'jsonl', '--output', str(path),
+                       '--api-key', 'local-key'])
+        assert status == 0
+        assert len(path.read_text().splitlines()) == 20
+        assert capsys.readouterr().out == ''
+
+    @patch('src.lambda_handler.get_guardian_content')
+    def test_writes_records_to_segments(self, mock_content, test_response,
+                                        tmp_path):
+        mock_content.side_effect = test_response
+        status = main(['--search-term', 'one', '--sink', 'segment',
+                       '--output', str(tmp_path), '--api-key', 'local-key'])
+        assert status == 0
+        assert len(list(read_segments(str(tmp_path),
+                                      'guardian_content'))) == 10
+
+    def test_failed_event_sets_exit_status(self, caplog, capsys):
+        with caplog.at_level(logging.INFO):
+            status = main(['--search-term', ' ', '--api-key', 'local-key'])
+        assert status == 1
+        assert 'Invalid input parameter (search_term).' in caplog.text
+
+    @patch('src.lambda_handler.get_guardian_content')
+    def test_profile_is_written(self, mock_content, test_response,
+                                tmp_path, capsys):
+        mock_content.side_effect = test_response
+        path = tmp_path / 'run.prof'
+        main(['--search-term', 'one', '--api-key', 'local-key',
+              '--profile', str(path)])
+        assert path.stat().st_size > 0
@@ -3,7 +3,21 @@ import boto3
 import pytest
 import os
 import json
-from src.message_broker import create_stream, add_records
+import threading
+import time
+from unittest.mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from src.message_broker import (
+    create_stream, add_records, put_entries, _batch_indices,
+    wait_for_stream, forget_stream, get_throttle_controller,
+    put_aggregated_entries, put_compressed_entries, KinesisProducer,
+    BufferFullError, RETRY_BASE_DELAY
+)
+from src.aggregation import deaggregate
+from src.serialization import decode_records
+from src.partitioning import (
+    RoundRobinPartitioner, get_shard_ranges, even_shard_ranges, MAX_HASH_KEY
+)
 
 
 @pytest.fixture(scope="function")
@@ -16,12 +30,35 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
 
 
+@pytest.fixture(autouse=True)
+def clear_stream_cache():
+    forget_stream()
+    yield
+    forget_stream()
+
+
 @pytest.fixture(scope='function')
 def mock_broker(aws_credentials):
     with mock_aws():
         yield boto3.client('kinesis', region_name='eu-west-2')
 
 
+def mock_kinesis(shard_count=1):
+    '''
+    Returns a mock Kinesis client for a stream of shard_count evenly split
+    shards.
+    '''
+    kinesis = MagicMock()
+    kinesis.list_shards.return_value = {'Shards': [
+        {'ShardId': f'shardId-{index:012d}',
+         'HashKeyRange': {'StartingHashKey': str(start),
+                          'EndingHashKey': str(end)},
+         'SequenceNumberRange': {'StartingSequenceNumber': '1'}}
+        for index, (start, end) in enumerate(even_shard_ranges(shard_count))
+    ]}
+    return kinesis
+
+
 class TestCreateStream:
     def test_creates_stream_if_not_exists(self, mock_broker):
         stream_name = 'test-stream'
@@ -34,6 +71,53 @@ class TestCreateStream:
         response = create_stream(mock_broker, stream_name)
         assert response is None
 
+    def test_sets_retention_period_for_new_stream(self, mock_broker):
+        stream_name = 'test-stream'
+        create_stream(mock_broker, stream_name)
+        response = mock_broker.describe_stream_summary(StreamName=stream_name)
+        summary = response['StreamDescriptionSummary']
+        assert summary['RetentionPeriodHours'] == 72
+
+    def test_returns_none_for_stream_created_elsewhere(self, mock_broker):
+        stream_name = 'test-stream'
+        mock_broker.create_stream(StreamName=stream_name, ShardCount=1)
+        assert create_stream(mock_broker, stream_name) is None
+
+    def test_known_stream_makes_no_calls(self, mock_broker):
+        stream_name = 'test-stream'
+        create_stream(mock_broker, stream_name)
+        kinesis = MagicMock()
+        assert create_stream(kinesis, stream_name) is None
+        assert kinesis.method_calls == []
+
+
+class TestWaitForStream:
+
+    @staticmethod
+    def _kinesis(statuses):
+        kinesis = MagicMock()
+        kinesis.describe_stream_summary.side_effect = [
+            {'StreamDescriptionSummary': {'StreamStatus': status}}
+            for status in statuses
+        ]
+        return kinesis
+
+    @patch('src.message_broker.time.sleep')
+    def test_waits_with_exponential_backoff(self, mock_sleep):
+        kinesis = self._kinesis(['CREATING', 'CREATING', 'ACTIVE'])
+        wait_for_stream(kinesis, 'test-stream')
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        assert delays == [0.1, 0.2]
+
+    @patch('src.message_broker.time.sleep')
+    @patch('src.message_broker.time.monotonic')
+    def test_raises_timeout_error_after_deadline(
+            self, mock_monotonic, mock_sleep):
+        mock_monotonic.side_effect = [0.0, 0.0, 0.5, 1.0]
+        kinesis = self._kinesis(['CREATING'] * 3)
+        with pytest.raises(TimeoutError):
+            wait_for_stream(kinesis, 'test-stream', timeout=0.5)
+
 
 class TestAddRecords:
 
@@ -70,4 +154,398 @@ class TestAddRecords:
         for i in range(len(self.test_records)):
             expect = self.test_records[i]
             for key in expect.keys():
-                assert output[i][key] == expect[key]
\ No newline at end of file
+                assert output[i][key] == expect[key]
+
+    def test_returns_record_count_per_shard(self, mock_broker):
+        stream_name = 'test-stream'
+        create_stream(mock_broker, stream_name)
+        output = add_records(
+            mock_broker, stream_name, 'test-term', self.test_records)
+        assert output['FailedRecordCount'] == 0
+        assert len(output['Shards']) == 1
+        assert list(output['Shards'].values()) == [len(self.test_records)]
+
+    def test_aggregated_records_can_be_deaggregated(self, mock_broker):
+        stream_name = 'test-stream'
+        create_stream(mock_broker, stream_name)
+        output = add_records(mock_broker, stream_name, 'test-term',
+                             self.test_records, aggregate=True)
+        assert sum(output['Shards'].values()) == len(self.test_records)
+
+        response = mock_broker.describe_stream(StreamName=stream_name)
+        kinesis_records = []
+        for shard in response['StreamDescription']['Shards']:
+            iterator = mock_broker.get_shard_iterator(
+                StreamName=stream_name, ShardId=shard['ShardId'],
+                ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+            kinesis_records.extend(mock_broker.get_records(
+                ShardIterator=iterator)['Records'])
+        assert len(kinesis_records) == 1
+        records = [json.loads(record['Data'])
+                   for record in deaggregate(kinesis_records[0]['Data'])]
+        assert records == self.test_records
+
+    def test_compressed_records_can_be_decoded(self, mock_broker):
+        stream_name = 'test-stream'
+        create_stream(mock_broker, stream_name)
+        output = add_records(mock_broker, stream_name, 'test-term',
+                             self.test_records, compression='gzip')
+        assert sum(output['Shards'].values()) == len(self.test_records)
+
+        response = mock_broker.describe_stream(StreamName=stream_name)
+        kinesis_records = []
+        for shard in response['StreamDescription']['Shards']:
+            iterator = mock_broker.get_shard_iterator(
+                StreamName=stream_name, ShardId=shard['ShardId'],
+                ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+            kinesis_records.extend(mock_broker.get_records(
+                ShardIterator=iterator)['Records'])
+        assert len(kinesis_records) == 1
+        assert decode_records(kinesis_records[0]['Data']) == \
+            self.test_records
+
+    def test_partitioner_spreads_records_across_shards(self, mock_broker):
+        stream_name = 'test-stream'
+        create_stream(mock_broker, stream_name)
+        partitioner = RoundRobinPartitioner(
+            get_shard_ranges(mock_broker, stream_name))
+        output = add_records(mock_broker, stream_name, 'test-term',
+                             self.test_records, partitioner=partitioner)
+        assert len(output['Shards']) == len(self.test_records)
+
+    def test_uses_single_request_for_all_records(self):
+        kinesis = mock_kinesis()
+        kinesis.put_records.return_value = {
+            'FailedRecordCount': 0,
+            'Records': [{'ShardId': 'shardId-000000000001',
+                         'SequenceNumber': '1'}] * len(self.test_records)
+        }
+        add_records(kinesis, 'test-stream', 'test-term', self.test_records)
+        assert kinesis.put_records.call_count == 1
+        kinesis.put_record.assert_not_called()
+
+
+class TestPutEntries:
+
+    @staticmethod
+    def _entries(count, size=10):
+        return [{'Data': b'x' * size, 'PartitionKey': 'key'}
+                for _ in range(count)]
+
+    def test_batches_respect_record_limit(self):
+        batches = list(_batch_indices(self._entries(1001)))
+        assert [len(batch) for batch in batches] == [500, 500, 1]
+
+    def test_batches_respect_byte_limit(self):
+        entries = self._entries(6, size=1024 * 1024)
+        batches = list(_batch_indices(entries))
+        assert [len(batch) for batch in batches] == [4, 2]
+
+    @patch('src.message_broker.time.sleep')
+    def test_retries_only_failed_entries(self, mock_sleep):
+        kinesis = mock_kinesis()
+        success = {'ShardId': 'shardId-000000000001', 'SequenceNumber': '1'}
+        failure = {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Error'}
+        kinesis.put_records.side_effect = [
+            {'FailedRecordCount': 1, 'Records': [success, failure, success]},
+            {'FailedRecordCount': 0, 'Records': [success]},
+        ]
+        entries = self._entries(3)
+        results = put_entries(kinesis, 'test-stream', entries)
+        assert results == [success] * 3
+        retry_call = kinesis.put_records.call_args_list[1]
+        assert retry_call.kwargs['Records'] == [entries[1]]
+
+    @patch('src.message_broker.time.sleep')
+    def test_returns_error_after_max_retries(self, mock_sleep):
+        kinesis = mock_kinesis()
+        failure = {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Error'}
+        kinesis.put_records.return_value = {
+            'FailedRecordCount': 1, 'Records': [failure]}
+        results = put_entries(
+            kinesis, 'test-stream', self._entries(1), max_retries=2)
+        assert results == [failure]
+        assert kinesis.put_records.call_count == 3
+
+    @patch('src.message_broker.time.sleep')
+    def test_requeues_throttled_entries_without_retries(self, mock_sleep):
+        kinesis = mock_kinesis()
+        success = {'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'}
+        throttled = {'ErrorCode': 'ProvisionedThroughputExceededException',
+                     'ErrorMessage': 'Rate exceeded'}
+        kinesis.put_records.side_effect = [
+            {'FailedRecordCount': 1, 'Records': [success, throttled]},
+            {'FailedRecordCount': 1, 'Records': [throttled]},
+            {'FailedRecordCount': 0, 'Records': [success]},
+        ]
+        results = put_entries(
+            kinesis, 'test-stream', self._entries(2), max_retries=1)
+        assert results == [success] * 2
+        assert kinesis.put_records.call_count == 3
+        stats = get_throttle_controller('test-stream').get_stats()
+        assert stats['throttled'] == 2
+        assert stats['written'] == 2
+
+    @patch('src.message_broker.time.sleep')
+    def test_throttled_request_requeues_every_entry(self, mock_sleep):
+        kinesis = mock_kinesis()
+        success = {'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'}
+        kinesis.put_records.side_effect = [
+            ClientError({'Error': {
+                'Code': 'ProvisionedThroughputExceededException',
+                'Message': 'Rate exceeded'}}, 'PutRecords'),
+            {'FailedRecordCount': 0, 'Records': [success, success]},
+        ]
+        results = put_entries(kinesis, 'test-stream', self._entries(2))
+        assert results == [success] * 2
+        shards = get_throttle_controller('test-stream').get_stats()['shards']
+        assert sum(shard['throttled'] for shard in shards.values()) == 2
+
+
+class TestStreamShards:
+
+    @staticmethod
+    def _kinesis():
+        '''
+        Returns a mock Kinesis client for a stream of two unevenly split
+        shards, which are not numbered from zero, writing every record.
+        '''
+        kinesis = MagicMock()
+        kinesis.list_shards.return_value = {'Shards': [
+            {'ShardId': 'shardId-000000000007',
+             'HashKeyRange': {'StartingHashKey': '0',
+                              'EndingHashKey': str(2 ** 126 - 1)},
+             'SequenceNumberRange': {'StartingSequenceNumber': '1'}},
+            {'ShardId': 'shardId-000000000009',
+             'HashKeyRange': {'StartingHashKey': str(2 ** 126),
+                              'EndingHashKey': str(MAX_HASH_KEY)},
+             'SequenceNumberRange': {'StartingSequenceNumber': '1'}},
+        ]}
+        kinesis.put_records.side_effect = lambda StreamName, Records: {
+            'FailedRecordCount': 0,
+            'Records': [{'ShardId': 'shardId-000000000007',
+                         'SequenceNumber': str(index)}
+                        for index in range(len(Records))]}
+        return kinesis
+
+    def test_aggregates_by_the_stream_shards(self):
+        kinesis = self._kinesis()
+        entries = [{'Data': b'x' * 10, 'PartitionKey': 'key',
+                    'ExplicitHashKey': str(hash_key)}
+                   for hash_key in (10, 5 * 10 ** 37, 2 ** 127)]
+        put_aggregated_entries(kinesis, 'test-stream', entries)
+        put_aggregated_entries(kinesis, 'test-stream', entries)
+        records = kinesis.put_records.call_args.kwargs['Records']
+        assert [record['ExplicitHashKey'] for record in records] == \
+            ['10', str(2 ** 127)]
+        kinesis.list_shards.assert_called_once()
+
+    def test_compresses_by_the_stream_shards(self):
+        kinesis = self._kinesis()
+        entries = [{'Data': b'{}', 'PartitionKey': 'key',
+                    'ExplicitHashKey': str(hash_key)}
+                   for hash_key in (10, 5 * 10 ** 37, 2 ** 127)]
+        put_compressed_entries(kinesis, 'test-stream', entries)
+        records = kinesis.put_records.call_args.kwargs['Records']
+        assert [record['ExplicitHashKey'] for record in records] == \
+            ['10', str(2 ** 127)]
+        assert [len(decode_records(record['Data']))
+                for record in records] == [2, 1]
+
+    @patch('src.message_broker.time.sleep')
+    def test_throttle_controller_uses_the_stream_shards(self, mock_sleep):
+        kinesis = self._kinesis()
+        throttled = {'ErrorCode': 'ProvisionedThroughputExceededException',
+                     'ErrorMessage': 'Rate exceeded'}
+        kinesis.put_records.side_effect = [
+            {'FailedRecordCount': 1, 'Records': [
+                {'ShardId': 'shardId-000000000007', 'SequenceNumber': '1'},
+                throttled]},
+            {'FailedRecordCount': 0, 'Records': [
+                {'ShardId': 'shardId-000000000009', 'SequenceNumber': '2'}]},
+        ]
+        entries = [{'Data': b'x' * 10, 'PartitionKey': 'key',
+                    'ExplicitHashKey': str(hash_key)}
+                   for hash_key in (10, 2 ** 127)]
+        put_entries(kinesis, 'test-stream', entries)
+        shards = get_throttle_controller('test-stream').get_stats()['shards']
+        assert set(shards) == {'shardId-000000000007',
+                               'shardId-000000000009'}
+        assert shards['shardId-000000000009']['throttled'] == 1
+        assert shards['shardId-000000000009']['written'] == 1
+        assert shards['shardId-000000000009']['records_per_second'] == 550.0
+        assert shards['shardId-000000000007']['records_per_second'] is None
+
+    def test_forgotten_stream_lists_its_shards_again(self):
+        kinesis = self._kinesis()
+        entries = [{'Data': b'x' * 10, 'PartitionKey': 'key'}]
+        put_aggregated_entries(kinesis, 'test-stream', entries)
+        forget_stream('test-stream')
+        put_aggregated_entries(kinesis, 'test-stream', entries)
+        assert kinesis.list_shards.call_count == 2
+
+
+class TestKinesisProducer:
+
+    @staticmethod
+    def _entry(hash_key=0):
+        return {'Data': b'x' * 10, 'PartitionKey': 'key',
+                'ExplicitHashKey': str(hash_key)}
+
+    @staticmethod
+    def _kinesis(failures=None):
+        '''
+        Returns a mock Kinesis client writing every record, except that
+        the first record of each call listed in failures is rejected.
+        '''
+        kinesis = MagicMock()
+        calls = []
+
+        def put_records(StreamName, Records):
+            calls.append(len(Records))
+            results = [{'ShardId': 'shardId-000000000000',
+                        'SequenceNumber': str(index)}
+                       for index in range(len(Records))]
+            if failures and len(calls) in failures:
+                results[0] = {'ErrorCode': failures[len(calls)],
+                              'ErrorMessage': 'Error'}
+            return {'FailedRecordCount': 0, 'Records': results}
+
+        kinesis.put_records.side_effect = put_records
+        kinesis.calls = calls
+        return kinesis
+
+    def test_sends_full_batch_without_waiting(self):
+        kinesis = self._kinesis()
+        producer = KinesisProducer(kinesis, linger=60)
+        futures = [producer.send('test-stream', self._entry())
+                   for _ in range(500)]
+        assert all('SequenceNumber' in future.result(timeout=5)
+                   for future in futures)
+        assert kinesis.calls == [500]
+        producer.close()
+
+    def test_sends_partial_batch_after_linger(self):
+        kinesis = self._kinesis()
+        producer = KinesisProducer(kinesis, linger=0.05)
+        futures = [producer.send('test-stream', self._entry())
+                   for _ in range(3)]
+        assert all('SequenceNumber' in future.result(timeout=5)
+                   for future in futures)
+        assert kinesis.calls == [3]
+        producer.close()
+
+    def test_flush_sends_buffered_entries(self):
+        kinesis = self._kinesis()
+        producer = KinesisProducer(kinesis, linger=60)
+        for _ in range(3):
+            producer.send('test-stream', self._entry())
+        assert producer.flush(timeout=5)
+        assert kinesis.calls == [3]
+        assert producer.get_stats()['sent'] == 3
+        producer.close()
+
+    def test_raises_when_buffer_full(self):
+        producer = KinesisProducer(
+            self._kinesis(), capacity=2, linger=60, backpressure='raise')
+        producer.send('test-stream', self._entry())
+        producer.send('test-stream', self._entry())
+        with pytest.raises(BufferFullError):
+            producer.send('test-stream', self._entry())
+        assert producer.get_stats()['buffer_full'] == 1
+        producer.close()
+
+    def test_blocks_until_space_is_freed(self):
+        producer = KinesisProducer(self._kinesis(), capacity=1, linger=60)
+        producer.send('test-stream', self._entry())
+        with pytest.raises(BufferFullError):
+            producer.send('test-stream', self._entry(), timeout=0.05)
+        flusher = threading.Thread(target=producer.flush)
+        flusher.start()
+        future = producer.send('test-stream', self._entry(), timeout=5)
+        flusher.join()
+        producer.flush(timeout=5)
+        assert 'SequenceNumber' in future.result(timeout=5)
+        producer.close()
+
+    def test_paces_each_shard_under_its_limit(self):
+        '''
+        A burst for one shard is held back once the shard's records for
+        the second are used, without holding back the other shards.
+        '''
+        kinesis = self._kinesis()
+        producer = KinesisProducer(
+            kinesis, linger=60, records_per_second=100,
+            shard_ranges=[(0, 9), (10, 2 ** 128 - 1)])
+        futures = [producer.send('test-stream', self._entry(0))
+                   for _ in range(150)]
+        futures += [producer.send('test-stream', self._entry(10))
+                    for _ in range(10)]
+        assert producer.flush(timeout=5)
+        assert kinesis.calls[0] == 110
+        assert sum(kinesis.calls) == 160
+        assert all('SequenceNumber' in future.result() for future in futures)
+        producer.close()
+
+    def test_requeues_failed_entries(self):
+        kinesis = self._kinesis(failures={1: 'InternalFailure'})
+        producer = KinesisProducer(kinesis, linger=60)
+        futures = [producer.send('test-stream', self._entry())
+                   for _ in range(3)]
+        assert producer.flush(timeout=5)
+        assert kinesis.calls == [3, 1]
+        assert all('SequenceNumber' in future.result() for future in futures)
+        assert producer.get_stats()['retried'] == 1
+        producer.close()
+
+    def test_backs_off_before_resending_failed_entries(self):
+        kinesis = self._kinesis(failures={1: 'InternalFailure'})
+        sent = []
+        put_records = kinesis.put_records.side_effect
+
+        def timed_put_records(**kwargs):
+            sent.append(time.monotonic())
+            return put_records(**kwargs)
+
+        kinesis.put_records.side_effect = timed_put_records
+        producer = KinesisProducer(kinesis, linger=60)
+        producer.send('test-stream', self._entry())
+        assert producer.flush(timeout=5)
+        assert kinesis.calls == [1, 1]
+        assert sent[1] - sent[0] >= RETRY_BASE_DELAY / 2
+        producer.close()
+
+    def test_requeues_throttled_entries_without_retries(self):
+        kinesis = self._kinesis(
+            failures={1: 'ProvisionedThroughputExceededException'})
+        producer = KinesisProducer(kinesis, linger=60, max_retries=0)
+        futures = [producer.send('test-stream', self._entry())
+                   for _ in range(3)]
+        assert producer.flush(timeout=5)
+        assert kinesis.calls == [3, 1]
+        assert all('SequenceNumber' in future.result() for future in futures)
+        stats = producer.get_stats()
+        assert stats['throttled'] == 1
+        assert stats['retried'] == 0
+        assert producer.throttle.get_stats()['throttled'] == 1
+        producer.close()
+
+    def test_failed_request_raises_from_future(self):
+        kinesis = MagicMock()
+        kinesis.put_records.side_effect = RuntimeError('Connection reset')
+        producer = KinesisProducer(kinesis, linger=60)
+        future = producer.send('test-stream', self._entry())
+        assert producer.flush(timeout=5)
+        assert isinstance(future.exception(), RuntimeError)
+        assert producer.get_stats()['failed'] == 1
+        producer.close()
+
+    def test_refuses_entries_once_closed(self):
+        producer = KinesisProducer(self._kinesis())
+        producer.close()
+        with pytest.raises(RuntimeError):
+            producer.send('test-stream', self._entry())
+
+    def test_rejects_unknown_backpressure(self):
+        with pytest.raises(ValueError):
+            KinesisProducer(MagicMock(), backpressure='drop')
@@ -0,0 +1,112 @@
+import io
+import json
+import logging
+import threading
+import pytest
+from src import metrics as metrics_module
+from src.metrics import (
+    Metrics, start_invocation, get_metrics, timed, set_stream, SERVICE,
+    MAX_SAMPLES
+)
+
+
+@pytest.fixture
+def metrics_log(caplog):
+    logger = logging.getLogger('GuardianMetrics')
+    logger.addHandler(caplog.handler)
+    yield caplog
+    logger.removeHandler(caplog.handler)
+
+
+class TestMetrics:
+
+    def test_timer_records_duration_samples(self):
+        metrics = Metrics()
+        for _ in range(2):
+            with metrics.timer('Stage'):
+                pass
+        durations = metrics.get('StageDuration')
+        assert len(durations) == 2
+        assert all(duration >= 0 for duration in durations)
+
+    def test_timer_records_duration_when_block_raises(self):
+        metrics = Metrics()
+        with pytest.raises(ValueError):
+            with metrics.timer('Stage'):
+                raise ValueError()
+        assert len(metrics.get('StageDuration')) == 1
+
+    def test_counters_are_summed_across_threads(self):
+        metrics = Metrics()
+        threads = [threading.Thread(
+            target=lambda: [metrics.add('Records') for _ in range(1000)])
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert metrics.get('Records') == 4000
+
+    def test_to_emf_declares_every_metric(self):
+        metrics = Metrics(cold_start=True, StreamId='test_stream')
+        metrics.add('BytesSent', 100, 'Bytes')
+        metrics.record('StageDuration', 1.5)
+        emf = metrics.to_emf()
+        directive = emf['_aws']['CloudWatchMetrics'][0]
+        assert directive['Dimensions'] == [['Service']]
+        assert {'Name': 'BytesSent', 'Unit': 'Bytes'} in \
+            directive['Metrics']
+        assert {'Name': 'StageDuration', 'Unit': 'Milliseconds'} in \
+            directive['Metrics']
+        assert emf['BytesSent'] == 100
+        assert emf['StageDuration'] == [1.5]
+        assert emf['ColdStart'] == 1
+        assert emf['StreamId'] == 'test_stream'
+
+    def test_samples_are_capped_for_emf(self):
+        metrics = Metrics()
+        for value in range(MAX_SAMPLES * 10):
+            metrics.record('StageDuration', value)
+        samples = metrics.get('StageDuration')
+        assert len(samples) == MAX_SAMPLES
+        assert len(set(samples)) == MAX_SAMPLES
+        assert max(samples) >= MAX_SAMPLES
+        emf = metrics.to_emf()
+        assert len(emf['StageDuration']) == MAX_SAMPLES
+        assert emf['StageDurationSamples'] == MAX_SAMPLES * 10
+        assert {'Name': 'StageDurationSamples', 'Unit': 'Count'} in \
+            emf['_aws']['CloudWatchMetrics'][0]['Metrics']
+
+    def test_emit_logs_json_line(self, metrics_log):
+        metrics = Metrics()
+        metrics.add('Records', 3)
+        with metrics_log.at_level(logging.INFO):
+            metrics.emit()
+        assert json.loads(metrics_log.records[-1].message)['Records'] == 3
+
+    def test_emit_writes_to_redirected_stream(self):
+        stream = io.StringIO()
+        previous = set_stream(stream)
+        try:
+            Metrics().emit()
+        finally:
+            set_stream(previous)
+        assert json.loads(stream.getvalue())['Service'] == SERVICE
+
+
+class TestInvocation:
+
+    def test_only_first_invocation_is_cold(self, monkeypatch):
+        monkeypatch.setattr(metrics_module, '_cold_start', True)
+        assert start_invocation().cold_start
+        assert not start_invocation().cold_start
+
+    def test_timed_records_to_current_invocation(self):
+        @timed('Work')
+        def work():
+            return 'done'
+
+        metrics = start_invocation()
+        assert work() == 'done'
+        assert get_metrics() is metrics
+        assert len(metrics.get('WorkDuration')) == 1
@@ -0,0 +1,103 @@
+import pytest
+from unittest.mock import MagicMock
+from src.partitioning import (
+    TermPartitioner, UrlHashPartitioner, RoundRobinPartitioner,
+    SaltedTermPartitioner, even_shard_ranges, get_shard_ranges, get_shards,
+    shard_distribution, get_partition_strategy, MAX_HASH_KEY
+)
+
+
+def make_records(count):
+    return [{'webUrl': f'https://www.theguardian.com/{index}/'}
+            for index in range(count)]
+
+
+class TestEvenShardRanges:
+
+    def test_ranges_cover_whole_hash_key_space(self):
+        ranges = even_shard_ranges(15)
+        assert len(ranges) == 15
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == MAX_HASH_KEY
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert start == end + 1
+
+
+class TestGetShardRanges:
+
+    def test_skips_closed_shards(self):
+        kinesis = MagicMock()
+        kinesis.list_shards.return_value = {'Shards': [
+            {'ShardId': 'shardId-000000000001',
+             'HashKeyRange': {'StartingHashKey': '10',
+                              'EndingHashKey': '19'},
+             'SequenceNumberRange': {'StartingSequenceNumber': '1'}},
+            {'ShardId': 'shardId-000000000000',
+             'HashKeyRange': {'StartingHashKey': '0',
+                              'EndingHashKey': '9'},
+             'SequenceNumberRange': {'StartingSequenceNumber': '1'}},
+            {'ShardId': 'shardId-000000000002',
+             'HashKeyRange': {'StartingHashKey': '0',
+                              'EndingHashKey': '19'},
+             'SequenceNumberRange': {'StartingSequenceNumber': '1',
+                                     'EndingSequenceNumber': '2'}},
+        ]}
+        assert get_shard_ranges(kinesis, 'test-stream') == \
+            [(0, 9), (10, 19)]
+        assert get_shards(kinesis, 'test-stream') == [
+            ('shardId-000000000000', (0, 9)),
+            ('shardId-000000000001', (10, 19))]
+
+
+class TestStrategies:
+
+    ranges = even_shard_ranges(15)
+
+    def test_term_partitioner_uses_one_shard(self):
+        counts = shard_distribution(
+            TermPartitioner(), make_records(150), 'term', self.ranges)
+        assert sorted(counts)[-1] == 150
+
+    def test_url_partitioner_spreads_records(self):
+        counts = shard_distribution(
+            UrlHashPartitioner(), make_records(1500), 'term', self.ranges)
+        assert min(counts) > 50
+
+    def test_url_partitioner_is_stable_per_article(self):
+        record = make_records(1)[0]
+        partitioner = UrlHashPartitioner()
+        assert partitioner.keys(record, 'term_1') == \
+            partitioner.keys(record, 'term_2')
+
+    def test_round_robin_partitioner_balances_exactly(self):
+        counts = shard_distribution(
+            RoundRobinPartitioner(self.ranges), make_records(150),
+            'term', self.ranges)
+        assert counts == [10] * 15
+
+    def test_salted_partitioner_limits_keys_per_term(self):
+        partitioner = SaltedTermPartitioner(salts=4)
+        keys = {partitioner.keys(record, 'term')['PartitionKey']
+                for record in make_records(100)}
+        assert keys == {f'term#{salt}' for salt in range(4)}
+
+
+class TestGetPartitionStrategy:
+
+    @pytest.mark.parametrize('name, strategy', [
+        ('term', TermPartitioner), ('url', UrlHashPartitioner),
+        ('round_robin', RoundRobinPartitioner),
+        ('salted', SaltedTermPartitioner)
+    ])
+    def test_returns_selected_strategy(self, monkeypatch, name, strategy):
+        monkeypatch.setenv('PARTITION_STRATEGY', name)
+        assert isinstance(get_partition_strategy(15), strategy)
+
+    def test_defaults_to_term_partitioner(self, monkeypatch):
+        monkeypatch.delenv('PARTITION_STRATEGY', raising=False)
+        assert isinstance(get_partition_strategy(15), TermPartitioner)
+
+    def test_raises_error_for_unknown_strategy(self, monkeypatch):
+        monkeypatch.setenv('PARTITION_STRATEGY', 'random')
+        with pytest.raises(ValueError):
+            get_partition_strategy(15)
@@ -0,0 +1,60 @@
+import pytest
+from src.projection import FieldProjector, get_projector
+
+
+RECORD = {
+    'id': 'technology/2024/jan/01/article',
+    'webTitle': 'Article',
+    'webUrl': 'https://www.theguardian.com/article',
+    'fields': {'bodyText': 'Text', 'wordcount': '1'},
+}
+
+
+class TestFieldProjector:
+
+    def test_projects_top_level_fields(self):
+        projector = FieldProjector(['webTitle', 'webUrl'])
+        assert projector.project(RECORD) == {
+            'webTitle': 'Article',
+            'webUrl': 'https://www.theguardian.com/article'}
+
+    def test_single_field(self):
+        assert FieldProjector(['webTitle']).project(RECORD) == \
+            {'webTitle': 'Article'}
+
+    def test_missing_fields_are_left_out(self):
+        projector = FieldProjector(['webTitle', 'webPublicationDate'])
+        assert projector.project(RECORD) == {'webTitle': 'Article'}
+
+    def test_nested_paths_and_renaming(self):
+        projector = FieldProjector([
+            ('webUrl', 'url'), ('fields.bodyText', 'body'),
+            'fields.wordcount', 'fields.missing', 'webTitle.length'])
+        assert projector.project(RECORD) == {
+            'url': 'https://www.theguardian.com/article',
+            'body': 'Text', 'wordcount': '1'}
+        assert projector.project({'webUrl': 'url'}) == {'url': 'url'}
+
+    def test_dict_spec_maps_paths_to_names(self):
+        projector = FieldProjector({'fields.bodyText': 'body'})
+        assert projector.project(RECORD) == {'body': 'Text'}
+
+    def test_projects_page_with_incomplete_records(self):
+        projector = FieldProjector(['webTitle', 'webUrl'])
+        page = [RECORD, {'webTitle': 'Other'}, RECORD]
+        assert projector.project_page(page) == \
+            [projector.project(record) for record in page]
+
+    def test_empty_spec_projects_nothing(self):
+        assert FieldProjector([]).project_page([RECORD]) == [{}]
+
+    @pytest.mark.parametrize('fields', [
+        ['webTitle', ('webUrl', 'webTitle')], ['fields..bodyText'], ['']
+    ])
+    def test_raises_error_for_invalid_spec(self, fields):
+        with pytest.raises(ValueError):
+            FieldProjector(fields)
+
+    def test_projectors_are_compiled_once_per_spec(self):
+        spec = ('webTitle', 'webUrl')
+        assert get_projector(spec) is get_projector(spec)
@@ -0,0 +1,151 @@
+import json
+import os
+import pytest
+import requests
+import responses
+from src.guardian_api import get_guardian_content, set_rate_limiter
+from src.metrics import start_invocation
+from src.response_cache import (
+    ResponseCache, get_response_cache, reset_response_cache
+)
+
+URL = 'https://content.guardianapis.com/search'
+PARAMS = {'api-key': 'key', 'q': 'machine  learning', 'page': 1}
+BODY = json.dumps({'response': {'results': [{'webTitle': 'Title'}]}})
+
+
+@pytest.fixture(autouse=True)
+def reset_cache():
+    reset_response_cache()
+    set_rate_limiter(None)
+    yield
+    reset_response_cache()
+    set_rate_limiter(None)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResponseCache:
+
+    def test_key_ignores_api_key_order_and_whitespace(self):
+        same = {'page': 1, 'q': ' machine learning ', 'api-key': 'other'}
+        assert ResponseCache.key(PARAMS) == ResponseCache.key(same)
+        assert ResponseCache.key(PARAMS) != \
+            ResponseCache.key(dict(PARAMS, page=2))
+
+    def test_fresh_response_is_a_hit(self):
+        cache = ResponseCache()
+        key = cache.key(PARAMS)
+        assert cache.lookup(key) == (None, False)
+        cache.store(key, BODY.encode(), '"v1"')
+        entry, fresh = cache.lookup(key)
+        assert fresh
+        assert entry.json() == json.loads(BODY)
+        stats = cache.get_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_ratio'] == 0.5
+        assert stats['bytes_saved'] == len(BODY)
+
+    def test_stale_response_kept_only_with_etag(self):
+        clock = Clock()
+        cache = ResponseCache(ttl=60, clock=clock)
+        cache.store('tagged', b'{}', '"v1"')
+        cache.store('untagged', b'{}')
+        clock.now += 61
+        entry, fresh = cache.lookup('tagged')
+        assert entry.etag == '"v1"' and not fresh
+        assert cache.lookup('untagged') == (None, False)
+        cache.revalidate('tagged', entry)
+        assert cache.lookup('tagged')[1]
+
+    def test_least_recently_used_response_evicted(self):
+        cache = ResponseCache(capacity=2)
+        for key in ('a', 'b'):
+            cache.store(key, b'{}')
+        cache.lookup('a')
+        cache.store('c', b'{}')
+        assert cache.lookup('b') == (None, False)
+        assert cache.lookup('a')[1]
+
+    def test_disk_tier_survives_new_cache(self, tmp_path):
+        ResponseCache(directory=str(tmp_path)).store('key', b'{"a": 1}', 'e')
+        entry, fresh = ResponseCache(directory=str(tmp_path)).lookup('key')
+        assert fresh
+        assert entry.json() == {'a': 1}
+        assert entry.etag == 'e'
+
+    def test_disk_tier_keeps_most_recent_responses(self, tmp_path):
+        cache = ResponseCache(directory=str(tmp_path), disk_capacity=2)
+        for age, key in enumerate(('a', 'b', 'c')):
+            cache.store(key, b'{}')
+            os.utime(tmp_path / f'{key}.json', (age, age))
+        assert sorted(os.listdir(tmp_path)) == ['b.json', 'c.json']
+
+    def test_failed_disk_write_keeps_response_in_memory(
+            self, tmp_path, monkeypatch, caplog):
+        def full_disk(*args, **kwargs):
+            raise OSError(28, 'No space left on device')
+
+        cache = ResponseCache(directory=str(tmp_path))
+        monkeypatch.setattr('src.response_cache.tempfile.mkstemp', full_disk)
+        cache.store('key', b'{"a": 1}')
+        assert cache.lookup('key')[0].json() == {'a': 1}
+        assert 'Response not written to the cache' in caplog.text
+        assert os.listdir(tmp_path) == []
+
+    def test_disabled_without_ttl(self, monkeypatch):
+        monkeypatch.delenv('RESPONSE_CACHE_TTL', raising=False)
+        assert get_response_cache() is None
+        monkeypatch.setenv('RESPONSE_CACHE_TTL', '60')
+        assert get_response_cache() is get_response_cache()
+        assert get_response_cache().ttl == 60
+
+
+class TestCachedRequests:
+
+    @responses.activate
+    def test_repeated_request_served_from_cache(self, monkeypatch):
+        monkeypatch.setenv('RESPONSE_CACHE_TTL', '60')
+        responses.add(responses.GET, URL, body=BODY)
+        metrics = start_invocation()
+        first = get_guardian_content('key', 'football', '2024-01-01')
+        first['response']['results'].clear()
+        second = get_guardian_content('key', 'football', '2024-01-01')
+        assert second == json.loads(BODY)
+        assert len(responses.calls) == 1
+        assert metrics.get('GuardianCacheHits') == 1
+
+    @responses.activate
+    def test_stale_response_revalidated_with_etag(self, monkeypatch):
+        monkeypatch.setenv('RESPONSE_CACHE_TTL', '60')
+        responses.add(responses.GET, URL, body=BODY,
+                      headers={'ETag': '"v1"'})
+        responses.add(responses.GET, URL, status=304)
+        clock = Clock()
+        get_response_cache()._clock = clock
+        get_guardian_content('key', 'football', '2024-01-01')
+        clock.now += 61
+        assert get_guardian_content('key', 'football', '2024-01-01') == \
+            json.loads(BODY)
+        assert responses.calls[1].request.headers['If-None-Match'] == \
+            '"v1"'
+        stats = get_response_cache().get_stats()
+        assert stats['revalidated'] == 1
+        assert stats['bytes_saved'] == len(BODY)
+
+    @responses.activate
+    def test_failed_responses_are_not_cached(self, monkeypatch):
+        monkeypatch.setenv('RESPONSE_CACHE_TTL', '60')
+        responses.add(responses.GET, URL, status=401)
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                get_guardian_content('key', 'football', '2024-01-01')
+        assert len(responses.calls) == 2
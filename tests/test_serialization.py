@@ -0,0 +1,135 @@
+import gzip
+import json
+import pytest
+from src.aggregation import aggregate_entries
+from src.serialization import (
+    JsonSerializer, FastJsonSerializer, MessagePackSerializer,
+    compress_entries, decode_records, get_serializer, get_compression,
+    FORMAT_GZIP
+)
+from src.partitioning import ShardRouter, even_shard_ranges
+
+RECORD = {
+    'webPublicationDate': '2023-11-21T11:11:31Z',
+    'webTitle': 'Who said what: using machine learning',
+    'webUrl': 'https://www.theguardian.com/politics/2023/nov/21/who-said'
+}
+
+
+def make_entries(count):
+    return [{'Data': JsonSerializer().dumps(dict(RECORD, index=index)),
+             'PartitionKey': 'key'}
+            for index in range(count)]
+
+
+class TestSerializers:
+
+    def test_json_is_unmarked(self):
+        data = JsonSerializer().dumps(RECORD)
+        assert json.loads(data) == RECORD
+
+    def test_fast_json_round_trips(self):
+        pytest.importorskip('orjson')
+        data = FastJsonSerializer().dumps(RECORD)
+        assert json.loads(data) == RECORD
+        assert decode_records(data) == [RECORD]
+
+    def test_msgpack_round_trips(self):
+        pytest.importorskip('msgpack')
+        data = MessagePackSerializer().dumps(RECORD)
+        assert data[0] == 0x01
+        assert decode_records(data) == [RECORD]
+
+    def test_get_serializer_defaults_to_json(self, monkeypatch):
+        monkeypatch.delenv('SERIALIZER', raising=False)
+        assert isinstance(get_serializer(), JsonSerializer)
+
+    def test_get_serializer_reads_environment(self, monkeypatch):
+        pytest.importorskip('orjson')
+        monkeypatch.setenv('SERIALIZER', 'fastjson')
+        assert isinstance(get_serializer(), FastJsonSerializer)
+
+    def test_get_serializer_rejects_unknown_name(self):
+        with pytest.raises(ValueError, match='must be one of'):
+            get_serializer('xml')
+
+
+class TestCompressEntries:
+
+    def test_envelope_is_marked_and_smaller(self):
+        entries = make_entries(50)
+        groups = compress_entries(entries)
+        assert len(groups) == 1
+        envelope, indices = groups[0]
+        assert indices == list(range(50))
+        assert envelope['Data'][0] == FORMAT_GZIP
+        assert envelope['PartitionKey'] == 'key'
+        assert len(envelope['Data']) < \
+            sum(len(entry['Data']) for entry in entries) / 5
+
+    def test_round_trips_records_in_order(self):
+        groups = compress_entries(make_entries(20))
+        records = decode_records(groups[0][0]['Data'])
+        assert records == [dict(RECORD, index=index)
+                           for index in range(20)]
+
+    def test_envelopes_respect_max_size(self):
+        entries = make_entries(100)
+        groups = compress_entries(entries, max_size=4096)
+        assert len(groups) > 1
+        assert [index for _, indices in groups for index in indices] == \
+            list(range(100))
+        for envelope, _ in groups:
+            assert len(gzip.decompress(envelope['Data'][1:])) <= 4096
+
+    def test_envelopes_hold_entries_for_one_shard(self):
+        shard_ranges = even_shard_ranges(4)
+        router = ShardRouter(shard_ranges)
+        entries = [dict(entry, PartitionKey=f'key-{index}')
+                   for index, entry in enumerate(make_entries(200))]
+        groups = compress_entries(entries, shard_ranges=shard_ranges)
+        assert len(groups) == 4
+        for envelope, indices in groups:
+            assert {router.shard_id(entries[index])
+                    for index in indices} == {router.shard_id(envelope)}
+            assert [record['index'] for record in
+                    decode_records(envelope['Data'])] == indices
+
+    def test_zstd_round_trips(self):
+        pytest.importorskip('zstandard')
+        groups = compress_entries(make_entries(10), 'zstd')
+        assert len(decode_records(groups[0][0]['Data'])) == 10
+
+    def test_rejects_unknown_codec(self):
+        with pytest.raises(ValueError, match='must be one of'):
+            compress_entries(make_entries(1), 'lz4')
+
+
+class TestDecodeRecords:
+
+    def test_decodes_plain_json(self):
+        assert decode_records(json.dumps(RECORD).encode()) == [RECORD]
+
+    def test_decodes_aggregated_records(self):
+        entry, _ = aggregate_entries(make_entries(3))[0]
+        assert [record['index'] for record in
+                decode_records(entry['Data'])] == [0, 1, 2]
+
+    def test_empty_data_has_no_records(self):
+        assert decode_records(b'') == []
+
+
+class TestGetCompression:
+
+    def test_disabled_by_default(self, monkeypatch):
+        monkeypatch.delenv('COMPRESSION', raising=False)
+        assert get_compression() is None
+
+    def test_reads_environment(self, monkeypatch):
+        monkeypatch.setenv('COMPRESSION', 'gzip')
+        assert get_compression() == 'gzip'
+
+    def test_rejects_unknown_codec(self, monkeypatch):
+        monkeypatch.setenv('COMPRESSION', 'lz4')
+        with pytest.raises(ValueError, match='must be one of'):
+            get_compression()
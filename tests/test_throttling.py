@@ -0,0 +1,114 @@
+import pytest
+from src.throttling import (
+    ThrottleController, ShardBudget, entry_size, MIN_RATE_FRACTION
+)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def _entry(hash_key=0, size=10):
+    return {'Data': b'x' * size, 'PartitionKey': 'key',
+            'ExplicitHashKey': str(hash_key)}
+
+
+SHARD_RANGES = [(0, 9), (10, 2 ** 128 - 1)]
+
+
+class TestShardBudget:
+
+    def test_take_refuses_once_records_spent(self):
+        budget = ShardBudget(2, 1000, 0.0)
+        assert budget.take(10)
+        assert budget.take(10)
+        assert not budget.take(10)
+        assert budget.wait_time(10) == pytest.approx(0.5)
+
+    def test_refills_at_its_rate(self):
+        budget = ShardBudget(2, 1000, 0.0)
+        budget.take(10)
+        budget.take(10)
+        budget.refill(0.5)
+        assert budget.take(10)
+
+    def test_reserve_returns_delay_once_in_debt(self):
+        budget = ShardBudget(2, 1000, 0.0)
+        assert budget.reserve(10) == 0.0
+        assert budget.reserve(10) == 0.0
+        assert budget.reserve(10) == pytest.approx(0.5)
+
+
+class TestThrottleController:
+
+    def test_routes_entries_by_hash_key(self):
+        controller = ThrottleController(SHARD_RANGES)
+        assert controller.shard_id(_entry(0)) == 'shardId-000000000000'
+        assert controller.shard_id(_entry(10)) == 'shardId-000000000001'
+
+    def test_shards_are_not_paced_before_a_throttle(self, clock):
+        controller = ThrottleController(
+            SHARD_RANGES, records_per_second=1, clock=clock)
+        assert controller.reserve([_entry()] * 100) == 0.0
+
+    def test_throttle_halves_rate_of_shard(self, clock):
+        controller = ThrottleController(
+            SHARD_RANGES, records_per_second=100, clock=clock)
+        controller.record_throttle('shardId-000000000000', 5)
+        controller.record_throttle('shardId-000000000000', 5)
+        shards = controller.get_stats()['shards']
+        assert shards['shardId-000000000000']['records_per_second'] == 25.0
+        assert shards['shardId-000000000000']['throttled'] == 10
+        assert 'shardId-000000000001' not in shards
+
+    def test_throttled_shard_delays_its_entries(self, clock):
+        controller = ThrottleController(
+            SHARD_RANGES, records_per_second=100, clock=clock)
+        controller.record_throttle('shardId-000000000000')
+        assert controller.reserve([_entry(0)] * 10) == pytest.approx(0.2)
+        assert controller.reserve([_entry(10)] * 10) == 0.0
+
+    def test_rate_never_falls_below_minimum(self, clock):
+        controller = ThrottleController(
+            SHARD_RANGES, records_per_second=100, clock=clock)
+        for _ in range(20):
+            controller.record_throttle('shardId-000000000000')
+        shard = controller.get_stats()['shards']['shardId-000000000000']
+        assert shard['records_per_second'] == 100 * MIN_RATE_FRACTION
+
+    def test_successes_raise_rate_back_to_limit(self, clock):
+        controller = ThrottleController(
+            SHARD_RANGES, records_per_second=100, increase=0.25,
+            clock=clock)
+        controller.record_throttle('shardId-000000000000')
+        controller.record_success('shardId-000000000000')
+        shards = controller.get_stats()['shards']
+        assert shards['shardId-000000000000']['records_per_second'] == 75.0
+        for _ in range(5):
+            controller.record_success('shardId-000000000000')
+        shards = controller.get_stats()['shards']
+        assert shards['shardId-000000000000']['records_per_second'] == 100.0
+
+    def test_reports_effective_throughput(self, clock):
+        controller = ThrottleController(SHARD_RANGES, clock=clock)
+        controller.record_success(
+            'shardId-000000000000', 100, 100 * entry_size(_entry()))
+        clock.now = 2.0
+        controller.record_success(
+            'shardId-000000000001', 100, 100 * entry_size(_entry()))
+        stats = controller.get_stats()
+        assert stats['written'] == 200
+        assert stats['throttled'] == 0
+        assert stats['effective_records_per_second'] == 100.0
+        assert stats['effective_bytes_per_second'] == \
+            100.0 * entry_size(_entry())
@@ -1,7 +1,8 @@
 import pytest
 import re
 from src.validation import (
-    check_date_is_valid, check_id_string_is_valid
+    check_date_is_valid, check_id_string_is_valid,
+    check_positive_int_is_valid, check_list_is_valid
 )
 
 
@@ -167,3 +168,47 @@ class TestCheckIdStringIsValid:
         assert exec.match(re.escape(
             'Parameter (test_id) cannot contain only whitespace.'
         ))
+
+
+class TestCheckPositiveIntIsValid:
+
+    def test_returns_true_for_positive_integer(self):
+        assert check_positive_int_is_valid(1, 'test_param')
+        assert check_positive_int_is_valid(250, 'test_param')
+
+    @pytest.mark.parametrize('param', ['1', 1.5, True])
+    def test_raises_error_for_invalid_type(self, param):
+        with pytest.raises(TypeError) as exec:
+            check_positive_int_is_valid(param, 'test_param')
+        assert exec.match(re.escape(
+            'Parameter (test_param) must be of type integer.'
+        ))
+
+    @pytest.mark.parametrize('param', [0, -3])
+    def test_raises_error_for_non_positive_value(self, param):
+        with pytest.raises(ValueError) as exec:
+            check_positive_int_is_valid(param, 'test_param')
+        assert exec.match(re.escape(
+            'Parameter (test_param) must be a positive integer.'
+        ))
+
+
+class TestCheckListIsValid:
+
+    def test_returns_true_for_non_empty_list(self):
+        assert check_list_is_valid(['term'], 'test_param')
+
+    @pytest.mark.parametrize('param', ['term', ('term',), None])
+    def test_raises_error_for_invalid_type(self, param):
+        with pytest.raises(TypeError) as exec:
+            check_list_is_valid(param, 'test_param')
+        assert exec.match(re.escape(
+            'Parameter (test_param) must be of type list.'
+        ))
+
+    def test_raises_error_for_empty_list(self):
+        with pytest.raises(ValueError) as exec:
+            check_list_is_valid([], 'test_param')
+        assert exec.match(re.escape(
+            'Parameter (test_param) cannot be an empty list.'
+        ))